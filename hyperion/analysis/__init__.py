@@ -34,18 +34,6 @@ def build_context_line(role, content, name=None):
     return {'role': role, 'content': content, 'name': name}
 
 
-def acquire_mutex(fn):
-    def wrapper(*args, **kwargs):
-        mutex = args[0]._mutex
-        try:
-            mutex.acquire()
-            res = fn(*args, **kwargs)
-        finally:
-            mutex.release()
-        return res
-    return wrapper
-
-
 def get_model_token_specs(model):
     if model.startswith('gpt-3.5-turbo') and model != 'gpt-3.5-turbo-0301':
         ProjectLogger().debug('gpt-3.5-turbo may change over time. Returning num tokens assuming gpt-3.5-turbo-0301.')
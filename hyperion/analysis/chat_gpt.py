@@ -1,31 +1,96 @@
 from time import time
-from openai import OpenAI
+from openai import AsyncOpenAI
+from functools import lru_cache
 from threading import Lock
+from contextlib import contextmanager
 from openai._types import NOT_GIVEN
 from hyperion.utils import load_file
 from hyperion.utils.logger import ProjectLogger
-from hyperion.utils.request import RequestObject
-from concurrent.futures import ThreadPoolExecutor
+from hyperion.utils.request import RequestObject, RequestCancelled
 from hyperion.utils.paths import ProjectPaths
 from hyperion.utils.threading import Consumer, Producer
 from hyperion.analysis.prompt_manager import PromptManager
+from hyperion.analysis.completion_pool import CompletionPool
+from hyperion.analysis.sentence_segmenter import SentenceSegmenter
+from hyperion.analysis.response_cache import ResponseCache
 from hyperion.utils.external_resources_parsing import fetch_urls
-from hyperion.analysis import CHAT_MODELS, acquire_mutex, get_model_token_specs, build_context_line, sanitize_username
+from hyperion.analysis import CHAT_MODELS, get_model_token_specs, build_context_line, sanitize_username
 
 import os
 import queue
 import random
+import asyncio
 import tiktoken
 import numpy as np
 
 
+@lru_cache(maxsize=None)
+def get_tokenizer(model):
+    if model.startswith('mixtral'):
+        model = 'gpt-4-32k'
+    elif model.startswith('mistral'):
+        model = 'gpt-4'
+    return tiktoken.encoding_for_model(model)
+
+
+def message_tokens(message, tokenizer, tokens_per_message, tokens_per_name):
+    num_tokens = tokens_per_message
+    for key, value in message.items():
+        if type(value) == str:
+            num_tokens += len(tokenizer.encode(value))
+        elif value[0]['type'] == 'text':
+            num_tokens += len(tokenizer.encode(value[0]['text']))
+        elif value[0]['image_url']['detail'] == 'low':
+            num_tokens += 85
+        elif value[0]['image_url']['detail'] == 'high':
+            raise NotImplementedError('Depend of image size and may vary.')
+
+        if key == 'name':
+            num_tokens += tokens_per_name
+    return num_tokens
+
+
+class ConversationLocks:
+    """
+    One lock per conversation, so that requests of a conversation never wait for another one.
+    Time spent waiting for each lock is recorded.
+    """
+
+    def __init__(self):
+        self._lock = Lock()
+        self._locks = {}
+        self._waits = {}
+
+    @contextmanager
+    def hold(self, conversation):
+        with self._lock:
+            lock = self._locks.setdefault(conversation, Lock())
+
+        t0 = time()
+        lock.acquire()
+        wait = time() - t0
+        with self._lock:
+            count, total, longest = self._waits.get(conversation, (0, 0., 0.))
+            self._waits[conversation] = (count + 1, total + wait, max(longest, wait))
+
+        try:
+            yield
+        finally:
+            lock.release()
+
+    def stats(self):
+        with self._lock:
+            return {conversation: dict(acquisitions=count, wait_total=total, wait_mean=total / count, wait_max=longest)
+                    for conversation, (count, total, longest) in self._waits.items()}
+
+
 class ChatGPT(Consumer, Producer):
 
     def __init__(self, name, model, no_memory, clear, prompt='base', llama_host='localhost', llama_port=8080):
         super().__init__()
         ProjectLogger().info(f'{name} using {model} as chat backend. No memory -> {no_memory}')
 
-        self._mutex = Lock()
+        self._locks = ConversationLocks()
         self._model = model
         self._no_memory = no_memory
 
@@ -36,13 +101,15 @@ class ChatGPT(Consumer, Producer):
         self._error_sentences = load_file(sentences_path / 'dead')
         self._memory_sentences = load_file(sentences_path / 'memory')
 
+        # generations of every user share one event loop, each backend has its own connections pool and concurrency
+        self._completions = CompletionPool()
+        self._response_cache = ResponseCache()
         llama_cpp_url = f'http://{llama_host}:{llama_port}/v1'
-        self._mistral_client = OpenAI(api_key='sk-no-key-required', base_url=llama_cpp_url)
-        self._open_ai_client = None
+        self._completions.register('llama', lambda http_client: AsyncOpenAI(api_key='sk-no-key-required', base_url=llama_cpp_url, http_client=http_client))
         try:
             openai_api = ProjectPaths().resources_dir / 'keys' / 'openai_api.key'
             api_key = os.environ['OPENAI_API'] if 'OPENAI_API' in os.environ else load_file(openai_api)[0]
-            self._open_ai_client = OpenAI(api_key=api_key)
+            self._completions.register('openai', lambda http_client: AsyncOpenAI(api_key=api_key, http_client=http_client))
         except Exception:
             ProjectLogger().warning('No OpenAI api key found. GPT models won\'t be available.')
 
@@ -58,46 +125,46 @@ class ChatGPT(Consumer, Producer):
     def get_model(self):
         return self._model
 
+    def set_concurrency(self, limits):
+        self._completions.set_limits(limits)
+
+    def get_completions_stats(self):
+        return self._completions.stats()
+
+    def set_response_cache(self, ttl, max_entries=1024, similarity=0., excluded_prompts=()):
+        self._response_cache = ResponseCache(ttl, max_entries, similarity, excluded_prompts)
+
+    def get_response_cache_stats(self):
+        return self._response_cache.stats()
+
     def set_model(self, model):
         if model not in CHAT_MODELS.keys():
             return False
         self._model = model
         return True
 
+    def _tokens_specs(self, llm=None):
+        model = self._model if llm is None else llm
+        tokens_per_message, tokens_per_name = get_model_token_specs(model)
+        return get_tokenizer(model), tokens_per_message, tokens_per_name
+
     def _tokens_count(self, messages, llm=None):
         """
         Returns the number of tokens used by a list of messages.
         See https://platform.openai.com/docs/guides/vision for images token count.
         """
-        model = self._model if llm is None else llm
-        if model.startswith('mixtral'):
-            model = 'gpt-4-32k'
-        elif model.startswith('mistral'):
-            model = 'gpt-4'
-
-        tokenizer = tiktoken.encoding_for_model(model)
-        tokens_per_message, tokens_per_name = get_model_token_specs(self._model if llm is None else llm)
-
-        num_tokens = 0
-        for message in messages:
-            num_tokens += tokens_per_message
-            for key, value in message.items():
-                if type(value) == str:
-                    num_tokens += len(tokenizer.encode(value))
-                elif value[0]['type'] == 'text':
-                    num_tokens += len(tokenizer.encode(value[0]['text']))
-                elif value[0]['image_url']['detail'] == 'low':
-                    num_tokens += 85
-                elif value[0]['image_url']['detail'] == 'high':
-                    raise NotImplementedError('Depend of image size and may vary.')
-
-                if key == 'name':
-                    num_tokens += tokens_per_name
+        tokenizer, tokens_per_message, tokens_per_name = self._tokens_specs(llm)
+        num_tokens = sum(message_tokens(message, tokenizer, tokens_per_message, tokens_per_name) for message in messages)
         num_tokens += 3  # every reply is primed with <|start|>assistant<|message|>
         return num_tokens
 
-    @acquire_mutex
     def _add_to_context(self, new_message, preprompt=None, llm=None):
+        # resolved once, the current prompt may be changed meanwhile
+        preprompt = self.prompt_manager.conversation(preprompt)
+        with self._locks.hold(preprompt):
+            return self._build_context(new_message, preprompt, llm)
+
+    def _build_context(self, new_message, preprompt, llm):
         cache = [new_message]
         if self._video_ctx is not None and time() - self._video_ctx_timestamp < 20:
             video_ctx = f'[VIDEO STREAM] {self._video_ctx}'
@@ -106,25 +173,29 @@ class ChatGPT(Consumer, Producer):
         else:
             self._video_ctx = None
 
+        preprompt_messages = self.prompt_manager.preprompt(preprompt)
+        fixed_tokens = self._tokens_count(preprompt_messages + cache, llm)
+        budget = ChatGPT.max_tokens(self._model if llm is None else llm) - fixed_tokens
+        if budget <= 0:
+            ProjectLogger().warning(f'Request of {fixed_tokens} tokens does not fit the model context, even without history.')
+
+        # most recent messages fitting in the remaining budget, oldest ones being dropped
+        history, history_tokens, dropped_messages = [], 0, False
         if not self._no_memory:
-            cache = self.prompt_manager.all(preprompt) + cache
+            tokenizer, tokens_per_message, tokens_per_name = self._tokens_specs(llm)
+            key = f'{tokenizer.name}:{tokens_per_message}:{tokens_per_name}'
+            count_fn = lambda m: message_tokens(m, tokenizer, tokens_per_message, tokens_per_name)
+            history, history_tokens, dropped_messages = self.prompt_manager.tail(budget, key, count_fn, preprompt)
             self.prompt_manager.insert(new_message, preprompt)
 
-        dropped_messages = False
-        while True:
-            messages = self.prompt_manager.preprompt(preprompt) + cache
-            found_tokens = self._tokens_count(messages, llm)
-            if found_tokens < ChatGPT.max_tokens(self._model if llm is None else llm):
-                ProjectLogger().info(f'Sending a {found_tokens} tokens request.')
-                break
-            cache.pop(0)
-            dropped_messages = True
-
+        messages = preprompt_messages + history + cache
+        ProjectLogger().info(f'Sending a {fixed_tokens + history_tokens} tokens request.')
         return messages, dropped_messages
 
-    @acquire_mutex
     def clear_context(self, preprompt=None):
-        self.prompt_manager.truncate(preprompt)
+        preprompt = self.prompt_manager.conversation(preprompt)
+        with self._locks.hold(preprompt):
+            self.prompt_manager.truncate(preprompt)
         ProjectLogger().warning(f'Memory wiped for {preprompt}.')
 
     def add_video_context(self, frame_description):
@@ -135,32 +206,47 @@ class ChatGPT(Consumer, Producer):
     def add_indexes_context(self, query_res, preprompt, llm):
         _ = self._add_to_context(build_context_line('assistant', query_res), preprompt, llm)
 
-    @acquire_mutex
     def add_document_context(self, pages, preprompt):
-        for page in pages:
-            messages = [build_context_line('system', s.strip()) for s in page.split('.')]
-            _ = [self.prompt_manager.insert(message, preprompt) for message in messages]
+        messages = [build_context_line('system', s.strip()) for page in pages for s in page.split('.')]
+        preprompt = self.prompt_manager.conversation(preprompt)
+        with self._locks.hold(preprompt):
+            self.prompt_manager.insert_many(messages, preprompt)
+
+    def get_locks_stats(self):
+        return self._locks.stats()
+
+    @staticmethod
+    def _backend(model):
+        return 'openai' if model.startswith('gpt') else 'llama'
 
-    def answer(self, chat_input, role='user', name=None, preprompt=None, llm=None, stream=True):
+    async def answer(self, client, chat_input, role='user', name=None, preprompt=None, llm=None, stream=True):
         if name is not None:
             name = sanitize_username(name)
 
-        messages, dropped_messages = self._add_to_context(build_context_line(role, chat_input, name=name), preprompt, llm)
+        # history storage and tokens counting are blocking, they must not hold the event loop
+        messages, dropped_messages = await asyncio.to_thread(self._add_to_context, build_context_line(role, chat_input, name=name), preprompt, llm)
         max_tokens = NOT_GIVEN
-        response = self._chat_completion(llm, messages, stream, max_tokens)
+        response = await self._chat_completion(client, llm, messages, stream, max_tokens)
         return response, dropped_messages
 
-    def _chat_completion(self, llm, messages, stream, max_tokens):
+    async def _embed(self, text):
+        try:
+            async with self._completions.slot('openai') as client:
+                response = await client.embeddings.create(model='text-embedding-ada-002', input=text)
+            return np.array(response.data[0].embedding, dtype=np.float32)
+        except Exception as e:
+            ProjectLogger().warning(f'Request embedding failed, exact matches only. {e}')
+            return None
+
+    async def _chat_completion(self, client, llm, messages, stream, max_tokens):
         model = self._model if llm is None else llm
-        client = self._open_ai_client
-        if not model.startswith('gpt'):
-            client = self._mistral_client
+        if ChatGPT._backend(model) == 'llama':
             for message in messages:
                 if 'name' in message:
                     name = message['name']
                     content = message['content']
                     message['content'] = f'{name} : {content}'
-        return client.chat.completions.create(model=model, messages=messages, stream=stream, max_tokens=max_tokens)
+        return await client.chat.completions.create(model=model, messages=messages, stream=stream, max_tokens=max_tokens)
 
     def _dispatch_sentence(self, sentence, sentence_num, t0, request_obj):
         #sentence = sentence.strip()
@@ -193,102 +279,148 @@ class ChatGPT(Consumer, Producer):
         self._dispatch(request_obj)
 
     def _process_request(self, request_obj):
+        # blocking entry point for other stages, the generation still runs on the completions loop
+        future = self._completions.submit(self._generate(request_obj), request_obj.cancel_token)
+        return future.result()
+
+    async def _generate(self, request_obj):
 
         t0 = time()
         memory = ''
-        sentence = ''
         sentence_num = 0
+        chunked_response = None
+        segmenter = SentenceSegmenter()
+        # dispatching blocks on full downstream queues, it is handed off so other generations keep running
         try:
+            request_obj.cancel_token.raise_if_cancelled()
             ProjectLogger().info('Requesting ChatGPT...')
             ProjectLogger().info(f'{request_obj.user} : {request_obj.text_request}')
 
-            input_text = fetch_urls(request_obj.text_request)
+            input_text = await asyncio.to_thread(fetch_urls, request_obj.text_request)
+            model = self._model if request_obj.llm is None else request_obj.llm
             answer_opts = dict(name=request_obj.user, preprompt=request_obj.preprompt, llm=request_obj.llm)
-            chunked_response, dropped_messages = self.answer(input_text, **answer_opts)
-            ProjectLogger().info(f'ChatGPT answered in {time() - t0:.3f} sec(s)')
-            if dropped_messages and self._dispatch_memory_warning(request_obj, sentence_num, randomized=True):
-                sentence_num += 1
-
-            for chunk in chunked_response:
-                finish_reason = chunk.choices[0].finish_reason
-                # TODO vision-preview support
-                if 'finish_details' in chunk.choices[0].model_extra and chunk.choices[0].model_extra['finish_details'] is not None:
-                    finish_reason = chunk.choices[0].model_extra['finish_details']['type']
-
-                if finish_reason == 'stop':
+            # answers of requests already asked are replayed, without memory nor fetched urls they would not hold
+            preprompt = self.prompt_manager.conversation(request_obj.preprompt)
+            cacheable = self._response_cache.enabled(preprompt) and input_text == request_obj.text_request and not input_text.startswith('data:image')
+            embedding = None
+            cached_answer = self._response_cache.get(preprompt, model, input_text) if cacheable else None
+            if cacheable and cached_answer is None and self._response_cache.similarity > 0:
+                # embedding costs a round-trip, only exact misses pay it
+                embedding = await self._embed(input_text)
+                cached_answer = self._response_cache.get_similar(preprompt, model, embedding)
+
+            if cached_answer is not None:
+                ProjectLogger().info(f'ChatGPT answer replayed from cache in {time() - t0:.3f} sec(s)')
+                name = None if request_obj.user is None else sanitize_username(request_obj.user)
+                _ = await asyncio.to_thread(self._add_to_context, build_context_line('user', input_text, name=name), request_obj.preprompt, request_obj.llm)
+                memory = cached_answer
+                for sentence in segmenter.feed(cached_answer) + [segmenter.flush()]:
                     if sentence != '':
-                        self._dispatch_sentence(sentence, sentence_num, t0, request_obj)
-                    break
-                elif finish_reason == 'length':
-                    ProjectLogger().warning('Not enough left tokens to generate a complete answer')
-                    self._dispatch_memory_warning(request_obj, sentence_num)
-                    break
-                elif finish_reason is not None:
-                    ProjectLogger().warning('Unsupported finish reason')
-                    self._dispatch_error(sentence_num, request_obj)
-
-                answer = chunk.choices[0].delta
-                if hasattr(answer, 'content') and answer.content is not None:
-                    content = answer.content
-                    sentence += content
-                    memory += content
-
-                    # Need to comment line 146
-                    # sentence_ends = [sentence.find(e) for e in ['. ', '! ', '? ', '; ']]
-                    sentence_ends = [sentence.find(e) for e in ['. ', '.\n', '! ', '!\n', '? ', '?\n', '; ', ';\n', ': ', ':\n']]
-                    sentence_end = sentence_ends[np.argmax(sentence_ends)] + 1
-                    # if sentence.endswith('.') or sentence.endswith('!') or sentence.endswith('?'):
-                    if sentence_end > 0:
-                        self._dispatch_sentence(sentence[:sentence_end], sentence_num, t0, request_obj)
-                        sentence = sentence[sentence_end:]
+                        await asyncio.to_thread(self._dispatch_sentence, sentence, sentence_num, t0, request_obj)
+                        sentence_num += 1
+            else:
+                completed = False
+                async with self._completions.slot(ChatGPT._backend(model)) as client:
+                    chunked_response, dropped_messages = await self.answer(client, input_text, **answer_opts)
+                    ProjectLogger().info(f'ChatGPT answered in {time() - t0:.3f} sec(s)')
+                    if dropped_messages and await asyncio.to_thread(self._dispatch_memory_warning, request_obj, sentence_num, randomized=True):
                         sentence_num += 1
 
-            _ = self._add_to_context(build_context_line('assistant', memory), request_obj.preprompt, request_obj.llm)
-
+                    async for chunk in chunked_response:
+                        finish_reason = chunk.choices[0].finish_reason
+                        # TODO vision-preview support
+                        if 'finish_details' in chunk.choices[0].model_extra and chunk.choices[0].model_extra['finish_details'] is not None:
+                            finish_reason = chunk.choices[0].model_extra['finish_details']['type']
+
+                        if finish_reason == 'stop':
+                            sentence = segmenter.flush()
+                            if sentence != '':
+                                await asyncio.to_thread(self._dispatch_sentence, sentence, sentence_num, t0, request_obj)
+                            completed = True
+                            break
+                        elif finish_reason == 'length':
+                            ProjectLogger().warning('Not enough left tokens to generate a complete answer')
+                            await asyncio.to_thread(self._dispatch_memory_warning, request_obj, sentence_num)
+                            break
+                        elif finish_reason is not None:
+                            ProjectLogger().warning('Unsupported finish reason')
+                            await asyncio.to_thread(self._dispatch_error, sentence_num, request_obj)
+
+                        answer = chunk.choices[0].delta
+                        if hasattr(answer, 'content') and answer.content is not None:
+                            content = answer.content
+                            memory += content
+
+                            for sentence in segmenter.feed(content):
+                                await asyncio.to_thread(self._dispatch_sentence, sentence, sentence_num, t0, request_obj)
+                                sentence_num += 1
+
+                if cacheable and completed and memory != '':
+                    self._response_cache.put(preprompt, model, input_text, memory, embedding)
+
+            _ = await asyncio.to_thread(self._add_to_context, build_context_line('assistant', memory), request_obj.preprompt, request_obj.llm)
+
+        except (asyncio.CancelledError, RequestCancelled):
+            ProjectLogger().info(f'ChatGPT generation for {request_obj.identifier} canceled.')
+            if chunked_response is not None:
+                await chunked_response.response.aclose()
+            # what has already been said is remembered
+            if memory != '':
+                _ = await asyncio.to_thread(self._add_to_context, build_context_line('assistant', memory), request_obj.preprompt, request_obj.llm)
         except Exception as e:
             ProjectLogger().error(f'ChatGPT had a stroke. {e}')
-            self._dispatch_error(sentence_num, request_obj)
+            await asyncio.to_thread(self._dispatch_error, sentence_num, request_obj)
 
         # To close streaming response
-        self._dispatch(RequestObject(request_obj.identifier, request_obj.user, termination=True))
+        await asyncio.to_thread(self._dispatch, RequestObject(request_obj.identifier, request_obj.user, termination=True))
 
     def run(self) -> None:
-        with ThreadPoolExecutor(max_workers=4) as executor:
-            while self.running:
-                try:
-                    request_obj = self._consume()
+        self._completions.start()
+        while self.running:
+            try:
+                request_obj = self._consume()
+
+                ack = RequestObject.copy(request_obj)
+                ack.text_answer = '<ACK>'
+                ack.silent = True
+                self._dispatch(ack)
 
+                if request_obj.text_request == '':
                     ack = RequestObject.copy(request_obj)
-                    ack.text_answer = '<ACK>'
+                    ack.text_answer = '<CONFUSED>'
                     ack.silent = True
+                    ack.priority = 0
                     self._dispatch(ack)
 
-                    if request_obj.text_request == '':
-                        ack = RequestObject.copy(request_obj)
-                        ack.text_answer = '<CONFUSED>'
-                        ack.silent = True
-                        ack.priority = 0
-                        self._dispatch(ack)
-
-                        # 1 in 10 chance of receiving a notification that the message wasn't heard.
-                        request_obj.text_answer = ''
-                        if random.choices(range(10), weights=[1] * 10) != 9:
-                            placeholder = self._deaf_sentences[random.randint(0, len(self._deaf_sentences) - 1)]
-                            request_obj.text_answer = placeholder
-                            request_obj.num_answer += 1
-
-                        self._dispatch(request_obj)
-                        # To close streaming response
-                        self._dispatch(RequestObject(request_obj.identifier, request_obj.user, termination=True))
-                        continue
-
-                    _ = executor.submit(self._process_request, request_obj)
-                except queue.Empty:
+                    # 1 in 10 chance of receiving a notification that the message wasn't heard.
+                    request_obj.text_answer = ''
+                    if random.choices(range(10), weights=[1] * 10) != 9:
+                        placeholder = self._deaf_sentences[random.randint(0, len(self._deaf_sentences) - 1)]
+                        request_obj.text_answer = placeholder
+                        request_obj.num_answer += 1
+
+                    self._dispatch(request_obj)
+                    # To close streaming response
+                    self._dispatch(RequestObject(request_obj.identifier, request_obj.user, termination=True))
                     continue
 
+                # waits for a generation slot, requests queue up in the bounded intake meanwhile
+                model = self._model if request_obj.llm is None else request_obj.llm
+                _ = self._completions.submit(self._generate(request_obj), request_obj.cancel_token, ChatGPT._backend(model))
+            except queue.Empty:
+                continue
+
+        self._completions.stop()
         ProjectLogger().info('ChatGPT stopped.')
 
 
 if __name__ == '__main__':
+    async def main(chat):
+        async with chat._completions.slot('openai') as client:
+            response, _ = await chat.answer(client, 'En quelle année est né Nicolas Sarkozy ?', stream=False)
+            print(response.choices[0].message.content)
+
     chat = ChatGPT('TOTO', 'gpt-3.5-turbo', False, False)
-    chat.answer('En quelle année est né Nicolas Sarkozy ?', stream=False)
+    chat._completions.start()
+    chat._completions.submit(main(chat)).result()
+    chat._completions.stop()
@@ -0,0 +1,147 @@
+from threading import Lock, Thread, BoundedSemaphore
+from contextlib import asynccontextmanager
+from hyperion.utils.logger import ProjectLogger
+
+import httpx
+import asyncio
+
+# concurrent generations per backend
+DEFAULT_LIMITS = {'openai': 16, 'llama': 2}
+
+
+class CompletionPool:
+    """
+    Chat completions run as coroutines of a single event loop thread.
+    Each backend has its own HTTP connection pool and concurrency limit, running generations are cancelled
+    along with their request.
+    """
+
+    def __init__(self):
+        self._lock = Lock()
+        self._limits = dict(DEFAULT_LIMITS)
+        self._factories = {}
+        self._clients = {}
+        self._semaphores = {}
+        self._counters = {}
+        self._tasks = set()
+        self._pending = {}
+
+        self._loop = None
+        self._thread = None
+
+    def register(self, backend, factory):
+        """
+        :param backend: backend name
+        :param factory: builds the backend async client given an httpx.AsyncClient
+        """
+        self._factories[backend] = factory
+
+    def set_limits(self, limits):
+        assert self._loop is None, 'Limits must be set before the pool is started'
+        assert all(limit > 0 for limit in limits.values())
+        self._limits.update(limits)
+
+    def start(self):
+        self._pending = {backend: BoundedSemaphore(self._limits.get(backend, 1)) for backend in self._factories}
+        self._loop = asyncio.new_event_loop()
+        self._thread = Thread(target=self._loop.run_forever, name=self.__class__.__name__, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        if self._loop is None:
+            return
+
+        asyncio.run_coroutine_threadsafe(self._close(), self._loop).result()
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+        self._loop.close()
+        self._loop = None
+
+    async def _close(self):
+        with self._lock:
+            tasks = [t for t in self._tasks if t is not asyncio.current_task()]
+        _ = [t.cancel() for t in tasks]
+        await asyncio.gather(*tasks, return_exceptions=True)
+        _ = [await client.close() for client in self._clients.values()]
+
+    def submit(self, coroutine, cancel_token=None, backend=None):
+        """
+        Schedules a coroutine on the pool loop, returns a concurrent.futures.Future of its result.
+        The coroutine is cancelled as soon as cancel_token is.
+        When backend is given, blocks until less than its limit of submitted coroutines are pending, so that
+        the backlog stays in the calling stage intake.
+        """
+        assert self._loop is not None, 'Completion pool is not started'
+        pending = self._pending.get(backend)
+        if pending is None:
+            return asyncio.run_coroutine_threadsafe(self._track(coroutine, cancel_token), self._loop)
+
+        pending.acquire()
+        try:
+            future = asyncio.run_coroutine_threadsafe(self._track(coroutine, cancel_token), self._loop)
+        except Exception:
+            pending.release()
+            raise
+        future.add_done_callback(lambda _: pending.release())
+        return future
+
+    async def _track(self, coroutine, cancel_token):
+        task = asyncio.current_task()
+        loop = self._loop
+        with self._lock:
+            self._tasks.add(task)
+
+        def cancel():
+            ProjectLogger().info('Generation canceled.')
+            loop.call_soon_threadsafe(task.cancel)
+
+        if cancel_token is not None:
+            cancel_token.on_cancel(cancel)
+        try:
+            return await coroutine
+        finally:
+            if cancel_token is not None:
+                cancel_token.remove_callback(cancel)
+            with self._lock:
+                self._tasks.discard(task)
+
+    def _client(self, backend):
+        if backend not in self._factories:
+            raise ValueError(f'Backend {backend} is not available')
+
+        if backend not in self._clients:
+            limit = self._limits.get(backend, 1)
+            pool_limits = httpx.Limits(max_connections=limit, max_keepalive_connections=limit)
+            self._clients[backend] = self._factories[backend](httpx.AsyncClient(limits=pool_limits))
+            self._semaphores[backend] = asyncio.Semaphore(limit)
+            self._counters[backend] = dict(running=0, waiting=0, completed=0, canceled=0)
+        return self._clients[backend]
+
+    @asynccontextmanager
+    async def slot(self, backend):
+        """
+        Holds one of the backend generation slots, yields its client.
+        The slot must be held until the streamed answer is fully read.
+        """
+        client = self._client(backend)
+        counters = self._counters[backend]
+
+        counters['waiting'] += 1
+        try:
+            await self._semaphores[backend].acquire()
+        finally:
+            counters['waiting'] -= 1
+
+        counters['running'] += 1
+        try:
+            yield client
+            counters['completed'] += 1
+        except asyncio.CancelledError:
+            counters['canceled'] += 1
+            raise
+        finally:
+            counters['running'] -= 1
+            self._semaphores[backend].release()
+
+    def stats(self):
+        return {backend: dict(limit=self._limits.get(backend, 1), **counters) for backend, counters in list(self._counters.items())}
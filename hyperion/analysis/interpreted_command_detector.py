@@ -11,7 +11,7 @@ from hyperion.utils.memory_utils import MANAGER_TOKEN
 from hyperion.utils.identity_store import IdentityStore
 from hyperion.utils.threading import Consumer, Producer
 from hyperion.utils.task_scheduler import TaskScheduler
-from hyperion.utils.request import RequestObject, KeepAliveSet
+from hyperion.utils.request import RequestObject, KeepAliveSet, Cancellations
 from hyperion.utils.external_resources_parsing import load_url
 
 import re
@@ -267,6 +267,9 @@ class InterpretedCommandDetector(Consumer, Producer):
     def _on_quiet(self, request_obj):
         termination_request = RequestObject(request_obj.identifier, request_obj.user, termination=True)
         termination_request.priority = 0
+        # the answer carrying the command is cancelled along with every request of its client
+        request_obj.cancel_token.cancel()
+        Cancellations().cancel(request_obj.identifier, request_obj.socket_id)
         self._put(termination_request, request_obj.identifier)
         self.sio().emit('interrupt', Timer().now(), to=request_obj.socket_id)
 
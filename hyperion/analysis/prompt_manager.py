@@ -1,5 +1,5 @@
 from datetime import datetime
-from tinydb import TinyDB, Query
+from threading import Lock
 from hyperion.utils import load_file
 from werkzeug.utils import secure_filename
 from hyperion.utils.logger import ProjectLogger
@@ -7,6 +7,85 @@ from hyperion.utils.paths import ProjectPaths
 from hyperion.analysis import build_context_line, sanitize_username
 
 import os
+import json
+import sqlite3
+
+
+class HistoryStore:
+    """
+    Append-only conversation history backed by SQLite in WAL mode.
+    Inserts only append rows, token counts are cached per counting key so that recent messages are read without loading the whole history.
+    """
+
+    def __init__(self, db_path):
+        self._lock = Lock()
+        self._counted = {}
+        self._conn = sqlite3.connect(db_path, check_same_thread=False)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        with self._conn:
+            self._conn.execute('CREATE TABLE IF NOT EXISTS messages (id INTEGER PRIMARY KEY AUTOINCREMENT, message TEXT NOT NULL)')
+            self._conn.execute('CREATE TABLE IF NOT EXISTS tokens (key TEXT NOT NULL, message_id INTEGER NOT NULL, count INTEGER NOT NULL, PRIMARY KEY (key, message_id))')
+
+    def all(self):
+        with self._lock:
+            rows = self._conn.execute('SELECT message FROM messages ORDER BY id').fetchall()
+        return [json.loads(row[0]) for row in rows]
+
+    def insert(self, messages):
+        with self._lock, self._conn:
+            self._conn.executemany('INSERT INTO messages (message) VALUES (?)', [(json.dumps(m, ensure_ascii=False),) for m in messages])
+
+    def truncate(self):
+        with self._lock, self._conn:
+            self._conn.execute('DELETE FROM tokens')
+            self._conn.execute('DELETE FROM messages')
+            self._counted.clear()
+
+    def _count(self, key, count_fn):
+        # messages are only appended, counted ones always are the ids up to the last counted
+        if key not in self._counted:
+            self._counted[key] = self._conn.execute('SELECT COALESCE(MAX(message_id), 0) FROM tokens WHERE key = ?', (key,)).fetchone()[0]
+
+        rows = self._conn.execute('SELECT id, message FROM messages WHERE id > ? ORDER BY id', (self._counted[key],)).fetchall()
+        if len(rows) > 0:
+            with self._conn:
+                self._conn.executemany('INSERT OR REPLACE INTO tokens VALUES (?, ?, ?)', [(key, i, count_fn(json.loads(m))) for i, m in rows])
+            self._counted[key] = rows[-1][0]
+
+    def tail(self, budget, key, count_fn):
+        """
+        Most recent messages whose tokens count stays under budget, oldest first.
+        Returns the messages, their tokens count and whether older messages were left out.
+        """
+        with self._lock:
+            self._count(key, count_fn)
+            cursor = self._conn.execute('SELECT m.message, t.count FROM messages m JOIN tokens t ON t.message_id = m.id AND t.key = ? ORDER BY m.id DESC', (key,))
+
+            messages, num_tokens, dropped = [], 0, False
+            for message, count in cursor:
+                if num_tokens + count >= budget:
+                    dropped = True
+                    break
+                messages.append(message)
+                num_tokens += count
+            cursor.close()
+
+        return [json.loads(m) for m in reversed(messages)], num_tokens, dropped
+
+
+def migrate_tinydb(json_path, store):
+    """
+    Appends the messages of a former TinyDB history file to a store, in insertion order.
+    """
+    with open(json_path) as f:
+        content = f.read().strip()
+
+    tables = json.loads(content) if len(content) > 0 else {}
+    documents = tables.get('_default', {})
+    messages = [documents[doc_id] for doc_id in sorted(documents, key=int)]
+    store.insert(messages)
+    return len(messages)
 
 
 class PromptManager:
@@ -14,6 +93,7 @@ class PromptManager:
     def __init__(self, bot_name, initial_preprompt_name, clear=False):
         self._bot_name = bot_name
         self._db = {}
+        self._db_lock = Lock()
         self._preprompt = {}
 
         self._clear = clear
@@ -22,16 +102,24 @@ class PromptManager:
         self._db_dir = ProjectPaths().cache_dir / 'prompts_db'
         self._db_dir.mkdir(exist_ok=True)
 
-        self._fetch_db(initial_preprompt_name)
+        self._get_db(initial_preprompt_name)
         self._fetch_preprompt(initial_preprompt_name)
 
     def _fetch_db(self, preprompt):
-        db_path = self._db_dir / f'{preprompt}.json'
-        if self._clear and db_path.exists():
+        db_path = self._db_dir / f'{preprompt}.sqlite'
+        legacy_path = self._db_dir / f'{preprompt}.json'
+        if self._clear and (db_path.exists() or legacy_path.exists()):
             ProjectLogger().info('Cleared persistent memory.')
-            db_path.unlink()
+            for path in [db_path, legacy_path, db_path.with_name(f'{db_path.name}-wal'), db_path.with_name(f'{db_path.name}-shm')]:
+                path.unlink(missing_ok=True)
 
-        self._db[preprompt] = TinyDB(db_path)
+        migrate = not db_path.exists() and legacy_path.exists()
+        store = HistoryStore(db_path)
+        if migrate:
+            count = migrate_tinydb(legacy_path, store)
+            legacy_path.rename(legacy_path.with_suffix('.json.migrated'))
+            ProjectLogger().info(f'Migrated {count} messages of {legacy_path.name}.')
+        return store
 
     def _fetch_preprompt(self, preprompt_name):
         content = load_file(ProjectPaths().resources_dir / 'prompts' / preprompt_name)
@@ -62,11 +150,20 @@ class PromptManager:
             message[0]['text'] = message[0]['text'].replace('{name}', self._bot_name).replace('{date}', datetime.today().strftime('%Y-%m-%d %H:%M:%S'))
         return message
 
+    def conversation(self, preprompt_name=None):
+        return self._current_preprompt_name if preprompt_name is None else preprompt_name
+
     def _get_db(self, preprompt_name):
-        preprompt_name = self._current_preprompt_name if preprompt_name is None else preprompt_name
-        if preprompt_name not in self._db:
-            self._fetch_db(preprompt_name)
-        return self._db[preprompt_name]
+        preprompt_name = self.conversation(preprompt_name)
+        store = self._db.get(preprompt_name)
+        if store is None:
+            # stores are opened, and migrated, once, they are only published when ready
+            with self._db_lock:
+                store = self._db.get(preprompt_name)
+                if store is None:
+                    store = self._fetch_db(preprompt_name)
+                    self._db[preprompt_name] = store
+        return store
 
     def _get_preprompt(self, preprompt_name):
         preprompt_name = self._current_preprompt_name if preprompt_name is None else preprompt_name
@@ -132,11 +229,20 @@ class PromptManager:
     def all(self, preprompt_name=None):
         return self._get_db(preprompt_name).all()
 
+    def tail(self, budget, key, count_fn, preprompt_name=None):
+        """
+        Most recent history fitting in budget tokens. Each message is counted once per key (tokenizer and model specs).
+        """
+        return self._get_db(preprompt_name).tail(budget, key, count_fn)
+
     def preprompt(self, preprompt_name=None):
         return self._get_preprompt(preprompt_name)
 
     def insert(self, new_message, preprompt_name=None):
-        self._get_db(preprompt_name).insert(new_message)
+        self._get_db(preprompt_name).insert([new_message])
+
+    def insert_many(self, new_messages, preprompt_name=None):
+        self._get_db(preprompt_name).insert(new_messages)
 
     def truncate(self, preprompt_name=None):
         self._get_db(preprompt_name).truncate()
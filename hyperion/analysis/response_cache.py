@@ -0,0 +1,106 @@
+from time import time
+from threading import Lock
+from unidecode import unidecode
+from collections import OrderedDict
+
+import re
+import numpy as np
+
+
+class ResponseCache:
+    """
+    Complete answers of recent requests, shared by every user, keyed on (preprompt, model, normalized request).
+    Requests differing only by case, accents or punctuation share their answer. When similarity is set, a request
+    embedding at least that close (cosine) to a cached one of the same preprompt and model is also a hit.
+    Entries expire after ttl seconds, least recently used ones are evicted first. A ttl of 0 disables the cache.
+    """
+
+    def __init__(self, ttl=0, max_entries=1024, similarity=0., excluded_prompts=()):
+        assert 0. <= similarity <= 1.
+        self._ttl = ttl
+        self._max_entries = max_entries
+        self.similarity = similarity
+        self._excluded_prompts = set(excluded_prompts)
+
+        self._lock = Lock()
+        self._entries = OrderedDict()
+        self._hits = 0
+        self._similar_hits = 0
+        self._misses = 0
+
+    @staticmethod
+    def normalize(text):
+        text = unidecode(text).lower()
+        return ' '.join(re.sub(r'[^\w\s]', ' ', text).split())
+
+    def enabled(self, preprompt):
+        return self._ttl > 0 and preprompt not in self._excluded_prompts
+
+    def _similar(self, preprompt, model, embedding, now):
+        best_key, best_similarity = None, self.similarity
+        for key, (timestamp, _, cached_embedding) in self._entries.items():
+            if key[:2] != (preprompt, model) or cached_embedding is None or now - timestamp > self._ttl:
+                continue
+            similarity = float(np.dot(embedding, cached_embedding))
+            if similarity >= best_similarity:
+                best_key, best_similarity = key, similarity
+        return best_key
+
+    def get(self, preprompt, model, text):
+        """
+        Answer of the same normalized request, None on a miss.
+        With similarity matching, a miss is only counted by get_similar which must then be tried.
+        """
+        key = (preprompt, model, ResponseCache.normalize(text))
+        now = time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and now - entry[0] > self._ttl:
+                del self._entries[key]
+                entry = None
+
+            if entry is None:
+                self._misses += 1 if self.similarity == 0 else 0
+                return None
+
+            self._hits += 1
+            self._entries.move_to_end(key)
+            return entry[1]
+
+    def get_similar(self, preprompt, model, embedding):
+        """
+        Answer of the closest request of the same preprompt and model, None on a miss or without embedding.
+        """
+        with self._lock:
+            key = None
+            if embedding is not None:
+                key = self._similar(preprompt, model, embedding / np.linalg.norm(embedding), time())
+
+            if key is None:
+                self._misses += 1
+                return None
+
+            self._hits += 1
+            self._similar_hits += 1
+            self._entries.move_to_end(key)
+            return self._entries[key][1]
+
+    def put(self, preprompt, model, text, answer, embedding=None):
+        key = (preprompt, model, ResponseCache.normalize(text))
+        embedding = None if embedding is None else embedding / np.linalg.norm(embedding)
+        with self._lock:
+            self._entries[key] = (time(), answer, embedding)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self._max_entries:
+                self._entries.popitem(last=False)
+
+    def stats(self):
+        with self._lock:
+            requests = self._hits + self._misses
+            return dict(
+                entries=len(self._entries),
+                hits=self._hits,
+                similar_hits=self._similar_hits,
+                misses=self._misses,
+                hit_rate=self._hits / requests if requests > 0 else 0.
+            )
@@ -0,0 +1,175 @@
+DELIMITERS = '.!?;:…'
+# characters closing a sentence after its punctuation, kept with it
+CLOSERS = '"\')]»”’'
+# french typography puts a (narrow) no-break space before closing guillemets
+FRENCH_SPACES = ' \u00a0\u202f'
+SOFT_DELIMITERS = ',—'
+CODE_FENCE = '```'
+# lower cased words ending with a dot which do not end a sentence
+ABBREVIATIONS = frozenset([
+    'm', 'mm', 'mme', 'mmes', 'mlle', 'mlles', 'dr', 'pr', 'me', 'st', 'ste', 'mgr',
+    'cf', 'ex', 'p', 'pp', 'env', 'av', 'apr', 'bd', 'vol', 'chap', 'fig', 'no', 'n°', 'tél',
+    'mr', 'mrs', 'ms', 'vs', 'e.g', 'i.e'
+])
+
+
+class SentenceSegmenter:
+    """
+    Splits a streamed answer in sentences as soon as they are complete, only newly received characters are scanned.
+    A sentence ends at a delimiter followed by a space or a line break, closing quotes or brackets being kept with it.
+    Dots of abbreviations, initials and list numbers do not end sentences, neither do delimiters inside code.
+    Sentences shorter than min_length are merged with the next one, the first one may be emitted as short as
+    first_min_length to start the speech synthesis early. Sentences longer than max_length (first_max_length for
+    the first one) are split at their last comma or space.
+    """
+
+    def __init__(self, min_length=12, max_length=250, first_min_length=0, first_max_length=80,
+                 abbreviations=ABBREVIATIONS, split_lines=True):
+        assert 0 <= min_length < max_length and 0 <= first_min_length < first_max_length
+        self._min_length = min_length
+        self._max_length = max_length
+        self._first_min_length = first_min_length
+        self._first_max_length = first_max_length
+        self._abbreviations = abbreviations
+        self._split_lines = split_lines
+
+        self._buffer = ''
+        self._cursor = 0
+        self._in_code_block = False
+        self._in_inline_code = False
+        self._emitted = 0
+
+    def _limits(self):
+        if self._emitted == 0:
+            return self._first_min_length, self._first_max_length
+        return self._min_length, self._max_length
+
+    def _previous_word(self, index):
+        start = index
+        while start > 0 and index - start < 16 and not self._buffer[start - 1].isspace():
+            start -= 1
+        return self._buffer[start:index], start
+
+    def _ends_sentence(self, index):
+        """
+        Whether the delimiter at index ends its sentence, a dot may end an abbreviation, an initial or a list number.
+        """
+        if self._buffer[index] != '.':
+            return True
+
+        word, start = self._previous_word(index)
+        if word.lower().lstrip('(«"\'') in self._abbreviations:
+            return False
+        # initials, J. R. R. Tolkien
+        if len(word) == 1 and word.isupper():
+            return False
+        # numbered list item, 1. at the beginning of a line
+        if word.isdigit() and (start == 0 or self._buffer[start - 1] == '\n'):
+            return False
+        return True
+
+    def _cut(self, end):
+        sentence, self._buffer = self._buffer[:end], self._buffer[end:]
+        self._emitted += 1
+        return sentence
+
+    def _soft_cut(self, max_length):
+        # long sentence without delimiter, cut at its last comma, or space, among already scanned characters
+        window = self._buffer[:min(max_length, self._cursor)]
+        end = max(window.rfind(f'{d} ') for d in SOFT_DELIMITERS) + 1
+        if end <= 0:
+            end = window.rfind(' ')
+        if end <= 0 or len(window[:end].strip()) == 0:
+            return None
+
+        self._cursor -= end
+        return self._cut(end)
+
+    def feed(self, text):
+        """
+        Appends streamed text, returns the sentences completed by it.
+        """
+        self._buffer += text
+        sentences = []
+
+        i = self._cursor
+        while i < len(self._buffer):
+            char = self._buffer[i]
+            end = None
+
+            if char == '`':
+                if len(self._buffer) - i < len(CODE_FENCE) and CODE_FENCE.startswith(self._buffer[i:]):
+                    # may be a code fence, wait for the next characters
+                    break
+
+                if self._buffer.startswith(CODE_FENCE, i):
+                    self._in_code_block = not self._in_code_block
+                    i += len(CODE_FENCE)
+                    if not self._in_code_block:
+                        # a code block is read as a whole
+                        end = i
+                elif not self._in_code_block:
+                    self._in_inline_code = not self._in_inline_code
+                    i += 1
+                else:
+                    i += 1
+            elif self._in_code_block or self._in_inline_code:
+                i += 1
+            elif char in DELIMITERS:
+                k = i + 1
+                while k < len(self._buffer) and self._buffer[k] in DELIMITERS:
+                    k += 1
+                j = k
+                while j < len(self._buffer):
+                    if self._buffer[j] in CLOSERS:
+                        j += 1
+                    elif self._buffer[j] in FRENCH_SPACES and j + 1 < len(self._buffer) and self._buffer[j + 1] == '»':
+                        j += 2
+                    else:
+                        break
+                if j == len(self._buffer) or (self._buffer[j] in FRENCH_SPACES and j + 1 == len(self._buffer)):
+                    # the following characters tell if the sentence ends here
+                    break
+
+                # a single dot may end an abbreviation, an ellipsis always ends a sentence
+                if self._buffer[j].isspace() and (k - i > 1 or self._ends_sentence(i)):
+                    end = j
+                i = j
+            elif char == '\n' and self._split_lines:
+                i += 1
+                end = i
+            else:
+                i += 1
+
+            if end is not None:
+                min_length, _ = self._limits()
+                length = len(self._buffer[:end].strip())
+                # shorter sentences are merged with the next one
+                if length > 0 and length >= min_length:
+                    sentences.append(self._cut(end))
+                    i = 0
+
+        self._cursor = i
+        while not self._in_code_block:
+            _, max_length = self._limits()
+            if len(self._buffer) <= max_length:
+                break
+
+            sentence = self._soft_cut(max_length)
+            if sentence is None:
+                break
+            sentences.append(sentence)
+
+        return sentences
+
+    def flush(self):
+        """
+        Returns the pending end of the answer, empty if there is none.
+        """
+        sentence = self._buffer if len(self._buffer.strip()) > 0 else ''
+        self._buffer = ''
+        self._cursor = 0
+        self._in_code_block = False
+        self._in_inline_code = False
+        self._emitted = 0
+        return sentence
@@ -3,7 +3,7 @@ from time import time
 from hyperion.utils.timer import Timer
 from hyperion.utils.paths import ProjectPaths
 from hyperion.utils.logger import ProjectLogger
-from hyperion.utils.request import RequestObject
+from hyperion.utils.request import RequestObject, Cancellations
 from multiprocessing.managers import BaseManager
 from hyperion.utils.memory_utils import MANAGER_TOKEN
 from hyperion.utils.threading import Consumer, Producer
@@ -169,15 +169,26 @@ class UserCommandDetector(Consumer, Producer):
         parser.add_argument('sentence', type=str)
 
         self._decompose_args(request_obj, parser, 'DRAW')
-        self.img_intake.put(request_obj)
+        try:
+            # drawings enter the image generation stage like new requests, its overflow policy applies
+            self.img_intake.admit(request_obj)
+        except queue.Full:
+            ProjectLogger().warning(f'Request {request_obj.identifier} rejected. Image generation overloaded.')
+            self._put(RequestObject(request_obj.identifier, request_obj.user, termination=True), request_obj.identifier)
 
     def _on_quiet(self, request_obj, termination_request):
         termination_request.priority = 0
+        Cancellations().cancel(request_obj.identifier, request_obj.socket_id)
         self._put(termination_request, request_obj.identifier)
         self.sio().emit('interrupt', Timer().now(), to=request_obj.socket_id)
 
-    def _on_sleep(self, request_obj, termination_request):
+    def freeze(self):
         self.frozen = True
+        # open streams must notice they are frozen
+        self.wake_up_identified_sinks()
+
+    def _on_sleep(self, request_obj, termination_request):
+        self.freeze()
 
         ack = RequestObject.copy(request_obj)
         ack.text_answer = '<SLEEPING>'
@@ -0,0 +1,60 @@
+import io
+import numpy as np
+import soundfile as sf
+
+PCM = 'pcm'
+# codec name: (container, subtype) as understood by libsndfile
+_FORMATS = {
+    'opus': ('OGG', 'OPUS'),
+    'flac': ('FLAC', 'PCM_16')
+}
+
+
+def _supported_codecs():
+    codecs = [codec for codec, (container, subtype) in _FORMATS.items() if subtype in sf.available_subtypes(container)]
+    return codecs + [PCM]
+
+
+# ordered by preference, opus requires libsndfile >= 1.0.29
+AUDIO_CODECS = _supported_codecs()
+
+
+def negotiate_codec(accepted_codecs):
+    """
+    Picks the first codec of a comma separated list, ordered by preference, also supported here.
+    Returns None when audio must be sent as raw PCM.
+    """
+    if accepted_codecs is None:
+        return None
+
+    for codec in accepted_codecs.split(','):
+        codec = codec.strip().lower()
+        if codec in AUDIO_CODECS:
+            return None if codec == PCM else codec
+    return None
+
+
+def encode_audio(pcm, sample_rate, codec):
+    assert np.issubdtype(pcm.dtype, np.int16), f'Cannot encode {pcm.dtype} audio'
+    if codec is None or codec == PCM:
+        return pcm.tobytes()
+
+    container, subtype = _FORMATS[codec]
+    buffer = io.BytesIO()
+    sf.write(buffer, pcm, sample_rate, format=container, subtype=subtype)
+    return buffer.getvalue()
+
+
+def decode_audio(data, codec):
+    """
+    Decodes an audio payload to Int16 samples. Payloads of unknown codec are rejected.
+    """
+    if codec is None or codec == PCM:
+        return np.frombuffer(data, dtype=np.int16)
+
+    assert codec in _FORMATS, f'Unknown audio codec {codec}'
+    if len(data) == 0:
+        return np.zeros((0,), dtype=np.int16)
+
+    pcm, _ = sf.read(io.BytesIO(data), dtype='int16')
+    return pcm
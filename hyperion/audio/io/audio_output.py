@@ -1,6 +1,6 @@
 from time import time, sleep
-from librosa import resample
 from hyperion.audio import int16_to_float32
+from hyperion.audio.transcoding import resample
 from hyperion.utils.threading import Consumer
 from hyperion.utils.logger import ProjectLogger
 from hyperion.audio.io.sound_device_resource import SoundDeviceResource
@@ -23,11 +23,17 @@ class AudioOutput(SoundDeviceResource, Consumer):
         super().stop()
         self.close()
 
+    def close(self):
+        super().close()
+        # unblock the playing loop so it notices the closed stream
+        self._wake_up()
+
     def change(self, device_idx):
         ProjectLogger().info('Changing Output device.')
         self.close()
         self.set_device(device_idx)
         self._init_stream()
+        self._wake_up()
 
     def mute(self, timestamp):
         ProjectLogger().info('Silence required !')
@@ -39,6 +45,8 @@ class AudioOutput(SoundDeviceResource, Consumer):
             self._in_queue.queue.clear()
 
         self._stream.abort(ignore_errors=True)
+        # unblock the playing loop so it notices the aborted stream
+        self._wake_up()
 
     def run(self) -> None:
         while self.running:
@@ -1,6 +1,6 @@
 from queue import Queue
-from librosa import resample
 from functools import partial
+from hyperion.audio.transcoding import resample
 from hyperion.utils.logger import ProjectLogger
 from hyperion.audio.io.source import AudioSource
 from hyperion.audio.aec.nonlinear_adaptive_filters import *
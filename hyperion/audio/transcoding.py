@@ -0,0 +1,59 @@
+from math import gcd
+from functools import lru_cache
+from scipy.signal import firwin, resample_poly
+
+import io
+import pydub
+import numpy as np
+
+
+class PolyphaseResampler:
+    """
+    Rational ratio resampler. Its anti-aliasing filter is designed once, then reused for every signal.
+    """
+
+    def __init__(self, orig_sr, target_sr):
+        divisor = gcd(orig_sr, target_sr)
+        self.up = target_sr // divisor
+        self.down = orig_sr // divisor
+
+        # same low-pass filter as scipy default design, in float32 to keep float32 signals in float32
+        max_rate = max(self.up, self.down)
+        self._taps = firwin(2 * 10 * max_rate + 1, 1. / max_rate, window=('kaiser', 5.0)).astype(np.float32)
+
+    def __call__(self, audio):
+        if self.up == self.down:
+            return audio
+
+        if np.issubdtype(audio.dtype, np.integer):
+            info = np.iinfo(audio.dtype)
+            resampled = resample_poly(audio.astype(np.float32), self.up, self.down, window=self._taps)
+            return np.clip(np.rint(resampled), info.min, info.max).astype(audio.dtype)
+        return resample_poly(audio, self.up, self.down, window=self._taps).astype(audio.dtype, copy=False)
+
+
+@lru_cache(maxsize=16)
+def get_resampler(orig_sr, target_sr):
+    return PolyphaseResampler(orig_sr, target_sr)
+
+
+def resample(audio, orig_sr, target_sr):
+    return get_resampler(int(orig_sr), int(target_sr))(audio)
+
+
+def decode(data, audio_format, sample_rate=None):
+    """
+    Decodes compressed audio (mp3, ogg...) straight to mono Int16 samples, resampled to sample_rate if given.
+    :param data: bytes-like compressed audio
+    :param audio_format: container format as understood by ffmpeg
+    :param sample_rate: output sample rate, source sample rate if None
+    :return: Int16 samples
+    """
+    segment = pydub.AudioSegment.from_file(io.BytesIO(data), format=audio_format).set_sample_width(2)
+    pcm = np.frombuffer(segment.raw_data, dtype=np.int16)
+    if segment.channels > 1:
+        pcm = pcm.reshape(-1, segment.channels).mean(axis=1).astype(np.int16)
+
+    if sample_rate is None:
+        return pcm
+    return resample(pcm, orig_sr=segment.frame_rate, target_sr=sample_rate)
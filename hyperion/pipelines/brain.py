@@ -1,10 +1,12 @@
 from PIL import Image
+from uuid import uuid4
 from pypdf import PdfReader
 from hyperion.utils.paths import ProjectPaths
+from hyperion.utils.logger import ProjectLogger
 from hyperion.audio import int16_to_float32
 from hyperion.analysis.chat_gpt import ChatGPT
 from hyperion.utils.protocol import frame_encode
-from hyperion.utils.request import RequestObject
+from hyperion.utils.request import RequestObject, Cancellations
 from hyperion.video.image_generator import ImageGenerator
 from hyperion.voice_processing.voice_detector import VoiceDetector
 from hyperion.voice_processing.voice_recognizer import VoiceRecognizer
@@ -27,14 +29,21 @@ class Brain:
         self.debug = opts.debug
         self.sio = None
 
+        # queues capacity and admission policy
+        self._queue_policy = opts.queue_policy
+        self._queue_size = opts.queue_size
+        self._queue_sizes = Brain._parse_stage_values(opts.queue_sizes)
+
         # Raw audio analysis pipeline
         self.voice_detector = VoiceDetector(ctx[-1:], 16000, activation_threshold=.9)
         self.voice_recognizer = VoiceRecognizer(ctx[-1:])
 
         # logical thinking and speech synthesis block
-        self.voice_transcriber = VoiceTranscriber(ctx[:1], opts.whisper)
+        self.voice_transcriber = VoiceTranscriber(ctx[:1], opts.whisper, batch_size=opts.whisper_batch, batch_window=opts.whisper_batch_window / 1000, length_aware=opts.whisper_length_aware)
         self.chat_gpt = ChatGPT(opts.name, opts.gpt, opts.no_memory, opts.clear, opts.prompt, llama_host=opts.llama_host, llama_port=opts.llama_port)
-        self.voice_synthesizer = VoiceSynthesizer(ctx[-1:], lambda: self.sio)
+        self.chat_gpt.set_concurrency(Brain._parse_stage_values(opts.llm_concurrency))
+        self.chat_gpt.set_response_cache(opts.chat_cache_ttl, opts.chat_cache_size, opts.chat_cache_similarity, [p.strip() for p in opts.chat_cache_exclude.split(',') if p.strip()])
+        self.voice_synthesizer = VoiceSynthesizer(ctx[-1:], lambda: self.sio, cache_size=opts.tts_cache_size, disk_cache_size=opts.tts_disk_cache_size, warm_up=not opts.no_tts_warm_up, routing=opts.tts_routing)
 
         # video/image processing
         self.visual_answering = VisualQuestionAnswering(ctx[:1])
@@ -44,20 +53,37 @@ class Brain:
         self.user_commands = UserCommandDetector(lambda: self.sio)
         self.interp_commands = InterpretedCommandDetector(lambda: self.sio)
 
+        # workers pools
+        workers = Brain._parse_stage_values(opts.workers)
+        replicated = [s.strip() for s in opts.replicate.split(',')]
+        for stage in [self.voice_detector, self.voice_recognizer, self.voice_transcriber, self.voice_synthesizer, self.images_gen]:
+            stage_name = stage.__class__.__name__
+            stage.set_workers(workers.get(stage_name, 1), replicate=stage_name in replicated)
+        self.voice_synthesizer.set_parallelism(opts.tts_parallel, Brain._parse_stage_values(opts.tts_engine_limits))
+
         # pipelines
-        self.voice_detector.pipe(self.voice_recognizer)
-        self.voice_transcriber.pipe(self.user_commands).pipe(self.chat_gpt).pipe(self.interp_commands).pipe(self.voice_synthesizer)
+        self.voice_detector.pipe(self.voice_recognizer, **self._edge_opts(self.voice_recognizer))
+        self.voice_transcriber.pipe(self.user_commands, **self._edge_opts(self.user_commands))\
+            .pipe(self.chat_gpt, **self._edge_opts(self.chat_gpt))\
+            .pipe(self.interp_commands, **self._edge_opts(self.interp_commands))\
+            .pipe(self.voice_synthesizer, **self._edge_opts(self.voice_synthesizer))
 
         # intakes
-        self.voice_det_intake = self.voice_detector.create_intake()
+        # Dropping an end of speech token would leave handle_audio waiting, detector can only block or reject
+        voice_det_opts = self._edge_opts(self.voice_detector)
+        voice_det_opts['policy'] = 'block' if voice_det_opts['policy'] == 'drop-oldest' else voice_det_opts['policy']
+        self.voice_det_intake = self.voice_detector.create_intake(**voice_det_opts)
         self.vqa_intake = self.visual_answering.create_intake(maxsize=1)
-        self.images_gen_intake = self.images_gen.create_intake()
-        self.voice_transcriber_intake = self.voice_transcriber.create_intake()
+        self.images_gen_intake = self.images_gen.create_intake(**self._edge_opts(self.images_gen))
+        self.voice_transcriber_intake = self.voice_transcriber.create_intake(**self._edge_opts(self.voice_transcriber))
         self.user_cmd_intake = self.user_commands.get_intake()
         self.synthesizer_intake = self.voice_synthesizer.get_intake()
 
+        # close the stream of requests dropped before entering the pipeline
+        for intake in [self.images_gen_intake, self.voice_transcriber_intake, self.user_cmd_intake]:
+            intake.on_drop = self._on_request_dropped
+
         # sinks
-        self.voice_recognizer_sink = self.voice_recognizer.create_sink()
         self.vqa_sink = self.visual_answering.create_sink()
 
         # delegates
@@ -80,6 +106,28 @@ class Brain:
             self.images_gen
         ]
 
+    @staticmethod
+    def _parse_stage_values(stage_values):
+        values = {}
+        for stage_value in stage_values.split(','):
+            if stage_value.strip() == '':
+                continue
+            stage, value = stage_value.split('=')
+            values[stage.strip()] = int(value)
+        return values
+
+    def _edge_opts(self, consumer):
+        maxsize = self._queue_sizes.get(consumer.__class__.__name__, self._queue_size)
+        return dict(maxsize=maxsize, policy=self._queue_policy)
+
+    def _on_request_dropped(self, request_obj):
+        ProjectLogger().warning(f'Request {request_obj.identifier} dropped. Pipeline overloaded.')
+        termination_request = RequestObject(request_obj.identifier, request_obj.user, termination=True)
+        self.voice_synthesizer._put(termination_request, request_obj.identifier)
+
+    def queues_state(self):
+        return {t.__class__.__name__: t.get_intake().gauge() for t in self.threads}
+
     def start(self, sio, flask_app):
         try:
             _ = [t.start() for t in self.threads]
@@ -113,81 +161,113 @@ class Brain:
         self.user_commands.delete_identified_sink(request_id)
         self.images_gen.delete_identified_sink(request_id)
 
-    def sink_streamer(self, sink):
-        while True:
-            if self.user_commands.frozen:
-                return
-
-            # TODO Ship into drain ?
-            try:
-                request_obj = sink.drain()
-            except queue.Empty:
-                continue
-
-            if request_obj.termination:
-                self.delete_identified_sink(request_obj.identifier)
-                return
-
-            args = [
-                request_obj.timestamp,
-                request_obj.num_answer,
-                request_obj.user,
-                request_obj.text_request,
-                request_obj.text_answer,
-                request_obj.audio_answer,
-                request_obj.image_answer
-            ]
-            yield frame_encode(*args)
+    def sink_streamer(self, sink, origin_request=None):
+        try:
+            while True:
+                if self.user_commands.frozen:
+                    return
+
+                try:
+                    request_obj = sink.drain()
+                except queue.Empty:
+                    # woken up without any answer, re-check frozen state
+                    continue
+
+                if request_obj.termination:
+                    self.delete_identified_sink(request_obj.identifier)
+                    return
+
+                args = [
+                    request_obj.timestamp,
+                    request_obj.num_answer,
+                    request_obj.user,
+                    request_obj.text_request,
+                    request_obj.text_answer,
+                    request_obj.audio_answer,
+                    request_obj.image_answer,
+                    request_obj.audio_codec,
+                    request_obj.sub_index if request_obj.stream_audio else None
+                ]
+                yield frame_encode(*args)
+        except GeneratorExit:
+            # client went away, nobody will read the rest of the answer
+            if origin_request is not None:
+                origin_request.cancel_token.cancel()
+            raise
+        finally:
+            if origin_request is not None:
+                Cancellations().release(origin_request)
 
     @staticmethod
-    def _customize_request(request_obj, preprompt, llm, speech_engine, voice, silent):
+    def _customize_request(request_obj, preprompt, llm, speech_engine, voice, silent, codec=None, stream_audio=False):
         request_obj.set_preprompt(preprompt)
         request_obj.set_llm(llm)
         request_obj.set_speech_engine(speech_engine)
         request_obj.set_voice(voice)
         request_obj.set_silent(silent)
+        request_obj.set_audio_codec(codec)
+        request_obj.set_stream_audio(stream_audio)
 
-    def handle_speech(self, request_id, request_sid, speaker, speech, preprompt=None, llm=None, speech_engine=None, voice=None, silent=False, indexes=[]):
+    def handle_speech(self, request_id, request_sid, speaker, speech, preprompt=None, llm=None, speech_engine=None, voice=None, silent=False, indexes=[], codec=None, stream_audio=False):
         request_obj = RequestObject(request_id, speaker)
         request_obj.socket_id = request_sid
         request_obj.set_audio_request(speech)
         request_obj.set_indexes(indexes)
-        Brain._customize_request(request_obj, preprompt, llm, speech_engine, voice, silent)
+        Brain._customize_request(request_obj, preprompt, llm, speech_engine, voice, silent, codec, stream_audio)
 
         sink = self.create_identified_sink(request_id)
-        self.voice_transcriber_intake.put(request_obj)
+        Cancellations().register(request_obj)
+        try:
+            self.voice_transcriber_intake.admit(request_obj)
+        except queue.Full:
+            Cancellations().release(request_obj)
+            self.delete_identified_sink(request_id)
+            raise
 
-        stream = self.sink_streamer(sink)
+        stream = self.sink_streamer(sink, request_obj)
         return stream
 
-    def handle_chat(self, request_id, request_sid, user, message, preprompt=None, llm=None, speech_engine=None, voice=None, silent=False, indexes=[]):
+    def handle_chat(self, request_id, request_sid, user, message, preprompt=None, llm=None, speech_engine=None, voice=None, silent=False, indexes=[], codec=None, stream_audio=False):
         request_obj = RequestObject(request_id, user)
         request_obj.socket_id = request_sid
         request_obj.set_text_request(message)
         request_obj.set_indexes(indexes)
-        Brain._customize_request(request_obj, preprompt, llm, speech_engine, voice, silent)
+        Brain._customize_request(request_obj, preprompt, llm, speech_engine, voice, silent, codec, stream_audio)
 
         sink = self.create_identified_sink(request_id)
-        self.user_cmd_intake.put(request_obj)
+        Cancellations().register(request_obj)
+        try:
+            self.user_cmd_intake.admit(request_obj)
+        except queue.Full:
+            Cancellations().release(request_obj)
+            self.delete_identified_sink(request_id)
+            raise
 
-        stream = self.sink_streamer(sink)
+        stream = self.sink_streamer(sink, request_obj)
         return stream
 
     def handle_audio(self, audio):
         buffer = np.frombuffer(audio, dtype=np.int16)
         buffer = int16_to_float32(buffer)
 
-        self.voice_det_intake.put(buffer)
-        self.voice_det_intake.put(None)  # end of speech
+        # correlation id of this detection, concurrent requests never receive each other's speech
+        session_id = uuid4().hex
+        sink = self.voice_recognizer.create_identified_sink(session_id)
+        try:
+            self.voice_det_intake.admit((session_id, buffer))
+        except queue.Full:
+            self.voice_recognizer.delete_identified_sink(session_id)
+            raise
+        self.voice_det_intake.put((session_id, None))  # end of speech
 
-        # TODO Ship into drain ?
         speech, speaker = None, None
         while True:
             try:
-                speech, speaker = self.voice_recognizer_sink.drain()
+                speech, speaker = sink.drain()
                 break
             except queue.Empty:
                 continue
+        self.voice_recognizer.delete_identified_sink(session_id)
 
         speech = speech if speech is None else speech.numpy()
         return speaker, speech
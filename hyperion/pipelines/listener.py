@@ -3,7 +3,8 @@ from hyperion.audio import float32_to_int16
 from hyperion.gui import UIAction
 from hyperion.utils.logger import ProjectLogger
 from hyperion.gui.chat_window import ChatWindow
-from hyperion.utils.protocol import frame_decode
+from hyperion.utils.protocol import FrameDecoder
+from hyperion.audio.codec import encode_audio, decode_audio, PCM
 from hyperion.audio.io.source.in_file import InFile
 from hyperion.audio.io.audio_input import AudioInput
 from hyperion.audio.io.audio_output import AudioOutput
@@ -17,7 +18,6 @@ import os
 import queue
 import threading
 import requests
-import numpy as np
 
 
 class Listener:
@@ -110,7 +110,9 @@ class Listener:
 
     def _process_request(self, api_endpoint, payload, requester=None):
         t0 = time()
-        headers = {'SID': self.sid}
+        headers = {'SID': self.sid, 'codecs': self._opts.codecs, 'stream_audio': str(not self._opts.no_stream_audio)}
+        if self._opts.upload_codec != PCM:
+            headers['audio_codec'] = self._opts.upload_codec
         if self._requests_preprompt is not None:
             headers['preprompt'] = self._requests_preprompt
         if self._requests_llm is not None:
@@ -143,33 +145,28 @@ class Listener:
             elif not self._opts.no_gui:
                 self._gui.update_status('online')
 
-            buffer = bytearray()
+            decoder = FrameDecoder()
             for bytes_chunk in res.iter_content(chunk_size=4096):
-                buffer.extend(bytes_chunk)
-                output = frame_decode(buffer)
-                if output is None:
-                    continue
-
-                decoded_frame, buffer = output
-                self._distribute(decoded_frame)
+                for decoded_frame in decoder.feed(bytes_chunk):
+                    self._distribute(decoded_frame)
 
             ProjectLogger().info(f'Request processed in {time() - t0:.3f} sec(s).')
         except Exception as e:
             ProjectLogger().warning(f'Request canceled : {e}')
 
     def _process_audio_request(self, audio):
-        audio = float32_to_int16(audio)
+        audio = encode_audio(float32_to_int16(audio), self._in_sample_rate, self._opts.upload_codec)
         payload = [
-            ('audio', ('audio', audio.tobytes(), 'application/octet-stream'))
+            ('audio', ('audio', audio, 'application/octet-stream'))
         ]
         self._process_request('audio', payload)
 
     def _process_speech_request(self, recognized_speaker, speech):
-        speech = float32_to_int16(speech)
+        speech = encode_audio(float32_to_int16(speech), self._in_sample_rate, self._opts.upload_codec)
         ProjectLogger().info(f'Processing {recognized_speaker}\'s request...')
         payload = [
             ('speaker', ('speaker', recognized_speaker, 'text/plain')),
-            ('speech', ('speech', speech.tobytes(), 'application/octet-stream'))
+            ('speech', ('speech', speech, 'application/octet-stream'))
         ]
         self._process_request('speech', payload, requester=recognized_speaker)
 
@@ -188,12 +185,15 @@ class Listener:
         answer = decoded_frame['ANS']
         audio = decoded_frame['PCM']
 
-        if not self._opts.no_gui:
-            self._gui.queue_message(timestamp, idx, speaker, request, answer)
+        # following sub-frames of a streamed answer only carry audio
+        if decoded_frame.get('SUB', 0) == 0:
+            if not self._opts.no_gui:
+                self._gui.queue_message(timestamp, idx, speaker, request, answer)
+
+            ProjectLogger().info(f'{speaker} : {request}')
+            ProjectLogger().info(f'ChatGPT : {answer}')
 
-        ProjectLogger().info(f'{speaker} : {request}')
-        ProjectLogger().info(f'ChatGPT : {answer}')
-        spoken_chunk = np.frombuffer(audio, dtype=np.int16)
+        spoken_chunk = decode_audio(audio, decoded_frame.get('COD'))
         if len(spoken_chunk) > 0:
             self.intake.put((timestamp, spoken_chunk))
             # self.source.set_feedback(spoken_chunk, self._out_sample_rate)
@@ -2,71 +2,124 @@ import struct
 import numpy as np
 
 
-def frame_decode(frame):
+def _parse_frame(view, offset=0):
+    """
+    Decodes the frame starting at offset of a memoryview.
+    PCM and IMG payloads are memoryviews over the given buffer, they are not copied.
+    Returns the decoded frame and its end offset, None if the frame is not complete yet.
+    """
     decoded = dict()
-    frame_copy = frame.copy()
+    if len(view) < offset + 11:
+        return None
+
+    assert bytes(view[offset:offset + 3]) == b'TIM', 'Invalid frame header'
+    decoded['TIM'] = struct.unpack_from('d', view, offset + 3)[0]
+    offset += 11
     while True:
-        chunk_header = frame_copy[:3].decode('utf-8')
-        if chunk_header == 'TIM':
-            decoded['TIM'] = struct.unpack('d', frame_copy[3:11])[0]
-            frame_copy = frame_copy[11:]
+        if len(view) < offset + 7:
+            return None
+
+        chunk_header = bytes(view[offset:offset + 3]).decode('utf-8')
+        chunk_size = int.from_bytes(view[offset + 3:offset + 7], 'big')
+        chunk_start = offset + 7
+        offset = chunk_start + chunk_size
+        if len(view) < offset:
+            return None
+
+        chunk_content = view[chunk_start:offset]
+        if chunk_header in ['PCM', 'IMG']:
+            decoded[chunk_header] = chunk_content
+        elif chunk_header == 'SUB':
+            decoded[chunk_header] = int.from_bytes(chunk_content, 'big')
+        elif chunk_header == 'ANS':
+            decoded['IDX'] = chunk_content[0]
+            decoded[chunk_header] = bytes(chunk_content[1:]).decode('utf-8')
         else:
-            chunk_size = int.from_bytes(frame_copy[3:7], 'big')
-            chunk_content = frame_copy[7:7+chunk_size]
-            if len(chunk_content) < chunk_size:
-                return None
-
-            if chunk_header == 'PCM':
-                decoded[chunk_header] = chunk_content
-            elif chunk_header == 'ANS':
-                decoded['IDX'] = chunk_content[0]
-                decoded[chunk_header] = chunk_content[1:].decode('utf-8')
-            else:
-                decoded[chunk_header] = chunk_content.decode('utf-8')
-
-            frame_copy = frame_copy[7+chunk_size:]
-            if chunk_header == 'PCM':
-                return decoded, frame_copy
-
-
-def frame_encode(timestamp, idx, speaker, request, answer, pcm, img):
-    if pcm is None:
-        pcm = np.zeros((0,))
-    if img is None:
-        img = np.zeros((0,)).tobytes()
+            decoded[chunk_header] = bytes(chunk_content).decode('utf-8')
+
+        if chunk_header == 'IMG':
+            return decoded, offset
+
+
+class FrameDecoder:
+    """
+    Incremental decoder of an answers stream.
+    Received bytes are appended to a buffer read with an offset cursor, completed frames are returned without copying their payloads.
+    """
+
+    def __init__(self):
+        self._buffer = bytearray()
+        self._cursor = 0
+
+    def feed(self, data):
+        if self._cursor > 0:
+            # payloads of returned frames still reference the current buffer, only pending bytes are moved to a new one
+            self._buffer = self._buffer[self._cursor:]
+            self._cursor = 0
+        self._buffer.extend(data)
+
+        frames = []
+        view = memoryview(self._buffer)
+        while True:
+            output = _parse_frame(view, self._cursor)
+            if output is None:
+                break
+
+            decoded, self._cursor = output
+            frames.append(decoded)
+        return frames
+
+
+def frame_decode(frame):
+    output = _parse_frame(memoryview(frame))
+    if output is None:
+        return None
+
+    decoded, end = output
+    return decoded, frame[end:]
+
+
+def frame_segments(timestamp, idx, speaker, request, answer, pcm, img, codec=None, sub_index=None):
+    """
+    Frame as a list of small headers and payloads memoryviews, suitable for writev-like outputs.
+    When codec is given, pcm is the already compressed audio and a COD chunk announces it.
+    Streamed answers are split in sub-frames sharing the same idx, numbered by a SUB chunk.
+    Frames without codec keep the raw PCM layout understood by every client.
+    """
+    if codec is None:
+        pcm = np.zeros((0,), dtype=np.int16) if pcm is None else np.ascontiguousarray(pcm, dtype=np.int16)
+    else:
+        pcm = b'' if pcm is None else pcm
+    img = b'' if img is None else img
 
     # beware of accents, they are using 2 bytes. Byte string might be longer than str
     answer = int.to_bytes(idx, 1, 'big') + bytes(answer, 'utf-8')
     request = bytes(request, 'utf-8')
     speaker = bytes(speaker, 'utf-8')
 
-    spk_len = len(speaker)
-    req_len = len(request)
-    ans_len = len(answer)
-    pcm_len = len(pcm) * 2  # because each value is coded on 2 bytes (16 bits)
-    img_len = len(img) if img is not None else 0
-
-    frame = bytes('TIM', 'utf-8')
-    frame += struct.pack('d', timestamp)  # we need space magic to convert float to bytes
-
-    frame += bytes('SPK', 'utf-8')
-    frame += spk_len.to_bytes(4, 'big')
-    frame += speaker
-
-    frame += bytes('REQ', 'utf-8')
-    frame += req_len.to_bytes(4, 'big')
-    frame += request
+    pcm_view = memoryview(pcm).cast('B')  # each value is coded on 2 bytes (16 bits)
+    img_view = memoryview(img).cast('B')
 
-    frame += bytes('ANS', 'utf-8')
-    frame += ans_len.to_bytes(4, 'big')
-    frame += answer
+    segments = [
+        b'TIM' + struct.pack('d', timestamp),  # we need space magic to convert float to bytes
+        b'SPK' + len(speaker).to_bytes(4, 'big') + speaker,
+        b'REQ' + len(request).to_bytes(4, 'big') + request,
+        b'ANS' + len(answer).to_bytes(4, 'big') + answer
+    ]
+    if sub_index is not None:
+        segments.append(b'SUB' + (2).to_bytes(4, 'big') + sub_index.to_bytes(2, 'big'))
+    if codec is not None:
+        codec = bytes(codec, 'utf-8')
+        segments.append(b'COD' + len(codec).to_bytes(4, 'big') + codec)
 
-    frame += bytes('PCM', 'utf-8')
-    frame += pcm_len.to_bytes(4, 'big')
-    frame += pcm.tobytes()
+    return segments + [
+        b'PCM' + len(pcm_view).to_bytes(4, 'big'),
+        pcm_view,
+        b'IMG' + len(img_view).to_bytes(4, 'big'),
+        img_view
+    ]
 
-    frame += bytes('IMG', 'utf-8')
-    frame += img_len.to_bytes(4, 'big')
-    frame += img
 
-    return frame
+def frame_encode(timestamp, idx, speaker, request, answer, pcm, img, codec=None, sub_index=None):
+    # single allocation, payloads are copied once
+    return b''.join(frame_segments(timestamp, idx, speaker, request, answer, pcm, img, codec, sub_index))
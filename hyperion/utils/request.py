@@ -1,4 +1,6 @@
 from copy import deepcopy
+from threading import Lock
+from weakref import WeakSet
 from hyperion.utils.timer import Timer
 from hyperion.audio import int16_to_float32
 from hyperion.utils.singleton import Singleton
@@ -32,6 +34,86 @@ class KeepAliveSet(metaclass=Singleton):
             return term_req
 
 
+class RequestCancelled(Exception):
+    pass
+
+
+class CancellationToken:
+    """
+    Cancellation state of a request, shared by every copy of its RequestObject across stages.
+    """
+
+    def __init__(self):
+        self._lock = Lock()
+        self._callbacks = []
+        self.cancelled = False
+
+    def __deepcopy__(self, memo):
+        # copies of a request are answers of the same request
+        return self
+
+    def cancel(self):
+        with self._lock:
+            if self.cancelled:
+                return
+            self.cancelled = True
+            callbacks, self._callbacks = self._callbacks, []
+        _ = [callback() for callback in callbacks]
+
+    def on_cancel(self, callback):
+        """
+        Calls callback once the request is cancelled, right away if it already is.
+        """
+        with self._lock:
+            if not self.cancelled:
+                self._callbacks.append(callback)
+                return
+        callback()
+
+    def remove_callback(self, callback):
+        with self._lock:
+            if callback in self._callbacks:
+                self._callbacks.remove(callback)
+
+    def raise_if_cancelled(self):
+        if self.cancelled:
+            raise RequestCancelled()
+
+
+class Cancellations(metaclass=Singleton):
+    """
+    Tokens of in-flight requests by request identifier and client socket.
+    Socket.io requests reuse the socket id as identifier, every new request gets its own token.
+    """
+
+    def __init__(self):
+        self._lock = Lock()
+        self._by_identifier = dict()
+        self._by_socket = dict()
+
+    def register(self, request_obj):
+        with self._lock:
+            self._by_identifier.setdefault(request_obj.identifier, WeakSet()).add(request_obj.cancel_token)
+            if request_obj.socket_id is not None:
+                self._by_socket.setdefault(request_obj.socket_id, WeakSet()).add(request_obj.cancel_token)
+
+    def release(self, request_obj):
+        with self._lock:
+            for registry, key in [(self._by_identifier, request_obj.identifier), (self._by_socket, request_obj.socket_id)]:
+                if key in registry:
+                    registry[key].discard(request_obj.cancel_token)
+                    if len(registry[key]) == 0:
+                        del registry[key]
+
+    def cancel(self, identifier=None, socket_id=None):
+        with self._lock:
+            tokens = set(self._by_identifier.pop(identifier, []))
+            tokens.update(self._by_socket.pop(socket_id, []))
+
+        _ = [token.cancel() for token in tokens]
+        return len(tokens)
+
+
 class RequestObject:
 
     def __init__(self, identifier, user, termination=False, priority=1, push=False):
@@ -57,9 +139,13 @@ class RequestObject:
         self.num_answer = 0
         self.text_answer = None
         self.audio_answer = None
+        self.audio_codec = None
+        self.stream_audio = False
+        self.sub_index = 0
         self.image_answer = None
         self.command_args = dict()
         self.indexes = []
+        self.cancel_token = CancellationToken()
 
     @staticmethod
     def copy(request):
@@ -81,6 +167,12 @@ class RequestObject:
     def set_silent(self, is_silent):
         self.silent = True if is_silent else False
 
+    def set_audio_codec(self, codec):
+        self.audio_codec = codec
+
+    def set_stream_audio(self, stream_audio):
+        self.stream_audio = True if stream_audio else False
+
     def set_voice(self, voice):
         self.voice = voice
 
@@ -95,8 +187,12 @@ class RequestObject:
         if model != '':
             self.llm = model
 
+    def _order(self):
+        # answers of the same priority come out in sentence order, then in sub-frames order, their termination last
+        return self.priority, self.termination, self.num_answer, self.sub_index
+
     def __eq__(self, other):
-        return self.priority == other.priority
+        return self._order() == other._order()
 
     def __gt__(self, other):
-        return self.priority > other.priority
+        return self._order() > other._order()
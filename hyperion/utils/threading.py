@@ -1,5 +1,104 @@
-from threading import Thread
-from queue import Queue, PriorityQueue
+from collections import deque
+from queue import Queue, PriorityQueue, Empty, Full
+from threading import Thread, Lock, local, current_thread
+
+
+class Wakeup:
+    """
+    Sentinel pushed into a queue to unblock a reader waiting on it.
+    Readers receiving it behave as if the queue was empty (queue.Empty is raised),
+    so they can re-check their state (running flag, frozen state...) without polling.
+    It always comes first in a PriorityQueue.
+    """
+    priority = -1
+
+    def __lt__(self, other):
+        return True
+
+    def __gt__(self, other):
+        return False
+
+
+def wake_up(queue):
+    try:
+        queue.put_nowait(Wakeup())
+    except Full:
+        # A full queue already has something to wake its reader up
+        pass
+
+
+QUEUE_POLICIES = ['block', 'drop-oldest', 'reject']
+
+
+class BoundedQueue(Queue):
+    """
+    FIFO queue feeding a pipeline stage.
+    Stages always block on each other (backpressure), the overflow policy is only applied
+    on admission of new jobs coming from outside the pipeline (see admit).
+    """
+    def __init__(self, maxsize=0, policy='block', name=None):
+        assert policy in QUEUE_POLICIES, f'Unknown queue policy {policy}'
+        super().__init__(maxsize)
+        self.name = name
+        self.policy = policy
+        self.on_drop = None
+
+        self.peak = 0
+        self.dropped = 0
+        self.rejected = 0
+
+    def _put(self, item):
+        super()._put(item)
+        self.peak = max(self.peak, self._qsize())
+
+    def _drop_oldest(self):
+        # termination requests are never dropped, otherwise streams would wait forever, nor are wake up sentinels
+        for i, job in enumerate(self.queue):
+            if not isinstance(job, Wakeup) and not getattr(job, 'termination', False):
+                del self.queue[i]
+                self.unfinished_tasks -= 1
+                self.dropped += 1
+                return job
+        return None
+
+    def admit(self, job):
+        """
+        Put a job according to the queue policy.
+        Raises queue.Full if the job is rejected.
+        """
+        if self.policy == 'reject':
+            try:
+                self.put_nowait(job)
+            except Full:
+                self.rejected += 1
+                raise
+        elif self.policy == 'drop-oldest':
+            dropped = None
+            with self.not_full:
+                if 0 < self.maxsize <= self._qsize():
+                    dropped = self._drop_oldest()
+                if dropped is not None:
+                    self._put(job)
+                    self.unfinished_tasks += 1
+                    self.not_empty.notify()
+
+            if dropped is None:
+                self.put(job)
+            elif self.on_drop is not None:
+                self.on_drop(dropped)
+        else:
+            self.put(job)
+
+    def gauge(self):
+        return dict(size=self.qsize(), capacity=self.maxsize, peak=self.peak, policy=self.policy, dropped=self.dropped, rejected=self.rejected)
+
+
+def blocking_get(queue, timeout=None):
+    job = queue.get(timeout=timeout)
+    queue.task_done()
+    if isinstance(job, Wakeup):
+        raise Empty
+    return job
 
 
 class ThreadedTask(Thread):
@@ -20,12 +119,12 @@ class ThreadedTask(Thread):
 class Sink:
     def __init__(self, queue):
         self._sink = queue
-        self._timeout = 0.1
 
-    def drain(self):
-        job = self._sink.get(timeout=self._timeout)
-        self._sink.task_done()
-        return job
+    def drain(self, timeout=None):
+        return blocking_get(self._sink, timeout)
+
+    def wake_up(self):
+        wake_up(self._sink)
 
 
 class Consumer(ThreadedTask):
@@ -33,7 +132,10 @@ class Consumer(ThreadedTask):
     def __init__(self):
         super().__init__()
         self._in_queue = None
-        self._timeout = 0.1
+
+    def stop(self):
+        super().stop()
+        self._wake_up()
 
     def set_in_queue(self, queue):
         assert self._in_queue is None
@@ -42,15 +144,97 @@ class Consumer(ThreadedTask):
     def get_intake(self):
         return self._in_queue
 
-    def create_intake(self, maxsize=0):
-        queue = Queue(maxsize)
+    def create_intake(self, maxsize=0, policy='block'):
+        queue = BoundedQueue(maxsize, policy, name=self.__class__.__name__)
         self.set_in_queue(queue)
         return queue
 
-    def _consume(self):
-        job = self._in_queue.get(timeout=self._timeout)
-        self._in_queue.task_done()
-        return job
+    def _consume(self, timeout=None):
+        return blocking_get(self._in_queue, timeout)
+
+    def _wake_up(self):
+        if self._in_queue is not None:
+            wake_up(self._in_queue)
+
+
+class ConsumerPool(Consumer):
+    """
+    Consumer running num_workers threads off the same intake.
+    Jobs sharing the same affinity key (request identifier by default) are processed
+    one after another in arrival order, different keys are processed in parallel.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.num_workers = 1
+        self.replicate = False
+        self._workers = []
+        self._local = local()
+        self._affinity_lock = Lock()
+        self._affinity_backlogs = {}
+
+    def set_workers(self, num_workers, replicate=False):
+        assert num_workers > 0
+        self.num_workers = num_workers
+        self.replicate = replicate
+
+    def start(self):
+        super().start()
+        for i in range(1, self.num_workers):
+            worker = Thread(target=self.run, name=f'{self.__class__.__name__}-{i}', daemon=self.daemon)
+            worker.start()
+            self._workers.append(worker)
+
+    def join(self, timeout=None):
+        super().join(timeout)
+        _ = [w.join(timeout) for w in self._workers]
+
+    def _wake_up(self):
+        if self._in_queue is not None:
+            _ = [wake_up(self._in_queue) for _ in range(self.num_workers)]
+
+    def _replica(self, name, factory):
+        """
+        Returns the shared attribute name, or the calling worker's own copy built with factory
+        when models are replicated. Copies are built lazily on first use.
+        """
+        if not self.replicate or current_thread() is self:
+            return getattr(self, name)
+
+        if not hasattr(self._local, name):
+            setattr(self._local, name, factory())
+        return getattr(self._local, name)
+
+    @staticmethod
+    def _affinity_key(job):
+        return getattr(job, 'identifier', None)
+
+    def _consume(self, timeout=None):
+        # calling _consume again means the previous job is done
+        owned_key = getattr(self._local, 'owned_key', None)
+        if owned_key is not None:
+            with self._affinity_lock:
+                backlog = self._affinity_backlogs[owned_key]
+                if len(backlog) > 0:
+                    return backlog.popleft()
+                del self._affinity_backlogs[owned_key]
+                self._local.owned_key = None
+
+        while True:
+            job = blocking_get(self._in_queue, timeout)
+            key = self._affinity_key(job)
+            if key is None:
+                return job
+
+            with self._affinity_lock:
+                if key in self._affinity_backlogs:
+                    # another worker is processing this request, it will pick this job up
+                    self._affinity_backlogs[key].append(job)
+                    continue
+
+                self._affinity_backlogs[key] = deque()
+                self._local.owned_key = key
+                return job
 
 
 class Producer(ThreadedTask):
@@ -60,8 +244,17 @@ class Producer(ThreadedTask):
         self._out_queues = []
         self._identified_out_queues = {}
 
-    def pipe(self, consumer: Consumer):
-        queue = Queue()
+    def stop(self):
+        super().stop()
+        # Let downstream readers re-check their state
+        _ = [wake_up(q) for q in self._out_queues]
+        self.wake_up_identified_sinks()
+
+    def wake_up_identified_sinks(self):
+        _ = [wake_up(q) for q in list(self._identified_out_queues.values())]
+
+    def pipe(self, consumer: Consumer, maxsize=0, policy='block'):
+        queue = BoundedQueue(maxsize, policy, name=consumer.__class__.__name__)
         self._out_queues.append(queue)
         consumer.set_in_queue(queue)
         return consumer
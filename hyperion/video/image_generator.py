@@ -1,8 +1,8 @@
 from time import time
 from PIL import Image
 from hyperion.utils.logger import ProjectLogger
-from hyperion.utils.threading import Producer, Consumer
-from hyperion.utils.request import RequestObject, KeepAliveSet
+from hyperion.utils.threading import Producer, ConsumerPool
+from hyperion.utils.request import RequestObject, KeepAliveSet, RequestCancelled
 from diffusers import StableDiffusionPipeline, DPMSolverMultistepScheduler
 
 import io
@@ -10,17 +10,24 @@ import queue
 import torch
 
 
-class ImageGenerator(Consumer, Producer):
+class ImageGenerator(ConsumerPool, Producer):
     def __init__(self, ctx, model_name='stabilityai/stable-diffusion-2-1-base'):
         super().__init__()
         self._ctx = ctx
+        self._model_name = model_name
 
         self.synthesizer_intake = None
+        self._pipe = self._load_model()
 
+    def _load_model(self):
         # Use the DPMSolverMultistepScheduler (DPM-Solver++) scheduler here instead
-        self._pipe = StableDiffusionPipeline.from_pretrained(model_name, torch_dtype=torch.float16)
-        self._pipe.scheduler = DPMSolverMultistepScheduler.from_config(self._pipe.scheduler.config)
-        self._pipe = self._pipe.to(ctx[0])
+        pipe = StableDiffusionPipeline.from_pretrained(self._model_name, torch_dtype=torch.float16)
+        pipe.scheduler = DPMSolverMultistepScheduler.from_config(pipe.scheduler.config)
+        return pipe.to(self._ctx[0])
+
+    def set_workers(self, num_workers, replicate=False):
+        # Scheduler keeps denoising state, the pipeline cannot be shared between workers
+        super().set_workers(num_workers, replicate=True)
 
     def set_synthesizer_intake(self, synthesizer_intake_delegate):
         self.synthesizer_intake = synthesizer_intake_delegate
@@ -48,6 +55,13 @@ class ImageGenerator(Consumer, Producer):
 
         self._forward(new_request_obj, is_terminal)
 
+    @staticmethod
+    def _interrupter(request_obj):
+        # called after each denoising step, raising is the only way to stop the pipeline
+        def callback(step, timestep, latents):
+            request_obj.cancel_token.raise_if_cancelled()
+        return callback
+
     def _forward(self, request, terminal_node):
         if terminal_node:
             self._put(request, request.identifier)
@@ -80,7 +94,9 @@ class ImageGenerator(Consumer, Producer):
                 args = {k: v for k, v in cmd_args.items() if k not in exkeys and v is not None}
 
                 try:
-                    images = self._pipe(images_prompts, **args).images
+                    request_obj.cancel_token.raise_if_cancelled()
+                    pipe = self._replica('_pipe', self._load_model)
+                    images = pipe(images_prompts, callback=ImageGenerator._interrupter(request_obj), callback_steps=1, **args).images
                     if mosaic and batch > 1:
                         grid = ImageGenerator.image_grid(images, rows, cols)
                         self.flush_img(grid, request_obj, is_terminal)
@@ -90,6 +106,8 @@ class ImageGenerator(Consumer, Producer):
                             self.flush_img(image, request_obj, is_terminal, text)
                             request_obj.num_answer += 1
 
+                except RequestCancelled:
+                    ProjectLogger().info(f'Image generation of {request_obj.identifier} canceled.')
                 except RuntimeError as e:
                     ProjectLogger().error(e)
 
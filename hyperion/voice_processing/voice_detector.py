@@ -2,20 +2,66 @@ from time import time
 from speechbrain.pretrained import VAD
 from hyperion.utils.paths import ProjectPaths
 from hyperion.utils.logger import ProjectLogger
-from hyperion.utils.threading import Consumer, Producer
+from hyperion.utils.threading import ConsumerPool, Producer
 
 import torch
 import queue
+import numpy as np
 
 
-class VoiceDetector(Consumer, Producer):
+class SpeechBuffer:
+    """
+    Preallocated audio buffer reused from one utterance to the next.
+    Capacity doubles when full, appending a chunk only copies that chunk.
+    """
 
-    def __init__(self, ctx, sampling_rate, activation_threshold=.8):
+    def __init__(self, capacity):
+        self._data = np.zeros((capacity,), dtype=np.float32)
+        self._size = 0
+
+    def __len__(self):
+        return self._size
+
+    def append(self, chunk):
+        end = self._size + len(chunk)
+        if end > len(self._data):
+            data = np.zeros((max(end, 2 * len(self._data)),), dtype=np.float32)
+            data[:self._size] = self._data[:self._size]
+            self._data = data
+
+        self._data[self._size:end] = chunk
+        self._size = end
+
+    def view(self, start=0, end=None):
+        end = self._size if end is None else min(end, self._size)
+        return self._data[start:end]
+
+    def clear(self):
+        self._size = 0
+
+
+class DetectionSession:
+
+    def __init__(self, capacity):
+        self.buffer = SpeechBuffer(capacity)
+        # end of the last detected speech within the buffer
+        self.speech_end = 0
+
+
+class VoiceDetector(ConsumerPool, Producer):
+    """
+    Jobs are either raw audio chunks (None as end of speech), or (session_id, chunk) tuples.
+    Each session gets its own buffer and exactly one (session_id, speech or None) answer on its end of speech.
+    """
+
+    def __init__(self, ctx, sampling_rate, activation_threshold=.8, margin=.1):
         super().__init__()
 
         self._ctx = ctx
         self._sampling_rate = sampling_rate
         self._act_thresh = activation_threshold
+        # audio kept around detected speech boundaries
+        self._margin = int(margin * sampling_rate)
         opts = {
             'source': 'speechbrain/vad-crdnn-libriparty',
             'savedir': ProjectPaths().cache_dir / 'vad',
@@ -24,40 +70,74 @@ class VoiceDetector(Consumer, Producer):
         }
         self._vad = VAD.from_hparams(**opts)
 
-        self._buffer = None
+        # raw audio chunks use the None session
+        self._sessions = {None: DetectionSession(10 * sampling_rate)}
+
+    @staticmethod
+    def _affinity_key(job):
+        # chunks of a same session are processed in order, raw chunks all belong to the same stream
+        return job[0] if type(job) == tuple else VoiceDetector.__name__
+
+    def _get_session(self, session_id):
+        if session_id not in self._sessions:
+            self._sessions[session_id] = DetectionSession(10 * self._sampling_rate)
+        return self._sessions[session_id]
 
-    def _detect(self, chunk):
-        chunk = torch.tensor(chunk)#.to(self._ctx[0])
-        prob = self._vad.get_speech_prob_chunk(chunk)
+    def _boundaries(self, prob_th):
+        boundaries = self._vad.get_boundaries(prob_th, output_value='seconds')
+        start = int(boundaries[0, 0].item() * self._sampling_rate)
+        end = int(boundaries[-1, 1].item() * self._sampling_rate)
+        return start, end
+
+    def _detect(self, chunk, session_id=None):
+        chunk = np.asarray(chunk, dtype=np.float32)
+        prob = self._vad.get_speech_prob_chunk(torch.from_numpy(chunk))
         prob_th = self._vad.apply_threshold(prob, activation_th=self._act_thresh)
 
         if prob_th.sum() > 0:
-            boundaries = self._vad.get_boundaries(prob_th, output_value='frame')[0]
-            start_index, end_index = [e.item() for e in boundaries]
-            voice_chunk = chunk
-            self._buffer = voice_chunk if self._buffer is None else torch.cat([self._buffer, voice_chunk])
+            session = self._get_session(session_id)
+            start_index, end_index = self._boundaries(prob_th)
+            if len(session.buffer) == 0:
+                # leading noise of the utterance is dropped
+                trimmed = max(0, start_index - self._margin)
+                chunk = chunk[trimmed:]
+                end_index -= trimmed
+
+            offset = len(session.buffer)
+            session.buffer.append(chunk)
+            session.speech_end = offset + end_index + self._margin
             return True
 
         ProjectLogger().info(f'Noise rejected. {prob.mean().item() * 100:.2f}%')
         return False
 
-    def _flush(self):
-        if self._buffer is not None:
+    def _flush(self, session_id=None):
+        session = self._sessions[session_id] if session_id is None else self._sessions.pop(session_id, None)
+
+        sentence = None
+        if session is not None and len(session.buffer) > 0:
             ProjectLogger().info('Speech detected.')
-            sentence = self._buffer
-            self._buffer = None
+            # trailing noise is dropped, copied once since the buffer is reused
+            sentence = torch.from_numpy(session.buffer.view(0, session.speech_end).copy())
+            session.buffer.clear()
+            session.speech_end = 0
+
+        if session_id is not None:
+            self._dispatch((session_id, sentence))
+        elif sentence is not None:
             self._dispatch(sentence)
 
     def run(self):
         while self.running:
             try:
                 task = self._consume()
+                session_id, task = task if type(task) == tuple else (None, task)
                 t0 = time()
                 if task is None:  # silence token received
-                    self._flush()
-                elif self._detect(task):
+                    self._flush(session_id)
+                elif self._detect(task, session_id):
                     ProjectLogger().debug(f'{self.__class__.__name__} {time() - t0:.3f} DETECT exec. time')
-                else:
+                elif session_id is None:
                     self._dispatch(None)  # To avoid locks
 
             except queue.Empty:
@@ -1,18 +1,126 @@
 from time import time
-from glob import glob
+from uuid import uuid4
+from threading import Lock
 from hyperion.utils.paths import ProjectPaths
 from hyperion.utils.logger import ProjectLogger
-from hyperion.utils.threading import Consumer, Producer
+from hyperion.utils.threading import ConsumerPool, Producer
 from speechbrain.pretrained import SpeakerRecognition
 
 import os
 import torch
 import queue
+import shutil
 import librosa
 import numpy as np
 
 
-class VoiceRecognizer(Consumer, Producer):
+class SpeakerIndex:
+    """
+    Normalized embeddings of every reference WAV, persisted on disk.
+    Each entry is keyed by its file path and signature (size, mtime), only new or modified files are embedded again.
+    """
+
+    def __init__(self, sample_dir, index_path, embed_fn, load_fn):
+        self._sample_dir = sample_dir
+        self._index_path = index_path
+        self._embed_fn = embed_fn
+        self._load_fn = load_fn
+
+        # file -> (speaker, signature, embedding)
+        self._entries = {}
+        self._lock = Lock()
+        # (speakers, speaker_ids, embeddings) swapped at once, readers never see a partially updated index
+        self._snapshot = ([], None, None)
+
+    @property
+    def speakers(self):
+        return self._snapshot[0]
+
+    @property
+    def embeddings(self):
+        return self._snapshot[2]
+
+    @staticmethod
+    def _signature(wav_file):
+        stat = wav_file.stat()
+        return stat.st_size, stat.st_mtime_ns
+
+    def _list_files(self):
+        files = {}
+        for speaker in sorted(self._sample_dir.glob('*')):
+            if not speaker.is_dir():
+                continue
+            for wav_file in sorted(speaker.glob('*.wav')):
+                files[str(wav_file.relative_to(self._sample_dir))] = (speaker.stem, SpeakerIndex._signature(wav_file))
+        return files
+
+    def load(self):
+        cached = torch.load(self._index_path) if self._index_path.exists() else {}
+
+        entries = {}
+        for file, (speaker, signature) in self._list_files().items():
+            if file in cached and cached[file][:2] == (speaker, signature):
+                entries[file] = cached[file]
+            else:
+                ProjectLogger().info(f'Embedding speaker sample {file}')
+                entries[file] = (speaker, signature, self._embed_fn(self._load_fn(self._sample_dir / file)))
+
+        with self._lock:
+            self._entries = entries
+            self._rebuild()
+            if entries.keys() != cached.keys() or any([entries[f] is not cached[f] for f in entries]):
+                self.save()
+
+    def add(self, speaker, wav_files, replace=False):
+        # embeddings are computed outside the lock, recognition keeps using the previous snapshot meanwhile
+        new_entries = {}
+        for wav_file in wav_files:
+            file = str(wav_file.relative_to(self._sample_dir))
+            new_entries[file] = (speaker, SpeakerIndex._signature(wav_file), self._embed_fn(self._load_fn(wav_file)))
+
+        with self._lock:
+            if replace:
+                self._entries = {file: entry for file, entry in self._entries.items() if entry[0] != speaker}
+            self._entries.update(new_entries)
+            self._rebuild()
+            self.save()
+
+    def remove(self, speaker):
+        with self._lock:
+            self._entries = {file: entry for file, entry in self._entries.items() if entry[0] != speaker}
+            self._rebuild()
+            self.save()
+
+    def save(self):
+        self._index_path.parent.mkdir(parents=True, exist_ok=True)
+        torch.save(self._entries, self._index_path)
+
+    def _rebuild(self):
+        entries = list(self._entries.values())
+        speakers = sorted(set([speaker for speaker, _, _ in entries]))
+        if len(entries) == 0:
+            self._snapshot = ([], None, None)
+            return
+
+        speaker_ids = torch.tensor([speakers.index(speaker) for speaker, _, _ in entries])
+        embeddings = torch.stack([embedding for _, _, embedding in entries])
+        self._snapshot = (speakers, speaker_ids, embeddings)
+
+    def scores(self, embedding):
+        """
+        Best cosine similarity of each speaker against a normalized embedding
+        """
+        speakers, speaker_ids, embeddings = self._snapshot
+        if embeddings is None:
+            return {}
+
+        similarities = embeddings @ embedding
+        best = torch.full((len(speakers),), -1., dtype=similarities.dtype)
+        best = best.scatter_reduce(0, speaker_ids, similarities, reduce='amax')
+        return {speaker: round(score, 4) for speaker, score in zip(speakers, best.tolist())}
+
+
+class VoiceRecognizer(ConsumerPool, Producer):
 
     def __init__(self, ctx, recog_threshold=0.25):
         super().__init__()
@@ -21,44 +129,20 @@ class VoiceRecognizer(Consumer, Producer):
         self._ctx = ctx
         self._recog_threshold = recog_threshold
 
-        sample_dir = ProjectPaths().resources_dir / 'speakers_samples'
-        self.speakers_references = self.load_references(sample_dir)
+        self._recog = self._load_model()
 
-        self.speakers_batch = None
-        if len(self.speakers_references) > 0:
-            smallest_speaker = min([speaker_batch.shape[1] for speaker_batch in list(self.speakers_references.values())])
-            speakers_batch = [speaker_batch[:, :smallest_speaker] for speaker_batch in list(self.speakers_references.values())]
-            self.speakers_batch = np.concatenate(speakers_batch, axis=0)
-
-        self.speakers_batch_indexes = {}
-        prev_pos = 0
-        for i, (speaker, batch) in enumerate(self.speakers_references.items()):
-            if i > 0:
-                prev_pos += len(list(self.speakers_references.values())[i - 1])
-            self.speakers_batch_indexes[speaker] = (prev_pos, prev_pos + len(batch) - 1)
+        self._sample_dir = ProjectPaths().resources_dir / 'speakers_samples'
+        index_path = ProjectPaths().cache_dir / 'recog' / 'speakers_index.pt'
+        self.speakers_index = SpeakerIndex(self._sample_dir, index_path, self.embed_sample, self.load_wavfile)
+        self.speakers_index.load()
 
+    def _load_model(self):
         opts = {
             'source': 'speechbrain/spkrec-ecapa-voxceleb',
             'savedir': ProjectPaths().cache_dir / 'recog',
-            'run_opts': {'device': str(ctx[0])}
+            'run_opts': {'device': str(self._ctx[0])}
         }
-        self._recog = SpeakerRecognition.from_hparams(**opts)
-
-    def load_references(self, sample_dir):
-        speakers_references = {}
-        for speaker in sample_dir.glob('*'):
-            if not speaker.is_dir():
-                continue
-
-            wav_files = list(speaker.glob('*.wav'))
-            if len(wav_files) == 0:
-                continue
-
-            pcm = [self.load_wavfile(w) for w in wav_files]
-            smallest_pcm = min([len(p) for p in pcm])
-            pcm = [p[:smallest_pcm] for p in pcm]
-            speakers_references[speaker.stem] = np.stack(pcm, axis=0)
-        return speakers_references
+        return SpeakerRecognition.from_hparams(**opts)
 
     def load_wavfile(self, file_path):
         # TODO Librosa fires a warning. ResourceWarning: unclosed file
@@ -66,25 +150,78 @@ class VoiceRecognizer(Consumer, Producer):
         trimmed_wav, _ = librosa.effects.trim(wav)
         return trimmed_wav
 
-    def recognize(self, audio_chunk):
-        if self.speakers_batch is None:
-            return 'Unknown'
-
+    @staticmethod
+    def _embed(recog, audio_chunk):
         if type(audio_chunk) == np.ndarray:
             audio_chunk = torch.tensor(audio_chunk)
 
-        audio_chunk = audio_chunk.unsqueeze(0).repeat(len(self.speakers_batch), 1)
-        scores, _ = self._recog.verify_batch(torch.tensor(self.speakers_batch), audio_chunk)
+        embedding = recog.encode_batch(audio_chunk.unsqueeze(0)).squeeze()
+        return torch.nn.functional.normalize(embedding, dim=-1).cpu()
+
+    def embed(self, audio_chunk):
+        return VoiceRecognizer._embed(self._replica('_recog', self._load_model), audio_chunk)
+
+    def embed_sample(self, audio_chunk):
+        # enrollment runs on request threads, which must not load their own replica
+        return VoiceRecognizer._embed(self._recog, audio_chunk)
+
+    def _speaker_dir(self, speaker):
+        speaker_dir = self._sample_dir / speaker
+        assert speaker_dir.resolve().parent == self._sample_dir.resolve(), f'Invalid speaker name {speaker}'
+        return speaker_dir
 
-        speakers_scores = {}
-        for k, (start, end) in self.speakers_batch_indexes.items():
-            speaker_scores = scores[start:end + 1, :]
-            speaker_score = round(speaker_scores.max().item(), 4)
-            speakers_scores[k] = speaker_score
+    def list_speakers(self):
+        return self.speakers_index.speakers
 
-        best_speaker_idx = np.argmax(list(speakers_scores.values()))
-        best_score = list(speakers_scores.values())[best_speaker_idx]
-        best_speaker = list(speakers_scores.keys())[best_speaker_idx]
+    def enroll(self, speaker, samples_dict, replace=False):
+        """
+        Saves uploaded WAV samples and adds their embeddings to the index.
+        Called from request threads, recognition is never paused.
+        :param speaker: speaker name
+        :param samples_dict: uploaded files (with a save method)
+        :param replace: drops previous samples of the speaker
+        :return: number of samples enrolled
+        """
+        speaker_dir = self._speaker_dir(speaker)
+        previous_files = list(speaker_dir.glob('*.wav')) if replace else []
+        os.makedirs(speaker_dir, exist_ok=True)
+
+        wav_files = []
+        for sample_name, uploaded_file in samples_dict.items():
+            wav_file = speaker_dir / f'{uuid4()}.wav'
+            try:
+                uploaded_file.save(wav_file)
+                _ = self.load_wavfile(wav_file)
+                wav_files.append(wav_file)
+            except Exception:
+                ProjectLogger().warning(f'Invalid speaker sample {sample_name}')
+                wav_file.unlink(missing_ok=True)
+
+        if len(wav_files) > 0:
+            # previous samples are recognized until the new ones are indexed
+            self.speakers_index.add(speaker, wav_files, replace=replace)
+            _ = [f.unlink(missing_ok=True) for f in previous_files]
+        elif not any(speaker_dir.iterdir()):
+            speaker_dir.rmdir()
+        return len(wav_files)
+
+    def remove_speaker(self, speaker):
+        speaker_dir = self._speaker_dir(speaker)
+        if not speaker_dir.is_dir():
+            return False
+
+        shutil.rmtree(speaker_dir)
+        self.speakers_index.remove(speaker)
+        return True
+
+    def recognize(self, audio_chunk):
+        if self.speakers_index.embeddings is None:
+            return 'Unknown'
+
+        speakers_scores = self.speakers_index.scores(self.embed(audio_chunk))
+
+        best_speaker = max(speakers_scores, key=speakers_scores.get)
+        best_score = speakers_scores[best_speaker]
 
         ProjectLogger().info(f'Speakers scores : {speakers_scores}')
         if best_score < self._recog_threshold:
@@ -92,18 +229,26 @@ class VoiceRecognizer(Consumer, Producer):
 
         return best_speaker[0].upper() + best_speaker[1:]
 
+    def _answer(self, session_id, result):
+        # detection sessions are answered on their own identified sink
+        if session_id is None:
+            self._dispatch(result)
+        else:
+            self._put(result, session_id)
+
     def run(self):
         while self.running:
             try:
-                audio_chunk = self._consume()
+                job = self._consume()
+                session_id, audio_chunk = job if type(job) == tuple else (None, job)
                 if audio_chunk is None:
-                    self._dispatch((None, None))
+                    self._answer(session_id, (None, None))
                     continue
 
                 t0 = time()
                 recognized_speaker = self.recognize(audio_chunk)
                 ProjectLogger().info(f'{recognized_speaker}\'s speaking...')
-                self._dispatch((audio_chunk, recognized_speaker))
+                self._answer(session_id, (audio_chunk, recognized_speaker))
                 ProjectLogger().debug(f'{self.__class__.__name__} {time() - t0:.3f} exec. time')
             except queue.Empty:
                 continue
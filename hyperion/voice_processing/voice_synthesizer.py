@@ -1,33 +1,317 @@
 from time import time
+from copy import copy
 from gtts import gTTS
 from TTS.api import TTS
+from contextlib import nullcontext, closing
 from hyperion.utils import load_file
-from hyperion.audio import float32_to_int16
+from collections import OrderedDict
+from hyperion.audio import float32_to_int16, transcoding
+from hyperion.audio.codec import encode_audio
 from hyperion.utils.paths import ProjectPaths
+from threading import Lock, RLock, Event, BoundedSemaphore, current_thread, get_ident
 from hyperion.utils.logger import ProjectLogger
+from concurrent.futures import ThreadPoolExecutor
 from hyperion.utils.protocol import frame_encode
+from hyperion.utils.request import RequestCancelled
 from hyperion.voice_processing import download_model
 from hyperion.utils.identity_store import IdentityStore
-from hyperion.utils.threading import Consumer, Producer
-from elevenlabs import set_api_key, voices, generate, RateLimitError
+from hyperion.utils.threading import ConsumerPool, Producer
+from elevenlabs import set_api_key, voices, generate
 
 import os
-import io
+import torch
 import queue
-import pydub
+import hashlib
 import numpy as np
 import noisereduce as nr
 import google.cloud.texttospeech as tts
 
 VALID_ENGINES = ['local', 'eleven', 'google_cloud', 'google_translate']
-
-
-class VoiceSynthesizer(Consumer, Producer):
-
-    def __init__(self, ctx, sio_delegate):
+# concurrent syntheses allowed per cloud engine, local synthesis is bounded by the number of workers
+ENGINE_LIMITS = {'eleven': 2, 'google_cloud': 4, 'google_translate': 2}
+
+
+ROUTING_POLICIES = ['preferred', 'fastest']
+
+
+class EngineHealth:
+    """
+    Latency and error rate of a speech engine (exponentially weighted moving averages) guarded by a circuit breaker.
+    After max_failures consecutive failures the engine is skipped for cooldown seconds,
+    then a single half-open probe decides whether it is used again.
+    """
+
+    def __init__(self, alpha=.2, max_failures=3, cooldown=30.):
+        self._alpha = alpha
+        self._max_failures = max_failures
+        self._cooldown = cooldown
+        self._lock = Lock()
+
+        # seconds of synthesis per character, sentences length vary a lot
+        self.latency = None
+        self.error_rate = 0.
+        self.successes = 0
+        self.failures = 0
+        self.consecutive_failures = 0
+        self.state = 'closed'
+        self._opened_at = 0.
+        self._probing = False
+
+    def available(self, now):
+        with self._lock:
+            if self.state == 'closed':
+                return True
+            if self.state == 'open':
+                return now - self._opened_at >= self._cooldown
+            return not self._probing
+
+    def begin(self, now):
+        with self._lock:
+            if self.state == 'open' and now - self._opened_at >= self._cooldown:
+                self.state = 'half-open'
+            if self.state == 'half-open':
+                self._probing = True
+
+    def record_success(self, duration, text_length):
+        with self._lock:
+            latency = duration / max(1, text_length)
+            self.latency = latency if self.latency is None else (1 - self._alpha) * self.latency + self._alpha * latency
+            self.error_rate = (1 - self._alpha) * self.error_rate
+            self.successes += 1
+            self.consecutive_failures = 0
+            self.state = 'closed'
+            self._probing = False
+
+    def record_failure(self, now):
+        with self._lock:
+            self.error_rate = (1 - self._alpha) * self.error_rate + self._alpha
+            self.failures += 1
+            self.consecutive_failures += 1
+            if self.state == 'half-open' or self.consecutive_failures >= self._max_failures:
+                self.state = 'open'
+                self._opened_at = now
+            self._probing = False
+
+    def stats(self):
+        with self._lock:
+            return dict(
+                state=self.state,
+                latency_per_char=self.latency,
+                error_rate=self.error_rate,
+                successes=self.successes,
+                failures=self.failures
+            )
+
+
+class SpeechCache:
+    """
+    Synthesized speech keyed on (engine, voice, normalized text, sample rate).
+    Recently used sentences are kept in memory, all of them are persisted on disk until disk_size is reached.
+    Least recently used entries are evicted first from both tiers.
+    """
+
+    def __init__(self, cache_dir, memory_size, disk_size):
+        self._cache_dir = cache_dir
+        self._memory_size = memory_size
+        self._disk_size = disk_size
+        self._lock = Lock()
+
+        self._memory = OrderedDict()
+        self._memory_bytes = 0
+        self._disk = OrderedDict()
+        self._disk_bytes = 0
+
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+        os.makedirs(self._cache_dir, exist_ok=True)
+        for path in sorted(self._cache_dir.glob('*.npy'), key=lambda p: p.stat().st_mtime):
+            self._disk[path.stem] = path.stat().st_size
+            self._disk_bytes += path.stat().st_size
+
+    @staticmethod
+    def key(engine, voice, text, sample_rate):
+        normalized_text = ' '.join(text.split())
+        return hashlib.sha1(f'{engine}|{voice}|{normalized_text}|{sample_rate}'.encode('utf-8')).hexdigest()
+
+    def get(self, key):
+        # only the index is updated under the lock, files are read and written outside of it
+        with self._lock:
+            if key in self._memory:
+                self._memory.move_to_end(key)
+                self.memory_hits += 1
+                return self._memory[key]
+
+            if key not in self._disk:
+                self.misses += 1
+                return None
+
+        path = self._cache_dir / f'{key}.npy'
+        try:
+            wav = np.load(path)
+            os.utime(path)
+        except (OSError, ValueError):
+            with self._lock:
+                evicted = self._forget(key) if key in self._disk else None
+                self.misses += 1
+            if evicted is not None:
+                evicted.unlink(missing_ok=True)
+            return None
+
+        with self._lock:
+            if key in self._disk:
+                self._disk.move_to_end(key)
+            self.disk_hits += 1
+            return self._remember(key, wav)
+
+    def put(self, key, wav):
+        with self._lock:
+            if key in self._disk:
+                return self._remember(key, wav)
+
+        # written aside then renamed, readers never load a partially written file
+        path = self._cache_dir / f'{key}.npy'
+        tmp_path = self._cache_dir / f'{key}.{get_ident()}.tmp'
+        with open(tmp_path, 'wb') as f:
+            np.save(f, wav)
+        size = tmp_path.stat().st_size
+        os.replace(tmp_path, path)
+
+        evicted = []
+        with self._lock:
+            if key not in self._disk:
+                self._disk[key] = size
+                self._disk_bytes += size
+                while self._disk_bytes > self._disk_size and len(self._disk) > 1:
+                    evicted.append(self._forget(next(iter(self._disk))))
+            wav = self._remember(key, wav)
+
+        _ = [path.unlink(missing_ok=True) for path in evicted]
+        return wav
+
+    def _remember(self, key, wav):
+        # cached arrays are shared between answers
+        wav.flags.writeable = False
+        if key not in self._memory:
+            self._memory[key] = wav
+            self._memory_bytes += wav.nbytes
+        while self._memory_bytes > self._memory_size and len(self._memory) > 1:
+            _, evicted = self._memory.popitem(last=False)
+            self._memory_bytes -= evicted.nbytes
+        return wav
+
+    def _forget(self, key):
+        # the file is removed by the caller once the lock is released
+        self._disk_bytes -= self._disk.pop(key)
+        return self._cache_dir / f'{key}.npy'
+
+    def state(self):
+        with self._lock:
+            return dict(
+                memory_entries=len(self._memory),
+                memory_bytes=self._memory_bytes,
+                disk_entries=len(self._disk),
+                disk_bytes=self._disk_bytes,
+                memory_hits=self.memory_hits,
+                disk_hits=self.disk_hits,
+                misses=self.misses
+            )
+
+
+class VoiceLatents:
+    """
+    XTTS speaker conditioning latents of each local voice, computed once from its samples and persisted on disk.
+    Latents are computed again when the voice samples directory changes (files added, removed or modified).
+    """
+
+    def __init__(self, sample_dir, cache_dir, compute_fn, device):
+        self._sample_dir = sample_dir
+        self._cache_dir = cache_dir
+        self._compute_fn = compute_fn
+        self._device = device
+        self._lock = Lock()
+        # voice -> (signature, gpt_cond_latent, speaker_embedding)
+        self._latents = {}
+
+    def _signature(self, voice):
+        wav_files = sorted((self._sample_dir / voice).glob('*.wav'))
+        return tuple([(f.name, f.stat().st_size, f.stat().st_mtime_ns) for f in wav_files])
+
+    def get(self, voice):
+        signature = self._signature(voice)
+        with self._lock:
+            entry = self._latents.get(voice)
+        if entry is not None and entry[0] == signature:
+            return entry[1:]
+
+        path = self._cache_dir / f'{voice}.pt'
+        if entry is None and path.exists():
+            entry = torch.load(path, map_location=self._device)
+        if entry is None or entry[0] != signature:
+            ProjectLogger().info(f'Computing {voice} voice conditioning latents...')
+            gpt_cond_latent, speaker_embedding = self._compute_fn(sorted((self._sample_dir / voice).glob('*.wav')))
+            entry = (signature, gpt_cond_latent, speaker_embedding)
+            self._cache_dir.mkdir(parents=True, exist_ok=True)
+            torch.save(entry, path)
+
+        with self._lock:
+            self._latents[voice] = entry
+        return entry[1:]
+
+
+class AnswersReorderBuffer:
+    """
+    Releases the answers of a request in the order its sentences were received (num_answer order),
+    whatever the order their syntheses complete in.
+    Answers of the oldest pending sentence are released as soon as they are pushed, the others wait for it.
+    """
+
+    def __init__(self, release, max_pending):
+        self._release = release
+        self._slots = BoundedSemaphore(max_pending)
+        self._lock = Lock()
+        self._next_seq = 0
+        self._head = 0
+        self._pending = {}
+        self._closed = set()
+
+    def reserve(self):
+        # blocks when max_pending sentences of this request are being synthesized
+        self._slots.acquire()
+        with self._lock:
+            seq = self._next_seq
+            self._next_seq += 1
+        return seq
+
+    def push(self, seq, request_obj):
+        with self._lock:
+            if seq == self._head:
+                self._release(request_obj)
+            else:
+                self._pending.setdefault(seq, []).append(request_obj)
+
+    def close(self, seq):
+        with self._lock:
+            self._closed.add(seq)
+            while self._head in self._closed:
+                self._closed.remove(self._head)
+                self._head += 1
+                _ = [self._release(answer) for answer in self._pending.pop(self._head, [])]
+        self._slots.release()
+
+
+class VoiceSynthesizer(ConsumerPool, Producer):
+
+    def __init__(self, ctx, sio_delegate, cache_size=64, disk_cache_size=512, warm_up=True, routing='preferred'):
         super().__init__()
+        assert routing in ROUTING_POLICIES, f'Unknown routing policy {routing}'
         self.sio = sio_delegate
         self.sample_rate = 24000
+        self._warm_up = warm_up
+        self._warmed_up = Event()
+        self._routing = routing
+        self._engine_health = {engine: EngineHealth() for engine in VALID_ENGINES}
 
         eleven_key_path = ProjectPaths().resources_dir / 'keys' / 'elevenlabs_api.key'
         google_key_path = ProjectPaths().resources_dir / 'keys' / 'google_api.key'
@@ -50,6 +334,16 @@ class VoiceSynthesizer(Consumer, Producer):
 
         self._preferred_engines.append(VALID_ENGINES[3])
 
+        # sizes in MB
+        self._speech_cache = SpeechCache(ProjectPaths().cache_dir / 'tts', cache_size * 2 ** 20, disk_cache_size * 2 ** 20)
+
+        self._max_pending = 1
+        self._engine_limits = dict(ENGINE_LIMITS)
+        self._engine_slots = {}
+        self._executor = None
+        self._reorder_lock = Lock()
+        self._reorder_buffers = {}
+
     def get_preferred_engines(self):
         return self._preferred_engines
 
@@ -79,6 +373,12 @@ class VoiceSynthesizer(Consumer, Producer):
             return self._default_local_voice
         return False
 
+    def get_engines_stats(self):
+        return {engine: health.stats() for engine, health in self._engine_health.items()}
+
+    def cache_state(self):
+        return self._speech_cache.state()
+
     def set_engine_default_voice(self, engine, voice):
         if engine == 'google_cloud' and voice in self._valid_google_voices:
             self._default_google_voice = voice
@@ -108,9 +408,54 @@ class VoiceSynthesizer(Consumer, Producer):
         self._default_local_voice = 'josh'
         self._valid_local_voices = [e.name for e in self._sample_dir.glob('*') if e.is_dir()]
 
+        self._ctx = ctx
+        self._local_tts = self._load_local_model()
+        self._failover_lock = RLock()
+        self._voice_latents = VoiceLatents(self._sample_dir, ProjectPaths().cache_dir / 'tts' / 'latents', self._compute_latents, ctx[0])
+        if self._default_local_voice in self._valid_local_voices:
+            _ = self._voice_latents.get(self._default_local_voice)
+
+    def set_parallelism(self, max_pending, engine_limits=None):
+        """
+        Synthesizes up to max_pending sentences of the same request at once on cloud engines.
+        engine_limits overrides the concurrent syntheses allowed per engine.
+        """
+        assert max_pending > 0
+        self._max_pending = max_pending
+        if engine_limits is not None:
+            self._engine_limits.update({engine: limit for engine, limit in engine_limits.items() if engine in ENGINE_LIMITS})
+
+    def start(self):
+        self._engine_slots = {engine: BoundedSemaphore(limit) for engine, limit in self._engine_limits.items()}
+        self._executor = ThreadPoolExecutor(max_workers=sum(self._engine_limits.values()), thread_name_prefix=self.__class__.__name__, initializer=self._init_executor_thread)
+        super().start()
+
+    def _warm_up_cache(self):
+        """
+        Synthesizes default sentences with the preferred engine and its default voice, unless already cached.
+        Runs on the stage thread before any worker consumes requests, the shared local model is never used concurrently.
+        """
+        sentences_path = ProjectPaths().resources_dir / 'default_sentences'
+        sentences = [sentence for name in ['deaf', 'dead', 'memory'] for sentence in load_file(sentences_path / name) if sentence != '']
+        t0 = time()
+        for sentence in sentences:
+            if not self.running:
+                return
+            try:
+                self._infer(sentence)
+            except Exception as e:
+                ProjectLogger().warning(f'Cannot warm up speech cache : {e}')
+                return
+        ProjectLogger().info(f'Speech cache warmed up with {len(sentences)} sentences in {time() - t0:.3f} sec(s).')
+
+    def join(self, timeout=None):
+        super().join(timeout)
+        self._executor.shutdown()
+
+    def _load_local_model(self):
         model_name = 'xtts_v2.0.2'
         download_model(model_name)
-        self._local_tts = TTS(model_name).to(ctx[0])
+        return TTS(model_name).to(self._ctx[0])
 
     def _eleven_synthesizer(self, text, voice=None):
         voice_name = self._default_eleven_voice if voice is None or voice not in self._valid_eleven_voices else voice
@@ -121,13 +466,37 @@ class VoiceSynthesizer(Consumer, Producer):
             model='eleven_multilingual_v1'
         )
 
-        mp3_sound = pydub.AudioSegment.from_file(io.BytesIO(audio), format='mp3')
-        memory_buff = io.BytesIO()
-        mp3_sound.export(memory_buff, format='wav')
-        wav_sound = pydub.AudioSegment.from_wav(memory_buff)
-        wav_sound = wav_sound.set_frame_rate(self.sample_rate)
-        wav_array = np.array(wav_sound.get_array_of_samples(), dtype=np.int16)
-        return wav_array
+        return transcoding.decode(audio, 'mp3', self.sample_rate)
+
+    def _eleven_stream_synthesizer(self, text, voice=None):
+        voice_name = self._default_eleven_voice if voice is None or voice not in self._valid_eleven_voices else voice
+        audio_stream = generate(
+            text=text,
+            stream=True,
+            voice=voice_name,
+            model='eleven_multilingual_v1'
+        )
+
+        # mp3 chunks are cut anywhere, the received stream is decoded again from its start
+        # and the last decoded samples are held back until the next chunks complete them
+        mp3_data = bytearray()
+        decoded_size = 0
+        emitted = 0
+        margin = int(.1 * self.sample_rate)
+        for mp3_chunk in audio_stream:
+            mp3_data.extend(mp3_chunk)
+            if len(mp3_data) - decoded_size < 16384:
+                continue
+
+            decoded_size = len(mp3_data)
+            wav_array = transcoding.decode(mp3_data, 'mp3', self.sample_rate)
+            if len(wav_array) - margin > emitted:
+                yield wav_array[emitted:len(wav_array) - margin]
+                emitted = len(wav_array) - margin
+
+        wav_array = transcoding.decode(mp3_data, 'mp3', self.sample_rate) if len(mp3_data) > 0 else []
+        if len(wav_array) > emitted:
+            yield wav_array[emitted:]
 
     def _google_cloud_synthesizer(self, text, voice=None):
         voice_name = self._default_google_voice if voice is None or voice not in self._valid_google_voices else voice
@@ -141,83 +510,310 @@ class VoiceSynthesizer(Consumer, Producer):
 
     def _google_translate_synthesizer(self, text, **kwargs):
         tts = gTTS(text, lang='fr', slow=False)
-        data = None
+        mp3_data = bytearray()
         for raw_buffer in tts.stream():
-            buffer = np.frombuffer(raw_buffer, dtype=np.float32)
-            data = buffer if data is None else np.concatenate([data, buffer])
-
-        mp3 = pydub.AudioSegment.from_file(io.BytesIO(data), format='mp3')
-
-        memory_buff = io.BytesIO()
-        mp3.export(memory_buff, format='wav')
-        sound = pydub.AudioSegment.from_wav(memory_buff)
-        wav_array = np.array(sound.get_array_of_samples(), dtype=np.int16)
-        return wav_array
+            mp3_data.extend(raw_buffer)
+
+        return transcoding.decode(mp3_data, 'mp3', self.sample_rate)
+
+    def _init_executor_thread(self):
+        self._local.failover = True
+
+    def _local_model(self):
+        """
+        Local model of the calling worker, and the lock to hold while using it.
+        Cloud jobs failing over to local synthesis run on executor threads, they share the stage model one at a time
+        instead of loading their own.
+        """
+        if getattr(self._local, 'failover', False):
+            return self._failover_lock, self._local_tts.synthesizer.tts_model
+        return nullcontext(), self._replica('_local_tts', self._load_local_model).synthesizer.tts_model
+
+    def _compute_latents(self, wav_files):
+        lock, model = self._local_model()
+        with lock:
+            return model.get_conditioning_latents(
+                audio_path=[str(f) for f in wav_files],
+                gpt_cond_len=model.config.gpt_cond_len,
+                gpt_cond_chunk_len=model.config.gpt_cond_chunk_len,
+                max_ref_length=model.config.max_ref_len,
+                sound_norm_refs=model.config.sound_norm_refs
+            )
 
     def _local_synthesizer(self, text, voice=None):
         voice_name = self._default_local_voice if voice is None or voice not in self._valid_local_voices else voice
-        samples = list((self._sample_dir / voice_name).glob('*.wav'))
-        wav_sound = self._local_tts.tts(text=text, speaker_wav=samples, language='fr')
-        wav = np.array(wav_sound, dtype=np.float32)
+        lock, model = self._local_model()
+        with lock:
+            gpt_cond_latent, speaker_embedding = self._voice_latents.get(voice_name)
+            output = model.inference(
+                text,
+                'fr',
+                gpt_cond_latent,
+                speaker_embedding,
+                temperature=model.config.temperature,
+                length_penalty=model.config.length_penalty,
+                repetition_penalty=model.config.repetition_penalty,
+                top_k=model.config.top_k,
+                top_p=model.config.top_p
+            )
+        wav = np.array(output['wav'], dtype=np.float32)
+        # same trailing pause as TTS api between sentences
+        wav = np.concatenate([wav, np.zeros((10000,), dtype=np.float32)])
         wav = float32_to_int16(wav)
         return nr.reduce_noise(wav, self.sample_rate)
 
+    def _local_stream_synthesizer(self, text, voice=None):
+        voice_name = self._default_local_voice if voice is None or voice not in self._valid_local_voices else voice
+        lock, model = self._local_model()
+        with lock:
+            gpt_cond_latent, speaker_embedding = self._voice_latents.get(voice_name)
+            for wav_chunk in model.inference_stream(text, 'fr', gpt_cond_latent, speaker_embedding):
+                wav = wav_chunk.squeeze().cpu().numpy().astype(np.float32)
+                wav = float32_to_int16(wav)
+                yield nr.reduce_noise(wav, self.sample_rate)
+
+    def _route(self):
+        """
+        Preferred engines whose circuit is not open. Ordered by preference, or by latency in fastest mode,
+        engines without measured latency being tried first.
+        Every preferred engine is returned when none is available, better late than muted.
+        """
+        now = time()
+        engines = [e for e in self._preferred_engines if self._engine_health[e].available(now)]
+        if len(engines) == 0:
+            return list(self._preferred_engines)
+
+        if self._routing == 'fastest':
+            engines = sorted(engines, key=lambda e: self._engine_health[e].latency or 0.)
+        return engines
+
     def _infer(self, text, engine=None, voice=None):
-        if engine is None:
-            for e in self._preferred_engines:
-                try:
-                    return self._infer_with_engine(text, e, voice)
-                except RateLimitError as e:
-                    ProjectLogger().error(e)
-        else:
+        if engine is not None:
             return self._infer_with_engine(text, engine, voice)
 
+        error = None
+        for e in self._route():
+            try:
+                return self._infer_with_engine(text, e, voice)
+            except Exception as err:
+                ProjectLogger().error(f'{e} speech engine failed : {err}')
+                error = err
+        raise error if error is not None else RuntimeError('No speech engine available')
+
+    def _engine_slot(self, engine):
+        return self._engine_slots.get(engine, nullcontext())
+
+    def _cache_key(self, text, engine, voice, streamed=False):
+        # local synthesis always uses the default voice
+        valid_voices = self.get_engine_valid_voices(engine)
+        if engine == 'local' or not valid_voices or voice not in valid_voices:
+            voice = self.get_engine_default_voice(engine)
+        # streamed speech is decoded and denoised by chunks, without trailing pause, it is not the same audio
+        mode = f'{engine}-stream' if streamed else engine
+        return SpeechCache.key(mode, voice, text, self.sample_rate)
+
     def _infer_with_engine(self, text, engine, voice):
+        key = self._cache_key(text, engine, voice)
+        wav = self._speech_cache.get(key)
+        if wav is not None:
+            return wav
+
+        health = self._engine_health[engine]
+        with self._engine_slot(engine):
+            t0 = time()
+            health.begin(t0)
+            try:
+                if engine == 'eleven':
+                    wav = self._eleven_synthesizer(text, voice)
+                elif engine == 'google_cloud':
+                    wav = self._google_cloud_synthesizer(text, voice)
+                elif engine == 'local':
+                    wav = self._local_synthesizer(text)
+                else:
+                    wav = self._google_translate_synthesizer(text)
+            except Exception:
+                health.record_failure(time())
+                raise
+            health.record_success(time() - t0, len(text))
+        return self._speech_cache.put(key, wav)
+
+    def _infer_stream(self, text, engine=None, voice=None):
+        """
+        Yields the synthesized speech by chunks as soon as they are available.
+        Engines without streaming support yield the whole sentence at once.
+        """
+        if engine is not None:
+            yield from self._infer_stream_with_engine(text, engine, voice)
+            return
+
+        error = None
+        for e in self._route():
+            streamed = False
+            try:
+                for chunk in self._infer_stream_with_engine(text, e, voice):
+                    streamed = True
+                    yield chunk
+                return
+            except Exception as err:
+                # the next engine would repeat the beginning of the sentence
+                if streamed:
+                    raise
+                ProjectLogger().error(f'{e} speech engine failed : {err}')
+                error = err
+        raise error if error is not None else RuntimeError('No speech engine available')
+
+    def _infer_stream_with_engine(self, text, engine, voice):
+        if engine not in ['eleven', 'local']:
+            yield self._infer_with_engine(text, engine, voice)
+            return
+
+        key = self._cache_key(text, engine, voice, streamed=True)
+        wav = self._speech_cache.get(key)
+        if wav is not None:
+            yield wav
+            return
+
+        chunks = []
         if engine == 'eleven':
-            return self._eleven_synthesizer(text, voice)
-        elif engine == 'google_cloud':
-            return self._google_cloud_synthesizer(text, voice)
-        elif engine == 'local':
-            return self._local_synthesizer(text)
+            with self._engine_slot(engine):
+                yield from self._measured_stream(engine, text, self._eleven_stream_synthesizer(text, voice), chunks)
+        else:
+            yield from self._measured_stream(engine, text, self._local_stream_synthesizer(text), chunks)
+
+        if len(chunks) > 0:
+            self._speech_cache.put(key, np.concatenate(chunks))
+
+    def _measured_stream(self, engine, text, stream, chunks):
+        # only the time spent in the engine is measured, not the time spent by the consumer of the chunks
+        health = self._engine_health[engine]
+        t0 = time()
+        health.begin(t0)
+        duration = 0.
+        try:
+            for chunk in stream:
+                duration += time() - t0
+                chunks.append(chunk)
+                yield chunk
+                t0 = time()
+        except Exception:
+            health.record_failure(time())
+            raise
+        duration += time() - t0
+        health.record_success(duration, len(text))
+
+    def _encode_answer(self, request_obj, wav):
+        request_obj.audio_answer = wav if request_obj.audio_codec is None else encode_audio(wav, self.sample_rate, request_obj.audio_codec)
+
+    def _answer(self, request_obj):
+        if request_obj.push:
+            if request_obj.identifier in IdentityStore().inverse and request_obj.identifier is not None:
+                socket_ids = IdentityStore().inverse[request_obj.identifier]
+                args = [
+                    request_obj.timestamp,
+                    request_obj.num_answer,
+                    request_obj.user,
+                    request_obj.text_request,
+                    request_obj.text_answer,
+                    request_obj.audio_answer,
+                    request_obj.image_answer,
+                    request_obj.audio_codec,
+                    request_obj.sub_index if request_obj.stream_audio else None
+                ]
+                frame = frame_encode(*args)
+                _ = [self.sio().emit('data', frame, to=socket_id) for socket_id in socket_ids]
         else:
-            return self._google_translate_synthesizer(text)
+            self._put(request_obj, request_obj.identifier)
+
+    def _release(self, request_obj):
+        if request_obj.termination:
+            # termination is the last answer of a request
+            with self._reorder_lock:
+                self._reorder_buffers.pop(request_obj.identifier, None)
+        self._answer(request_obj)
+
+    def _reorder_buffer(self, identifier):
+        with self._reorder_lock:
+            if identifier not in self._reorder_buffers:
+                self._reorder_buffers[identifier] = AnswersReorderBuffer(self._release, self._max_pending)
+            return self._reorder_buffers[identifier]
+
+    def _stream_answer(self, request_obj, answer):
+        """
+        Answers with sub-frames sharing the same num_answer, the text is only carried by the first one.
+        """
+        sub_index = 0
+        stream = self._infer_stream(request_obj.text_answer, engine=request_obj.speech_engine, voice=request_obj.voice)
+        try:
+            # closing the stream stops the engine, remaining chunks are not synthesized
+            with closing(stream):
+                for wav in stream:
+                    request_obj.cancel_token.raise_if_cancelled()
+                    sub_request_obj = copy(request_obj)
+                    sub_request_obj.sub_index = sub_index
+                    sub_request_obj.text_answer = request_obj.text_answer if sub_index == 0 else ''
+                    self._encode_answer(sub_request_obj, wav)
+                    answer(sub_request_obj)
+                    sub_index += 1
+        except RequestCancelled:
+            return
+        except Exception as e:
+            ProjectLogger().error(f'Synthesizer muted : {e}')
+
+        if sub_index == 0:
+            answer(request_obj)
+
+    def _synthesize(self, request_obj, reorder_buffer, seq):
+        t0 = time()
+        try:
+            if request_obj.cancel_token.cancelled:
+                # queued sentences of a cancelled request are dropped
+                ProjectLogger().info(f'Speech synthesis of {request_obj.identifier} canceled.')
+            elif request_obj.stream_audio:
+                ProjectLogger().info(f'Streaming speech synthesis...')
+                self._stream_answer(request_obj, lambda answer: reorder_buffer.push(seq, answer))
+            else:
+                ProjectLogger().info(f'Synthesizing speech...')
+                try:
+                    wav = self._infer(request_obj.text_answer, engine=request_obj.speech_engine, voice=request_obj.voice)
+                    self._encode_answer(request_obj, wav)
+                except Exception as e:
+                    ProjectLogger().error(f'Synthesizer muted : {e}')
+                if not request_obj.cancel_token.cancelled:
+                    reorder_buffer.push(seq, request_obj)
+            ProjectLogger().info(f'{self.__class__.__name__} {time() - t0:.3f} exec. time')
+        finally:
+            reorder_buffer.close(seq)
+
+    def _runs_locally(self, request_obj):
+        engine = request_obj.speech_engine if request_obj.speech_engine is not None else self._preferred_engines[0]
+        return engine == 'local'
 
     def run(self) -> None:
+        if current_thread() is self:
+            if self._warm_up:
+                self._warm_up_cache()
+            self._warmed_up.set()
+        else:
+            self._warmed_up.wait()
+
         while self.running:
             try:
                 request_obj = self._consume()
-                if request_obj.termination:
-                    self._put(request_obj, request_obj.identifier)
-                    continue
-
-                t0 = time()
-                if not request_obj.silent:
-                    ProjectLogger().info(f'Synthesizing speech...')
-                    try:
-                        wav = self._infer(request_obj.text_answer, engine=request_obj.speech_engine, voice=request_obj.voice)
-                        request_obj.audio_answer = wav
-                    except Exception as e:
-                        ProjectLogger().error(f'Synthesizer muted : {e}')
+                reorder_buffer = self._reorder_buffer(request_obj.identifier)
+                seq = reorder_buffer.reserve()
+                if request_obj.cancel_token.cancelled and not request_obj.termination:
+                    reorder_buffer.close(seq)
+                elif request_obj.termination or request_obj.silent:
+                    if request_obj.silent:
+                        ProjectLogger().info(f'Silent answer requested.')
+                    reorder_buffer.push(seq, request_obj)
+                    reorder_buffer.close(seq)
+                elif self._runs_locally(request_obj):
+                    # GPU bound, already parallelized by workers
+                    self._synthesize(request_obj, reorder_buffer, seq)
                 else:
-                    ProjectLogger().info(f'Silent answer requested.')
-
-                if request_obj.push:
-                    if request_obj.identifier in IdentityStore().inverse and request_obj.identifier is not None:
-                        socket_ids = IdentityStore().inverse[request_obj.identifier]
-                        args = [
-                            request_obj.timestamp,
-                            request_obj.num_answer,
-                            request_obj.user,
-                            request_obj.text_request,
-                            request_obj.text_answer,
-                            request_obj.audio_answer,
-                            request_obj.image_answer
-                        ]
-                        _ = [self.sio().emit('data', frame_encode(*args), to=socket_id) for socket_id in socket_ids]
-                else:
-                    self._put(request_obj, request_obj.identifier)
-
-                ProjectLogger().info(f'{self.__class__.__name__} {time() - t0:.3f} exec. time')
+                    # cloud engines are network bound, sentences of the same request are synthesized concurrently
+                    _ = self._executor.submit(self._synthesize, request_obj, reorder_buffer, seq)
             except queue.Empty:
                 continue
 
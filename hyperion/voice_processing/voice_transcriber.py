@@ -1,64 +1,256 @@
 from time import time
+from threading import Lock
 from hyperion.utils.paths import ProjectPaths
 from hyperion.utils.logger import ProjectLogger
-from hyperion.utils.threading import Consumer, Producer
+from hyperion.utils.threading import ConsumerPool, Producer
 
 import queue
 import torch
 import whisper
+import dataclasses
 import numpy as np
+import torch.nn.functional as F
 
 TRANSCRIPT_MODELS = ['tiny', 'base', 'small', 'medium', 'large']
 
 
-class VoiceTranscriber(Consumer, Producer):
+class AudioContextModel:
+    """
+    Whisper model view encoding audio windows shorter than 30 seconds.
+    The encoder positional embedding is truncated to the window length.
+    """
 
-    def __init__(self, ctx, model_size, confidence_threshold=.8):
+    def __init__(self, model, n_audio_ctx):
+        self._model = model
+        # decoding skips the encoder when given features matching dims.n_audio_ctx
+        self.dims = dataclasses.replace(model.dims, n_audio_ctx=n_audio_ctx)
+
+    def __getattr__(self, name):
+        return getattr(self._model, name)
+
+    def detect_language(self, mel, tokenizer=None):
+        # decoding task calls it with the already encoded audio features
+        return whisper.decoding.detect_language(self, mel, tokenizer)
+
+    def encoder(self, mel):
+        encoder = self._model.encoder
+        x = F.gelu(encoder.conv1(mel))
+        x = F.gelu(encoder.conv2(x))
+        x = x.permute(0, 2, 1)
+
+        x = (x + encoder.positional_embedding[:x.shape[1]]).to(x.dtype)
+        for block in encoder.blocks:
+            x = block(x)
+        return encoder.ln_post(x)
+
+
+class LanguageCache:
+    """
+    Last language detected for each speaker.
+    Confidence decays on every reuse, the language is detected again once it falls under min_confidence.
+    """
+
+    def __init__(self, min_confidence, decay=.97):
+        self._min_confidence = min_confidence
+        self._decay = decay
+        self._languages = {}
+        self._lock = Lock()
+
+    def get(self, speaker):
+        with self._lock:
+            if speaker not in self._languages:
+                return None
+
+            lang, confidence = self._languages[speaker]
+            if confidence < self._min_confidence:
+                del self._languages[speaker]
+                return None
+
+            self._languages[speaker] = (lang, confidence * self._decay)
+            return lang, confidence
+
+    def update(self, speaker, lang, confidence):
+        if speaker is None:
+            return
+        with self._lock:
+            self._languages[speaker] = (lang, confidence)
+
+    def invalidate(self, speaker):
+        with self._lock:
+            self._languages.pop(speaker, None)
+
+
+class VoiceTranscriber(ConsumerPool, Producer):
+
+    def __init__(self, ctx, model_size, confidence_threshold=.8, batch_size=1, batch_window=0., length_aware=False, length_bucket=5):
         super().__init__()
 
         self._ctx = ctx
         self._confidence_threshold = confidence_threshold
         assert model_size in TRANSCRIPT_MODELS
+        assert batch_size > 0
+
+        # up to batch_size utterances received within batch_window sec(s) are transcribed together
+        self._batch_size = batch_size
+        self._batch_window = batch_window
+
+        # encode only the utterance rounded up to length_bucket sec(s) instead of a 30 sec(s) window
+        self._length_aware = length_aware
+        self._length_bucket = length_bucket
+        # same thresholds as whisper.transcribe to detect a failed decoding
+        self._logprob_threshold = -1.
+        self._compression_ratio_threshold = 2.4
+
+        self._languages = LanguageCache(confidence_threshold)
+
+        self._model_size = model_size
+        self._asr = self._load_model()
+
+    def _load_model(self):
+        return whisper.load_model(self._model_size, download_root=ProjectPaths().cache_dir / 'whisper', device=self._ctx[0])
 
-        self._asr = whisper.load_model(model_size, download_root=ProjectPaths().cache_dir / 'whisper', device=ctx[0])
+    def set_workers(self, num_workers, replicate=False):
+        # whisper.decode hooks its kv-cache on the decoder modules, the model cannot be shared between workers
+        super().set_workers(num_workers, replicate=True)
+
+    @staticmethod
+    def _affinity_key(job):
+        # Utterances are transcribed independently, they can be batched in any order
+        return None
 
     def transcribe(self, voice_chunk):
-        if type(voice_chunk) == np.ndarray:
-            voice_chunk = torch.tensor(voice_chunk)
-
-        # pad/trim it to fit 30 seconds
-        # I cannot speak without breathing more thant 12 seconds.
-        audio = whisper.pad_or_trim(voice_chunk)
-        # make log-mel spectrogram
-        mel = whisper.log_mel_spectrogram(audio).to(self._asr.device)
+        return self.transcribe_batch([voice_chunk])[0]
+
+    def _window_length(self, voice_chunks):
+        if not self._length_aware:
+            return whisper.audio.N_SAMPLES
+
+        bucket = self._length_bucket * whisper.audio.SAMPLE_RATE
+        longest = max([len(c) for c in voice_chunks])
+        return min(whisper.audio.N_SAMPLES, int(np.ceil((longest + 1) / bucket)) * bucket)
+
+    def _decode_window(self, asr, voice_chunks, speakers, window_length):
+        mels = []
+        for voice_chunk in voice_chunks:
+            if type(voice_chunk) == np.ndarray:
+                voice_chunk = torch.tensor(voice_chunk)
+
+            # pad/trim it to fit the window, 30 seconds at most
+            # I cannot speak without breathing more thant 12 seconds.
+            audio = whisper.pad_or_trim(voice_chunk, length=window_length)
+            # make log-mel spectrogram
+            mels.append(whisper.log_mel_spectrogram(audio))
+        mel = torch.stack(mels).to(asr.device)
+
+        if window_length < whisper.audio.N_SAMPLES:
+            # conv2 has a stride of 2
+            asr = AudioContextModel(asr, mel.shape[-1] // 2)
+
+        # encoded once, shared by language detection and decoding
+        with torch.no_grad():
+            audio_features = asr.encoder(mel)
+
+        decoded = self._decode_features(asr, audio_features, speakers)
+
+        # a cached language might be outdated, detect it again
+        retry = [i for i, (result, _, _, cached) in enumerate(decoded) if cached and self._failed(result)]
+        if len(retry) > 0:
+            _ = [self._languages.invalidate(speakers[i]) for i in retry]
+            retried = self._decode_features(asr, audio_features[retry], [speakers[i] for i in retry])
+            for i, res in zip(retry, retried):
+                decoded[i] = res
+
+        return [(result, lang, score) for result, lang, score, _ in decoded]
+
+    def _decode_features(self, asr, audio_features, speakers):
+        languages = [self._languages.get(s) for s in speakers]
+        cached = [lang is not None for lang in languages]
+
         # detect the spoken language
-        _, probs = self._asr.detect_language(mel)
-        lang = max(probs, key=probs.get)
-        score = probs[lang]
-        ProjectLogger().info(f'Detected language -> {lang.upper()} {score * 100:.2f}%')
+        to_detect = [i for i, lang in enumerate(languages) if lang is None]
+        if len(to_detect) > 0:
+            _, probs = whisper.decoding.detect_language(asr, audio_features[to_detect])
+            for i, chunk_probs in zip(to_detect, probs):
+                lang = max(chunk_probs, key=chunk_probs.get)
+                languages[i] = (lang, chunk_probs[lang])
+                self._languages.update(speakers[i], *languages[i])
+
+        # decode the audio, language is given to skip its detection
+        results = [None] * len(speakers)
+        for lang in set([lang for lang, _ in languages]):
+            indexes = [i for i, (l, _) in enumerate(languages) if l == lang]
+            options = whisper.DecodingOptions(language=lang, fp16=False)
+            for i, result in zip(indexes, whisper.decode(asr, audio_features[indexes], options)):
+                results[i] = result
+
+        # a cached language confidence says nothing of this utterance, its speech probability is used instead
+        scores = [1. - result.no_speech_prob if is_cached else score for result, (_, score), is_cached in zip(results, languages, cached)]
+        return [(result, lang, score, is_cached) for result, (lang, _), score, is_cached in zip(results, languages, scores, cached)]
+
+    def _failed(self, result):
+        return result.avg_logprob < self._logprob_threshold or result.compression_ratio > self._compression_ratio_threshold
 
-        # decode the audio
-        options = whisper.DecodingOptions(fp16=False)
-        transcription = whisper.decode(self._asr, mel, options).text
-        ProjectLogger().info(f'Transcription -> {transcription}')
-        return transcription, lang, score
+    def transcribe_batch(self, voice_chunks, speakers=None):
+        """
+        :param voice_chunks: utterances sampled at 16kHz
+        :param speakers: optional speakers keys (socket id, user name) used to cache detected languages
+        :return: (text, language, score) for each utterance, score being the detected language probability,
+        or the speech probability when the speaker language was cached
+        """
+        speakers = [None] * len(voice_chunks) if speakers is None else speakers
+        asr = self._replica('_asr', self._load_model)
+
+        window_length = self._window_length(voice_chunks)
+        decoded = self._decode_window(asr, voice_chunks, speakers, window_length)
+        if window_length < whisper.audio.N_SAMPLES:
+            # falls back to the full window when the short one was not enough
+            failed = [i for i, (result, _, _) in enumerate(decoded) if self._failed(result)]
+            if len(failed) > 0:
+                ProjectLogger().info(f'{len(failed)} short window decoding(s) failed. Using full window.')
+                failed_speakers = [speakers[i] for i in failed]
+                full_decoded = self._decode_window(asr, [voice_chunks[i] for i in failed], failed_speakers, whisper.audio.N_SAMPLES)
+                for i, res in zip(failed, full_decoded):
+                    decoded[i] = res
+
+        transcriptions = []
+        for result, lang, score in decoded:
+            ProjectLogger().info(f'Detected language -> {lang.upper()} {score * 100:.2f}%')
+            ProjectLogger().info(f'Transcription -> {result.text}')
+            transcriptions.append((result.text, lang, score))
+        return transcriptions
+
+    def _consume_batch(self):
+        batch = [self._consume()]
+        deadline = time() + self._batch_window
+        while len(batch) < self._batch_size:
+            remaining = deadline - time()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self._consume(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
 
     def run(self):
         while self.running:
             try:
-                request_obj = self._consume()
+                batch = self._consume_batch()
 
-                ProjectLogger().info('Transcribing voice...')
+                ProjectLogger().info(f'Transcribing {len(batch)} voice(s)...')
                 t0 = time()
-                text, lang, score = self.transcribe(request_obj.audio_request)
+                voice_chunks = [request_obj.audio_request for request_obj in batch]
+                speakers = [request_obj.user if request_obj.socket_id is None else request_obj.socket_id for request_obj in batch]
+                transcriptions = self.transcribe_batch(voice_chunks, speakers)
 
-                request_obj.text_request = text
-                request_obj.request_lang = lang
-                if score < self._confidence_threshold:
-                    ProjectLogger().info(f'Score too low !')
-                    request_obj.text_request = ''
+                for request_obj, (text, lang, score) in zip(batch, transcriptions):
+                    request_obj.text_request = text
+                    request_obj.request_lang = lang
+                    if score < self._confidence_threshold:
+                        ProjectLogger().info(f'Score too low !')
+                        request_obj.text_request = ''
 
-                self._dispatch(request_obj)
+                    self._dispatch(request_obj)
                 ProjectLogger().info(f'{self.__class__.__name__} {time() - t0:.3f} exec. time')
             except queue.Empty:
                 continue
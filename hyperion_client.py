@@ -3,6 +3,7 @@
 from hyperion.utils import get_ctx
 from hyperion.utils.logger import ProjectLogger
 from hyperion.pipelines.listener import Listener
+from hyperion.audio.codec import AUDIO_CODECS, PCM
 from hyperion.utils.execution import startup, handle_errors
 
 import os
@@ -59,5 +60,8 @@ if __name__ == '__main__':
     parser.add_argument('--dummy-file', type=str, help='Play file instead of Brain\'s responses')
     parser.add_argument('--recog', action='store_true', help='Start bot with local user recognition. Slower than server recognition if there is no GPU.')
     parser.add_argument('--no-gui', action='store_true', help='Disable GUI.')
+    parser.add_argument('--codecs', type=str, default=','.join(AUDIO_CODECS), help='Accepted answers audio codecs, by preference. Brain falls back to raw PCM.')
+    parser.add_argument('--no-stream-audio', action='store_true', help='Wait for whole sentences to be synthesized instead of streaming their audio.')
+    parser.add_argument('--upload-codec', type=str, choices=AUDIO_CODECS, default=PCM, help='Requests audio codec. Brain must support it.')
 
     startup(APP_NAME.lower(), parser, main)
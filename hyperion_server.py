@@ -15,19 +15,23 @@ from hyperion.pipelines.brain import Brain
 from hyperion.utils.paths import ProjectPaths
 from hyperion.utils.logger import ProjectLogger
 from multiprocessing.managers import BaseManager
+from hyperion.audio.codec import negotiate_codec, decode_audio, AUDIO_CODECS
 from hyperion.utils.memory_utils import MANAGER_TOKEN
+from hyperion.utils.threading import QUEUE_POLICIES
 from hyperion.utils.identity_store import IdentityStore
+from hyperion.utils.request import Cancellations
 from hyperion.analysis.prompt_manager import PromptManager
 from hyperion.utils.execution import startup, handle_errors
 from flask_log_request_id import RequestID, current_request_id
 from flask import Flask, Response, request, g, stream_with_context
-from hyperion.voice_processing.voice_synthesizer import VALID_ENGINES
 from hyperion.voice_processing.voice_transcriber import TRANSCRIPT_MODELS
 from hyperion import HYPERION_VERSION, THEIA_MIN_VERSION, HYPERION_RAW_SECRET
+from hyperion.voice_processing.voice_synthesizer import VALID_ENGINES, ROUTING_POLICIES
 
 import os
 import io
 import json
+import queue
 import argparse
 
 
@@ -52,6 +56,24 @@ def get_headers_params():
     return request_sid, preprompt, llm, speech_engine, voice, silent, indexes
 
 
+def get_audio_params():
+    # codecs accepted for answers audio, by preference. Raw PCM if none is supported
+    codec = negotiate_codec(request.headers['codecs'] if 'codecs' in request.headers else None)
+    upload_codec = request.headers['audio_codec'] if 'audio_codec' in request.headers else None
+    stream_audio = json.loads(request.headers['stream_audio'].lower()) if 'stream_audio' in request.headers else False
+    return codec, upload_codec, stream_audio
+
+
+def valid_upload_codec(upload_codec):
+    return upload_codec is None or upload_codec in AUDIO_CODECS
+
+
+def read_audio_upload(audio, upload_codec):
+    if upload_codec is None:
+        return audio
+    return decode_audio(audio, upload_codec).tobytes()
+
+
 @sio.on('connect')
 def connect():
     ProjectLogger().info(f'Client {request.sid} connected')
@@ -62,6 +84,8 @@ def connect():
 def disconnect():
     ProjectLogger().info(f'Client {request.sid} disconnected')
     del IdentityStore()[request.sid]
+    # answers of a disconnected client are not worth computing anymore
+    Cancellations().cancel(socket_id=request.sid)
 
 
 @sio.on('identify')
@@ -102,6 +126,11 @@ def set_preferred_engines():
     return 'TTS engines order changed', 200
 
 
+@app.route('/tts-engines-stats', methods=['GET'])
+def get_engines_stats():
+    return brain.voice_synthesizer.get_engines_stats(), 200
+
+
 @app.route('/voices', methods=['GET'])
 def get_voices():
     engine = request.args.get('engine')
@@ -130,6 +159,31 @@ def set_voice():
     return f'{voice} set for engine {engine}', 200
 
 
+@app.route('/tts-cache', methods=['GET'])
+def get_tts_cache():
+    return brain.voice_synthesizer.cache_state(), 200
+
+
+@app.route('/queues', methods=['GET'])
+def get_queues():
+    return brain.queues_state(), 200
+
+
+@app.route('/chat-locks-stats', methods=['GET'])
+def get_chat_locks_stats():
+    return brain.chat_gpt.get_locks_stats(), 200
+
+
+@app.route('/llm-stats', methods=['GET'])
+def get_llm_stats():
+    return brain.chat_gpt.get_completions_stats(), 200
+
+
+@app.route('/chat-cache-stats', methods=['GET'])
+def get_chat_cache_stats():
+    return brain.chat_gpt.get_response_cache_stats(), 200
+
+
 @app.route('/models', methods=['GET'])
 def list_models():
     return list(CHAT_MODELS.keys()), 200
@@ -197,6 +251,38 @@ def delete_prompt(prompt_name):
     return f'{prompt_name} not found', 400
 
 
+  ###################
+ # SPEAKERS routes #
+###################
+@app.route('/speakers', methods=['GET'])
+def list_speakers():
+    return brain.voice_recognizer.list_speakers(), 200
+
+
+@app.route('/speaker/<string:speaker>', methods=['POST', 'PUT'])
+def enroll_speaker(speaker):
+    if len(request.files) == 0:
+        return 'No file(s) found.', 400
+    if secure_filename(speaker) != speaker or speaker == '':
+        return 'Invalid speaker name', 400
+
+    replace = request.method == 'PUT'
+    enrolled = brain.voice_recognizer.enroll(speaker, request.files.to_dict(), replace=replace)
+    if enrolled == 0:
+        return 'No valid WAV sample found.', 400
+    return f'{enrolled} sample(s) enrolled for {speaker}', 200
+
+
+@app.route('/speaker/<string:speaker>', methods=['DELETE'])
+def delete_speaker(speaker):
+    if secure_filename(speaker) != speaker or speaker == '':
+        return 'Invalid speaker name', 400
+
+    if not brain.voice_recognizer.remove_speaker(speaker):
+        return f'{speaker} not found', 404
+    return f'{speaker} has been deleted', 200
+
+
   ################
  # OTHER ROUTES #
 ################
@@ -205,10 +291,17 @@ def http_speech_stream():
     request_id = current_request_id()
     request_sid, preprompt, llm, speech_engine, voice, silent, indexes = get_headers_params()
 
-    speech = request.files['speech'].read()
+    codec, upload_codec, stream_audio = get_audio_params()
+    if not valid_upload_codec(upload_codec):
+        return f'Unsupported audio codec {upload_codec}', 400
+
+    speech = read_audio_upload(request.files['speech'].read(), upload_codec)
     speaker = request.files['speaker'].read().decode('utf-8')
 
-    stream = brain.handle_speech(request_id, request_sid, speaker, speech, preprompt, llm, speech_engine, voice, silent, indexes)
+    try:
+        stream = brain.handle_speech(request_id, request_sid, speaker, speech, preprompt, llm, speech_engine, voice, silent, indexes, codec, stream_audio)
+    except queue.Full:
+        return 'Server overloaded', 503
 
     if brain.user_commands.frozen:
         return 'I\'m a teapot', 418
@@ -221,13 +314,21 @@ def http_audio_stream():
     request_id = current_request_id()
     request_sid, preprompt, llm, speech_engine, voice, silent, indexes = get_headers_params()
 
+    codec, upload_codec, stream_audio = get_audio_params()
+    if not valid_upload_codec(upload_codec):
+        return f'Unsupported audio codec {upload_codec}', 400
+
     audio = request.files['audio'].read() if 'audio' in request.files else request.data
+    audio = read_audio_upload(audio, upload_codec)
 
-    speaker, speech = brain.handle_audio(audio)
-    if speaker is None and speech is None:
-        return 'No speech detected', 204
+    try:
+        speaker, speech = brain.handle_audio(audio)
+        if speaker is None and speech is None:
+            return 'No speech detected', 204
 
-    stream = brain.handle_speech(request_id, request_sid, speaker, speech, preprompt, llm, speech_engine, voice, silent, indexes)
+        stream = brain.handle_speech(request_id, request_sid, speaker, speech, preprompt, llm, speech_engine, voice, silent, indexes, codec, stream_audio)
+    except queue.Full:
+        return 'Server overloaded', 503
 
     if brain.user_commands.frozen:
         return 'I\'m a teapot', 418
@@ -242,9 +343,20 @@ def http_audio_stream():
 def sio_speech_stream(data):
     request_id = request.sid
     speaker = data['speaker']
-    speech = data['speech']
+    if not valid_upload_codec(data.get('audio_codec')):
+        ProjectLogger().warning(f'Request {request_id} rejected. Unsupported audio codec {data.get("audio_codec")}.')
+        return
+
+    speech = read_audio_upload(data['speech'], data.get('audio_codec'))
+    codec = negotiate_codec(data.get('codecs'))
+    stream_audio = data.get('stream_audio', False)
+
+    try:
+        stream = brain.handle_speech(request_id, request_id, speaker, speech, codec=codec, stream_audio=stream_audio)
+    except queue.Full:
+        ProjectLogger().warning(f'Request {request_id} rejected. Server overloaded.')
+        return
 
-    stream = brain.handle_speech(request_id, request_id, speaker, speech)
     for frame in stream:
         emit('answer', dict(requester=speaker, answer=frame), to=request_id)
         sio.sleep(0)  # force flush all emit calls. Should we import geventlet ?
@@ -254,11 +366,16 @@ def sio_speech_stream(data):
 def sio_audio_stream(audio):
     request_id = request.sid
 
-    speaker, speech = brain.handle_audio(audio)
-    if speaker is None and speech is None:
+    try:
+        speaker, speech = brain.handle_audio(audio)
+        if speaker is None and speech is None:
+            return
+
+        stream = brain.handle_speech(request_id, request_id, speaker, speech)
+    except queue.Full:
+        ProjectLogger().warning(f'Request {request_id} rejected. Server overloaded.')
         return
 
-    stream = brain.handle_speech(request_id, request_id, speaker, speech)
     for frame in stream:
         emit('answer', dict(requester=speaker, answer=frame), to=request_id)
         sio.sleep(0)  # force flush all emit calls. Should we import geventlet ?
@@ -277,13 +394,18 @@ def http_chat():
 
     # TODO Legacy to be removed
     if '!FREEZE' in message:
-        brain.user_commands.frozen = True
+        brain.user_commands.freeze()
         return 'Freezed', 202
     elif '!UNFREEZE' in message:
         brain.user_commands.frozen = False
         return 'Unfreezed', 202
 
-    stream = brain.handle_chat(request_id, request_sid, user, message, preprompt, llm, speech_engine, voice, silent, indexes)
+    codec, _, stream_audio = get_audio_params()
+    try:
+        stream = brain.handle_chat(request_id, request_sid, user, message, preprompt, llm, speech_engine, voice, silent, indexes, codec, stream_audio)
+    except queue.Full:
+        return 'Server overloaded', 503
+
     return Response(response=stream_with_context(stream), mimetype='application/octet-stream')
 
 
@@ -296,7 +418,14 @@ def sio_chat(data):
     if user is None or message is None:
         return
 
-    stream = brain.handle_chat(request_id, request_id, user, message)
+    codec = negotiate_codec(data.get('codecs'))
+    stream_audio = data.get('stream_audio', False)
+    try:
+        stream = brain.handle_chat(request_id, request_id, user, message, codec=codec, stream_audio=stream_audio)
+    except queue.Full:
+        ProjectLogger().warning(f'Request {request_id} rejected. Server overloaded.')
+        return
+
     # _ = [emit('answer', dict(requester=user, answer=frame), to=request_id) for frame in stream]
     for frame in stream:
         emit('answer', dict(requester=user, answer=frame), to=request_id)
@@ -484,12 +613,31 @@ if __name__ == '__main__':
         sub_parser.add_argument('-p', '--port', type=int, default=9999, help='Listening port.')
         sub_parser.add_argument('--llama-host', type=str, default='localhost', help='Llama server host')
         sub_parser.add_argument('--llama-port', type=int, default=8080, help='Llama server port')
+        sub_parser.add_argument('--llm-concurrency', type=str, default='', help='Per backend concurrent generations, for example openai=16,llama=2.')
+        sub_parser.add_argument('--chat-cache-ttl', type=int, default=0, help='Seconds answers of repeated requests are replayed for, 0 disables the cache.')
+        sub_parser.add_argument('--chat-cache-size', type=int, default=1024, help='Max number of cached answers.')
+        sub_parser.add_argument('--chat-cache-similarity', type=float, default=0, help='Min cosine similarity of request embeddings to replay an answer, 0 matches normalized requests only.')
+        sub_parser.add_argument('--chat-cache-exclude', type=str, default='', help='Comma separated prompts whose answers are never cached.')
         sub_parser.add_argument('--clear', action='store_true', help='Clean persistent memory at startup')
         sub_parser.add_argument('--no-memory', action='store_true', help='Start bot without persistent memory.')
         sub_parser.add_argument('--name', type=str, default='Hypérion', help='Set bot name.')
         sub_parser.add_argument('--gpt', type=str, default=list(CHAT_MODELS.keys())[1], choices=CHAT_MODELS.keys(), help='GPT version to use.')
         sub_parser.add_argument('--whisper', type=str, default=TRANSCRIPT_MODELS[3], choices=TRANSCRIPT_MODELS, help='Whisper version to use.')
+        sub_parser.add_argument('--whisper-batch', type=int, default=1, help='Maximum number of utterances transcribed together.')
+        sub_parser.add_argument('--whisper-batch-window', type=float, default=50, help='Time in ms waited for more utterances to fill a transcription batch.')
+        sub_parser.add_argument('--whisper-length-aware', action='store_true', help='Encode only the utterance length instead of a 30 sec(s) window.')
         sub_parser.add_argument('--prompt', type=str, default='base', help='Prompt file to use.')
+        sub_parser.add_argument('--queue-size', type=int, default=0, help='Default capacity of pipeline queues. 0 means unbounded.')
+        sub_parser.add_argument('--queue-sizes', type=str, default='', help='Per stage queue capacity, for example VoiceTranscriber=2,VoiceSynthesizer=32.')
+        sub_parser.add_argument('--workers', type=str, default='', help='Per stage number of workers, for example VoiceTranscriber=2,VoiceSynthesizer=2.')
+        sub_parser.add_argument('--replicate', type=str, default='', help='Stages loading one model per worker instead of sharing it, for example VoiceRecognizer. VoiceTranscriber and ImageGenerator always do.')
+        sub_parser.add_argument('--tts-parallel', type=int, default=3, help='Maximum number of sentences of the same answer synthesized at once by cloud engines.')
+        sub_parser.add_argument('--tts-engine-limits', type=str, default='', help='Per engine concurrent syntheses, for example eleven=2,google_cloud=4.')
+        sub_parser.add_argument('--tts-cache-size', type=int, default=64, help='Synthesized speech kept in memory, in MB.')
+        sub_parser.add_argument('--tts-disk-cache-size', type=int, default=512, help='Synthesized speech kept on disk, in MB.')
+        sub_parser.add_argument('--tts-routing', type=str, default=ROUTING_POLICIES[0], choices=ROUTING_POLICIES, help='Healthy engines are tried by preference or fastest first.')
+        sub_parser.add_argument('--no-tts-warm-up', action='store_true', help='Do not synthesize default sentences at startup.')
+        sub_parser.add_argument('--queue-policy', type=str, default=QUEUE_POLICIES[0], choices=QUEUE_POLICIES, help='Policy applied to new requests when a pipeline queue is full.')
 
     parser = argparse.ArgumentParser(description='Hyperion\'s brain')
     parser.add_argument('--debug', action='store_true', help='Enables debugging.')
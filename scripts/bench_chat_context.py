@@ -0,0 +1,88 @@
+from time import perf_counter
+from hyperion.analysis import get_model_token_specs
+from hyperion.analysis.prompt_manager import HistoryStore
+from hyperion.analysis.chat_gpt import ChatGPT, get_tokenizer, message_tokens
+
+import random
+import argparse
+import tempfile
+import tiktoken
+import numpy as np
+
+WORDS = 'le chat mange une pomme rouge sous la pluie pendant que hyperion écoute attentivement les réponses'.split()
+
+
+def legacy_tokens_count(messages, model):
+    """
+    Former behaviour : tokenizer looked up and every message encoded again on each call
+    """
+    tokenizer = tiktoken.encoding_for_model(model)
+    tokens_per_message, tokens_per_name = get_model_token_specs(model)
+    num_tokens = 0
+    for message in messages:
+        num_tokens += tokens_per_message
+        for key, value in message.items():
+            num_tokens += len(tokenizer.encode(value))
+            if key == 'name':
+                num_tokens += tokens_per_name
+    return num_tokens + 3
+
+
+def legacy_context(history, new_message, model, max_tokens):
+    """
+    Former behaviour : the oldest message is popped and the whole request counted again until it fits
+    """
+    cache = history + [new_message]
+    while True:
+        found_tokens = legacy_tokens_count(cache, model)
+        if found_tokens < max_tokens:
+            return cache, found_tokens
+        cache.pop(0)
+
+
+def store_context(store, new_message, model, max_tokens):
+    tokenizer = get_tokenizer(model)
+    specs = get_model_token_specs(model)
+    fixed_tokens = message_tokens(new_message, tokenizer, *specs) + 3
+    key = f'{tokenizer.name}:{specs[0]}:{specs[1]}'
+    history, history_tokens, _ = store.tail(max_tokens - fixed_tokens, key, lambda m: message_tokens(m, tokenizer, *specs))
+    return history + [new_message], fixed_tokens + history_tokens
+
+
+def random_message(i):
+    role = 'user' if i % 2 == 0 else 'assistant'
+    return {'role': role, 'content': ' '.join(random.choices(WORDS, k=random.randint(5, 60)))}
+
+
+def timeit(fn, repeat):
+    timings = []
+    for _ in range(repeat):
+        t0 = perf_counter()
+        output = fn()
+        timings.append(perf_counter() - t0)
+    return output, np.median(timings) * 1e3
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Context building cost of a chat request against its history length')
+    parser.add_argument('--model', default='gpt-4', help='Model whose tokenizer and context size are used.')
+    parser.add_argument('--histories', type=int, nargs='+', default=[1000, 2500, 5000, 10000], help='History lengths in messages.')
+    parser.add_argument('--repeat', type=int, default=3, help='Number of timed repetitions.')
+    args = parser.parse_args()
+
+    max_tokens = ChatGPT.max_tokens(args.model)
+    print(f'{args.model}, {max_tokens} tokens budget')
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for length in args.histories:
+            history = [random_message(i) for i in range(length)]
+            new_message = random_message(length)
+
+            store = HistoryStore(f'{tmp_dir}/{length}.sqlite')
+            store.insert(history)
+            # first read counts the whole history once, next ones only read the cached counts of the tail
+            (_, _), first_ms = timeit(lambda: store_context(store, new_message, args.model, max_tokens), 1)
+
+            (legacy, legacy_count), legacy_ms = timeit(lambda: legacy_context(list(history), new_message, args.model, max_tokens), 1)
+            (new, count), new_ms = timeit(lambda: store_context(store, new_message, args.model, max_tokens), args.repeat)
+            assert len(legacy) == len(new) and legacy_count == count, 'Context builders disagree'
+            print(f'{length:>6} messages | kept {len(new) - 1:>5} | legacy {legacy_ms:10.2f} ms | first count {first_ms:8.2f} ms | cached {new_ms:8.3f} ms | x{legacy_ms / new_ms:.0f}')
@@ -0,0 +1,78 @@
+from time import time, sleep, perf_counter, process_time
+from hyperion.utils.threading import Consumer, Producer
+
+import queue
+import argparse
+import numpy as np
+
+
+class Stage(Consumer, Producer):
+
+    def run(self):
+        while self.running:
+            try:
+                job = self._consume()
+                self._dispatch(job)
+            except queue.Empty:
+                continue
+
+
+class PollingStage(Stage):
+    """
+    Former behaviour : 100ms timeout on every get, spinning on queue.Empty
+    """
+    def _consume(self):
+        job = self._in_queue.get(timeout=.1)
+        self._in_queue.task_done()
+        return job
+
+    def stop(self):
+        self.running = False
+
+
+def build_chain(stage_cls, num_stages):
+    stages = [stage_cls() for _ in range(num_stages)]
+    intake = stages[0].create_intake()
+    for upstream, downstream in zip(stages[:-1], stages[1:]):
+        upstream.pipe(downstream)
+    sink = stages[-1].create_sink()
+    return stages, intake, sink
+
+
+def bench(stage_cls, num_stages, num_jobs, idle_duration):
+    stages, intake, sink = build_chain(stage_cls, num_stages)
+    _ = [s.start() for s in stages]
+
+    latencies = []
+    for _ in range(num_jobs):
+        intake.put(perf_counter())
+        while True:
+            try:
+                t0 = sink.drain(timeout=1)
+                break
+            except queue.Empty:
+                continue
+        latencies.append((perf_counter() - t0) / num_stages)
+        # let the chain go idle between two jobs, as real traffic does
+        sleep(.01)
+
+    cpu_t0, wall_t0 = process_time(), time()
+    sleep(idle_duration)
+    idle_cpu = (process_time() - cpu_t0) / (time() - wall_t0)
+
+    _ = [s.stop() for s in stages]
+    _ = [s.join() for s in stages]
+
+    latencies = np.array(latencies) * 1e6
+    print(f'{stage_cls.__name__:>12} | {num_stages} stages | per-hop latency mean {latencies.mean():.1f} us, p50 {np.percentile(latencies, 50):.1f} us, p99 {np.percentile(latencies, 99):.1f} us | idle CPU {idle_cpu * 100:.2f}%')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Per-hop latency and idle CPU of a Consumer/Producer chain')
+    parser.add_argument('--stages', type=int, default=5, help='Number of chained stages.')
+    parser.add_argument('--jobs', type=int, default=500, help='Number of jobs sent through the chain.')
+    parser.add_argument('--idle', type=float, default=5, help='Idle measurement duration in seconds.')
+    args = parser.parse_args()
+
+    bench(PollingStage, args.stages, args.jobs, args.idle)
+    bench(Stage, args.stages, args.jobs, args.idle)
@@ -0,0 +1,121 @@
+from time import perf_counter
+from hyperion.utils.protocol import frame_encode, FrameDecoder
+
+import struct
+import argparse
+import numpy as np
+
+
+def legacy_frame_encode(timestamp, idx, speaker, request, answer, pcm, img):
+    """
+    Former behaviour : bytes concatenation, every payload is copied several times
+    """
+    pcm = np.zeros((0,), dtype=np.int16) if pcm is None else pcm
+    img = b'' if img is None else img
+    answer = int.to_bytes(idx, 1, 'big') + bytes(answer, 'utf-8')
+    request = bytes(request, 'utf-8')
+    speaker = bytes(speaker, 'utf-8')
+
+    frame = b'TIM' + struct.pack('d', timestamp)
+    frame += b'SPK' + len(speaker).to_bytes(4, 'big') + speaker
+    frame += b'REQ' + len(request).to_bytes(4, 'big') + request
+    frame += b'ANS' + len(answer).to_bytes(4, 'big') + answer
+    frame += b'PCM' + (len(pcm) * 2).to_bytes(4, 'big') + pcm.tobytes()
+    frame += b'IMG' + len(img).to_bytes(4, 'big') + img
+    return frame
+
+
+def legacy_frame_decode(frame):
+    """
+    Former behaviour : the whole buffer is copied then re-sliced on every received chunk
+    """
+    decoded = dict()
+    frame_copy = frame.copy()
+    if len(frame_copy) < 11:
+        return None
+
+    decoded['TIM'] = struct.unpack('d', frame_copy[3:11])[0]
+    frame_copy = frame_copy[11:]
+    while True:
+        if len(frame_copy) < 7:
+            return None
+
+        chunk_header = frame_copy[:3].decode('utf-8')
+        chunk_size = int.from_bytes(frame_copy[3:7], 'big')
+        frame_copy = frame_copy[7:]
+        if len(frame_copy) < chunk_size:
+            return None
+
+        chunk_content = frame_copy[:chunk_size]
+        frame_copy = frame_copy[chunk_size:]
+        if chunk_header in ['PCM', 'IMG']:
+            decoded[chunk_header] = chunk_content
+        elif chunk_header == 'ANS':
+            decoded['IDX'] = chunk_content[0]
+            decoded[chunk_header] = chunk_content[1:].decode('utf-8')
+        else:
+            decoded[chunk_header] = chunk_content.decode('utf-8')
+
+        if chunk_header == 'IMG':
+            return decoded, frame_copy
+
+
+def legacy_stream(stream, chunk_size):
+    frames = []
+    buffer = bytearray()
+    for i in range(0, len(stream), chunk_size):
+        buffer.extend(stream[i:i + chunk_size])
+        while True:
+            output = legacy_frame_decode(buffer)
+            if output is None:
+                break
+            decoded_frame, buffer = output
+            frames.append(decoded_frame)
+    return frames
+
+
+def decoder_stream(stream, chunk_size):
+    frames = []
+    decoder = FrameDecoder()
+    for i in range(0, len(stream), chunk_size):
+        frames.extend(decoder.feed(stream[i:i + chunk_size]))
+    return frames
+
+
+def timeit(fn, repeat):
+    timings = []
+    for _ in range(repeat):
+        t0 = perf_counter()
+        output = fn()
+        timings.append(perf_counter() - t0)
+    return output, np.median(timings) * 1e3
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Encoding and streamed decoding throughput of answer frames')
+    parser.add_argument('--frames', type=int, default=8, help='Number of frames in the stream.')
+    parser.add_argument('--audio', type=float, default=10, help='Seconds of 24kHz audio per frame.')
+    parser.add_argument('--image', type=int, default=512, help='Image size per frame in KB.')
+    parser.add_argument('--chunk', type=int, default=4096, help='Network chunk size in bytes.')
+    parser.add_argument('--repeat', type=int, default=5, help='Number of timed repetitions.')
+    args = parser.parse_args()
+
+    pcm = (np.random.randn(int(args.audio * 24000)) * 3000).astype(np.int16)
+    img = np.random.bytes(args.image * 1024)
+    frame_args = [(perf_counter(), i, 'Speaker', 'Une requête', 'Une réponse accentuée', pcm, img) for i in range(args.frames)]
+
+    legacy_frames, legacy_enc_ms = timeit(lambda: [legacy_frame_encode(*a) for a in frame_args], args.repeat)
+    frames, enc_ms = timeit(lambda: [frame_encode(*a) for a in frame_args], args.repeat)
+    assert legacy_frames == frames, 'Encoders disagree'
+
+    stream = b''.join(frames)
+    size_mb = len(stream) / 2 ** 20
+    print(f'stream of {args.frames} frames, {size_mb:.1f} MB, fed by {args.chunk} bytes chunks')
+    print(f'encode | legacy {legacy_enc_ms:8.2f} ms | preallocated {enc_ms:8.2f} ms | x{legacy_enc_ms / enc_ms:.1f}')
+
+    legacy_decoded, legacy_dec_ms = timeit(lambda: legacy_stream(stream, args.chunk), 1)
+    decoded, dec_ms = timeit(lambda: decoder_stream(stream, args.chunk), args.repeat)
+    assert len(decoded) == len(legacy_decoded) == args.frames
+    for a, b in zip(decoded, legacy_decoded):
+        assert a['ANS'] == b['ANS'] and a['IDX'] == b['IDX'] and bytes(a['PCM']) == bytes(b['PCM']) and bytes(a['IMG']) == bytes(b['IMG'])
+    print(f'decode | legacy {legacy_dec_ms:8.2f} ms | incremental {dec_ms:8.2f} ms | x{legacy_dec_ms / dec_ms:.1f} | {size_mb / dec_ms * 1e3:.0f} MB/s')
@@ -0,0 +1,91 @@
+from time import perf_counter
+from hyperion.analysis.sentence_segmenter import SentenceSegmenter
+
+import random
+import argparse
+import numpy as np
+
+WORDS = 'le chat mange une pomme rouge sous la pluie pendant que Hypérion écoute attentivement les réponses de M. Dupont'.split()
+ENDS = ['.', ' !', ' ?', ',', ';', ' :', '…']
+
+
+def legacy_segment(tokens):
+    """
+    Former behaviour : the growing sentence is searched again for every delimiter at each token, split at the last one
+    """
+    sentence = ''
+    sentences = []
+    for content in tokens:
+        sentence += content
+        sentence_ends = [sentence.find(e) for e in ['. ', '.\n', '! ', '!\n', '? ', '?\n', '; ', ';\n', ': ', ':\n']]
+        sentence_end = sentence_ends[np.argmax(sentence_ends)] + 1
+        if sentence_end > 0:
+            sentences.append(sentence[:sentence_end])
+            sentence = sentence[sentence_end:]
+    if sentence != '':
+        sentences.append(sentence)
+    return sentences
+
+
+def incremental_segment(tokens):
+    segmenter = SentenceSegmenter()
+    sentences = []
+    for content in tokens:
+        sentences.extend(segmenter.feed(content))
+    sentence = segmenter.flush()
+    if sentence != '':
+        sentences.append(sentence)
+    return sentences
+
+
+def random_answer(num_sentences, sentence_words):
+    sentences = []
+    for _ in range(num_sentences):
+        words = random.choices(WORDS, k=random.randint(3, sentence_words))
+        sentences.append(' '.join(words) + random.choice(ENDS))
+    return ' '.join(sentences)
+
+
+def tokenize(text):
+    # streamed deltas are about 4 characters long
+    tokens = []
+    i = 0
+    while i < len(text):
+        size = random.randint(1, 7)
+        tokens.append(text[i:i + size])
+        i += size
+    return tokens
+
+
+def timeit(fn, repeat):
+    timings = []
+    for _ in range(repeat):
+        t0 = perf_counter()
+        output = fn()
+        timings.append(perf_counter() - t0)
+    return output, np.median(timings) * 1e3
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Sentence segmentation throughput of streamed answers')
+    parser.add_argument('--sentences', type=int, default=200, help='Number of sentences of the answer.')
+    parser.add_argument('--sentence-words', type=int, nargs='+', default=[10, 50, 200], help='Maximum words per sentence.')
+    parser.add_argument('--repeat', type=int, default=5, help='Number of timed repetitions.')
+    args = parser.parse_args()
+
+    for sentence_words in args.sentence_words:
+        answer = random_answer(args.sentences, sentence_words)
+        tokens = tokenize(answer)
+
+        legacy, legacy_ms = timeit(lambda: legacy_segment(tokens), args.repeat)
+        new, new_ms = timeit(lambda: incremental_segment(tokens), args.repeat)
+        assert ''.join(legacy) == ''.join(new) == answer, 'Segmenters lost characters'
+
+        # length of the first chunk when the answer starts with a long sentence, the synthesizer waits for it
+        long_first = tokenize(random_answer(1, 200) + ' ' + answer)
+        first_chars = [len(incremental_segment(long_first)[0]), len(legacy_segment(long_first)[0])]
+
+        mb = len(answer) / 2 ** 20
+        print(f'{sentence_words:>4} words max | {len(tokens):>6} tokens | legacy {legacy_ms:8.2f} ms {len(legacy):>4} sentences | '
+              f'incremental {new_ms:8.2f} ms {len(new):>4} sentences {mb / new_ms * 1e3:6.1f} MB/s | x{legacy_ms / new_ms:.1f} | '
+              f'first chunk {first_chars[0]} vs {first_chars[1]} chars')
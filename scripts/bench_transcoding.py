@@ -0,0 +1,96 @@
+from time import perf_counter
+from hyperion.audio import transcoding, int16_to_float32
+
+import io
+import pydub
+import librosa
+import argparse
+import numpy as np
+
+
+def legacy_eleven(mp3_data, sample_rate):
+    """
+    Former ElevenLabs path : mp3 -> in-memory wav -> parsed wav -> pydub resampling -> python array
+    """
+    mp3_sound = pydub.AudioSegment.from_file(io.BytesIO(mp3_data), format='mp3')
+    memory_buff = io.BytesIO()
+    mp3_sound.export(memory_buff, format='wav')
+    wav_sound = pydub.AudioSegment.from_wav(memory_buff)
+    wav_sound = wav_sound.set_frame_rate(sample_rate)
+    return np.array(wav_sound.get_array_of_samples(), dtype=np.int16)
+
+
+def legacy_google_translate(mp3_chunks):
+    """
+    Former gTTS path : streamed chunks concatenated one by one, then mp3 -> in-memory wav -> parsed wav
+    """
+    data = None
+    for raw_buffer in mp3_chunks:
+        buffer = np.frombuffer(raw_buffer, dtype=np.uint8)
+        data = buffer if data is None else np.concatenate([data, buffer])
+
+    mp3 = pydub.AudioSegment.from_file(io.BytesIO(data), format='mp3')
+    memory_buff = io.BytesIO()
+    mp3.export(memory_buff, format='wav')
+    sound = pydub.AudioSegment.from_wav(memory_buff)
+    return np.array(sound.get_array_of_samples(), dtype=np.int16)
+
+
+def google_translate(mp3_chunks, sample_rate):
+    mp3_data = bytearray()
+    for raw_buffer in mp3_chunks:
+        mp3_data.extend(raw_buffer)
+    return transcoding.decode(mp3_data, 'mp3', sample_rate)
+
+
+def synthetic_mp3(duration, sample_rate):
+    t = np.arange(int(duration * sample_rate)) / sample_rate
+    wav = (np.sin(2 * np.pi * 220 * t) * np.sin(2 * np.pi * 3 * t) * 12000).astype(np.int16)
+    segment = pydub.AudioSegment(wav.tobytes(), frame_rate=sample_rate, sample_width=2, channels=1)
+    buffer = io.BytesIO()
+    segment.export(buffer, format='mp3')
+    return buffer.getvalue()
+
+
+def timeit(fn, repeat):
+    timings = []
+    for _ in range(repeat):
+        t0 = perf_counter()
+        output = fn()
+        timings.append(perf_counter() - t0)
+    return output, np.median(timings) * 1e3
+
+
+def report(name, legacy_ms, new_ms):
+    print(f'{name:>28} | legacy {legacy_ms:8.2f} ms | new {new_ms:8.2f} ms | x{legacy_ms / new_ms:.1f}')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Legacy and direct decoding/resampling paths of synthesized speech')
+    parser.add_argument('--duration', type=float, default=8, help='Sentence duration in seconds.')
+    parser.add_argument('--sample-rate', type=int, default=24000, help='Synthesizer sample rate.')
+    parser.add_argument('--device-rate', type=int, default=48000, help='Client output device sample rate.')
+    parser.add_argument('--chunk', type=int, default=1024, help='gTTS stream chunk size in bytes.')
+    parser.add_argument('--repeat', type=int, default=10, help='Number of timed repetitions.')
+    args = parser.parse_args()
+
+    # ElevenLabs answers 44.1kHz mp3, resampled to the synthesizer rate
+    eleven_mp3 = synthetic_mp3(args.duration, 44100)
+    legacy, legacy_ms = timeit(lambda: legacy_eleven(eleven_mp3, args.sample_rate), args.repeat)
+    new, new_ms = timeit(lambda: transcoding.decode(eleven_mp3, 'mp3', args.sample_rate), args.repeat)
+    report('eleven (44.1kHz mp3)', legacy_ms, new_ms)
+    print(f'{"":>28} | {len(legacy)} vs {len(new)} samples')
+
+    # gTTS streams 24kHz mp3 by small chunks
+    gtts_mp3 = synthetic_mp3(args.duration, 24000)
+    gtts_chunks = [gtts_mp3[i:i + args.chunk] for i in range(0, len(gtts_mp3), args.chunk)]
+    legacy, legacy_ms = timeit(lambda: legacy_google_translate(gtts_chunks), args.repeat)
+    new, new_ms = timeit(lambda: google_translate(gtts_chunks, args.sample_rate), args.repeat)
+    report('google_translate (24kHz mp3)', legacy_ms, new_ms)
+    print(f'{"":>28} | {len(legacy)} vs {len(new)} samples')
+
+    # client playback, synthesizer rate to device rate
+    sentence = (np.random.randn(int(args.duration * args.sample_rate)) * 3000).astype(np.int16)
+    _, legacy_ms = timeit(lambda: librosa.resample(int16_to_float32(sentence), orig_sr=args.sample_rate, target_sr=args.device_rate), args.repeat)
+    _, new_ms = timeit(lambda: transcoding.resample(int16_to_float32(sentence), orig_sr=args.sample_rate, target_sr=args.device_rate), args.repeat)
+    report(f'playback {args.sample_rate}->{args.device_rate}Hz', legacy_ms, new_ms)
@@ -0,0 +1,65 @@
+from time import process_time
+from hyperion.voice_processing.voice_detector import SpeechBuffer
+
+import torch
+import argparse
+import numpy as np
+
+
+def accumulate_cat(chunks):
+    buffer = None
+    copied = 0
+    for chunk in chunks:
+        chunk = torch.tensor(chunk)
+        buffer = chunk if buffer is None else torch.cat([buffer, chunk])
+        copied += len(buffer)
+    return buffer, copied
+
+
+def accumulate_speech_buffer(chunks, capacity):
+    buffer = SpeechBuffer(capacity)
+    copied = 0
+    for chunk in chunks:
+        prev_capacity = len(buffer._data)
+        buffer.append(chunk)
+        copied += len(chunk) + (len(buffer) - len(chunk) if len(buffer._data) != prev_capacity else 0)
+    return torch.from_numpy(buffer.view().copy()), copied + len(buffer)
+
+
+def run_detector(chunks, sample_rate):
+    from hyperion.utils import get_ctx
+    from hyperion.voice_processing.voice_detector import VoiceDetector
+
+    detector = VoiceDetector(get_ctx(argparse.Namespace(gpus='-1')), sample_rate)
+    t0 = process_time()
+    _ = [detector._detect(c) for c in chunks]
+    return process_time() - t0
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Speech accumulation cost over long monologues')
+    parser.add_argument('--minutes', type=str, default='1,5,10', help='Monologue durations to compare.')
+    parser.add_argument('--chunk-ms', type=int, default=512, help='Duration of each input chunk.')
+    parser.add_argument('--with-vad', action='store_true', help='Also measure the full detector, VAD inference included.')
+    args = parser.parse_args()
+
+    sample_rate = 16000
+    chunk_size = int(sample_rate * args.chunk_ms / 1000)
+    for minutes in [float(m) for m in args.minutes.split(',')]:
+        seconds = minutes * 60
+        chunks = [np.random.uniform(-.1, .1, chunk_size).astype(np.float32) for _ in range(int(seconds * sample_rate / chunk_size))]
+
+        t0 = process_time()
+        _, cat_copied = accumulate_cat(chunks)
+        cat_cpu = process_time() - t0
+
+        t0 = process_time()
+        _, buffer_copied = accumulate_speech_buffer(chunks, 10 * sample_rate)
+        buffer_cpu = process_time() - t0
+
+        print(f'{minutes:4.1f} min | torch.cat {cat_cpu / seconds * 1000:7.3f} ms CPU/s audio, {cat_copied * 4 / seconds / 1e6:8.2f} MB copied/s audio | '
+              f'SpeechBuffer {buffer_cpu / seconds * 1000:7.3f} ms CPU/s audio, {buffer_copied * 4 / seconds / 1e6:8.2f} MB copied/s audio')
+
+        if args.with_vad:
+            vad_cpu = run_detector(chunks, sample_rate)
+            print(f'{minutes:4.1f} min | VoiceDetector {vad_cpu / seconds * 1000:7.3f} ms CPU/s audio')
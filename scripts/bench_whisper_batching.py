@@ -0,0 +1,42 @@
+from time import time
+from pathlib import Path
+from hyperion.utils import get_ctx
+from hyperion.voice_processing.voice_transcriber import VoiceTranscriber, TRANSCRIPT_MODELS
+
+import argparse
+import librosa
+import numpy as np
+
+
+def load_utterances(wav_dir, count, duration, sample_rate=16000):
+    if wav_dir is not None:
+        wav_files = sorted(Path(wav_dir).expanduser().glob('*.wav'))
+        utterances = [librosa.load(w, sr=sample_rate)[0] for w in wav_files]
+    else:
+        # noise is enough to measure throughput
+        utterances = [np.random.uniform(-.1, .1, int(duration * sample_rate)).astype(np.float32)]
+
+    return [utterances[i % len(utterances)] for i in range(count)]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Whisper transcription throughput per batch size')
+    parser.add_argument('--gpus', type=str, default='-1', help='GPUs id to use, for example 0,1, etc. -1 to use cpu.')
+    parser.add_argument('--whisper', type=str, default=TRANSCRIPT_MODELS[1], choices=TRANSCRIPT_MODELS, help='Whisper version to use.')
+    parser.add_argument('--wav-dir', type=str, default=None, help='Directory of 16kHz WAV utterances. Random noise is used otherwise.')
+    parser.add_argument('--duration', type=float, default=3, help='Duration of generated utterances in sec(s).')
+    parser.add_argument('--count', type=int, default=16, help='Number of utterances transcribed per batch size.')
+    parser.add_argument('--batch-sizes', type=str, default='1,2,4,8', help='Batch sizes to compare.')
+    args = parser.parse_args()
+
+    transcriber = VoiceTranscriber(get_ctx(args), args.whisper)
+    utterances = load_utterances(args.wav_dir, args.count, args.duration)
+    # warm up
+    _ = transcriber.transcribe(utterances[0])
+
+    for batch_size in [int(b) for b in args.batch_sizes.split(',')]:
+        t0 = time()
+        for i in range(0, len(utterances), batch_size):
+            _ = transcriber.transcribe_batch(utterances[i:i + batch_size])
+        elapsed = time() - t0
+        print(f'batch {batch_size:>2} | {elapsed:.2f} sec(s) | {len(utterances) / elapsed:.2f} utterances/sec')
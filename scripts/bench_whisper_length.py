@@ -0,0 +1,39 @@
+from time import time
+from pathlib import Path
+from hyperion.utils import get_ctx
+from hyperion.voice_processing.voice_transcriber import VoiceTranscriber, TRANSCRIPT_MODELS
+
+import argparse
+import librosa
+
+
+def measure(transcriber, utterance, repeat):
+    t0 = time()
+    for _ in range(repeat):
+        text, _, _ = transcriber.transcribe(utterance)
+    return (time() - t0) / repeat, text
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Whisper latency vs utterance length, full window vs length-aware window')
+    parser.add_argument('wav_dir', type=str, help='Directory of WAV utterances.')
+    parser.add_argument('--gpus', type=str, default='-1', help='GPUs id to use, for example 0,1, etc. -1 to use cpu.')
+    parser.add_argument('--whisper', type=str, default=TRANSCRIPT_MODELS[1], choices=TRANSCRIPT_MODELS, help='Whisper version to use.')
+    parser.add_argument('--repeat', type=int, default=3, help='Transcriptions per file.')
+    args = parser.parse_args()
+
+    ctx = get_ctx(args)
+    full_window = VoiceTranscriber(ctx, args.whisper)
+    length_aware = VoiceTranscriber(ctx, args.whisper, length_aware=True)
+
+    wav_files = sorted(Path(args.wav_dir).expanduser().glob('*.wav'))
+    utterances = [librosa.load(w, sr=16000)[0] for w in wav_files]
+    # warm up
+    _ = full_window.transcribe(utterances[0])
+
+    print(f'{"file":>30} | {"length":>7} | {"full":>8} | {"aware":>8} | same text')
+    for wav_file, utterance in sorted(zip(wav_files, utterances), key=lambda e: len(e[1])):
+        full_latency, full_text = measure(full_window, utterance, args.repeat)
+        aware_latency, aware_text = measure(length_aware, utterance, args.repeat)
+        length = len(utterance) / 16000
+        print(f'{wav_file.name[-30:]:>30} | {length:6.2f}s | {full_latency:7.3f}s | {aware_latency:7.3f}s | {full_text == aware_text}')
@@ -0,0 +1,24 @@
+from pathlib import Path
+from hyperion.utils.logger import ProjectLogger
+from hyperion.analysis.prompt_manager import HistoryStore, migrate_tinydb
+
+import argparse
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Migrate TinyDB conversation histories to SQLite history stores')
+    parser.add_argument('--db-dir', default='~/.hyperion/prompts_db', type=str, help='Conversation histories directory.')
+    parser.add_argument('--keep', action='store_true', help='Keep JSON files instead of renaming them *.json.migrated.')
+    args = parser.parse_args()
+
+    db_dir = Path(args.db_dir).expanduser()
+    for json_path in sorted(db_dir.glob('*.json')):
+        db_path = json_path.with_suffix('.sqlite')
+        if db_path.exists():
+            ProjectLogger().warning(f'{db_path.name} already exists, {json_path.name} skipped.')
+            continue
+
+        count = migrate_tinydb(json_path, HistoryStore(db_path))
+        if not args.keep:
+            json_path.rename(json_path.with_suffix('.json.migrated'))
+        ProjectLogger().info(f'Migrated {count} messages of {json_path.name} to {db_path.name}.')
@@ -0,0 +1,52 @@
+from queue import PriorityQueue
+from hyperion.utils.threading import Wakeup
+from hyperion.utils.request import RequestObject
+
+
+def answer(num_answer, sub_index=0, priority=1):
+    request_obj = RequestObject('id', 'user', priority=priority)
+    request_obj.num_answer = num_answer
+    request_obj.sub_index = sub_index
+    return request_obj
+
+
+def drain(sink):
+    jobs = []
+    while not sink.empty():
+        job = sink.get()
+        jobs.append('W' if isinstance(job, Wakeup) else 'T' if job.termination else (job.num_answer, job.sub_index))
+    return jobs
+
+
+def test_termination_last():
+    # a lagging client finds the whole answer, and its termination, queued in its identified sink
+    for priority in [1, 999]:
+        sink = PriorityQueue()
+        for num_answer in range(1, 4):
+            for sub_index in range(2):
+                sink.put(answer(num_answer, sub_index))
+        termination = RequestObject('id', 'user', termination=True)
+        termination.priority = priority
+        sink.put(termination)
+        sink.put(answer(4))
+        assert drain(sink) == [(1, 0), (1, 1), (2, 0), (2, 1), (3, 0), (3, 1), (4, 0), 'T']
+
+
+def test_priorities():
+    # acknowledgments and interruptions come first, wake up sentinels before anything
+    sink = PriorityQueue()
+    sink.put(answer(2))
+    sink.put(answer(1))
+    interruption = RequestObject('id', 'user', termination=True)
+    interruption.priority = 0
+    sink.put(interruption)
+    sink.put(answer(5, priority=0))
+    sink.put(Wakeup())
+    assert drain(sink) == ['W', (5, 0), 'T', (1, 0), (2, 0)]
+
+
+if __name__ == '__main__':
+    tests = [name for name in list(globals()) if name.startswith('test_')]
+    for name in tests:
+        globals()[name]()
+        print(f'{name} passed')
@@ -0,0 +1,92 @@
+from hyperion.analysis.sentence_segmenter import SentenceSegmenter
+
+import random
+
+ANSWER = (
+    'Bonjour M. Dupont, comment allez-vous ? Très bien merci. Le livre de J. R. R. Tolkien est long…\n'
+    'Voici la liste :\n1. Premier point\n2. Second point\n'
+    'Exemple :\n```python\nx = 1. \nprint(x)\n```\n'
+    'Utilise `a. b` pour voir ! Il a dit « Bonjour. » Puis il est parti. '
+    + 'Une phrase sans ponctuation qui continue encore et encore, longtemps, bien plus que de raison ' * 3 + 'fin.'
+)
+
+
+def segment(chunks, **kwargs):
+    segmenter = SentenceSegmenter(**kwargs)
+    sentences = []
+    for chunk in chunks:
+        sentences += segmenter.feed(chunk)
+    sentences.append(segmenter.flush())
+    return [sentence for sentence in sentences if sentence != '']
+
+
+def test_abbreviations_and_initials():
+    assert segment(['Bonjour M. Dupont, comment allez-vous ? Très bien merci.']) == [
+        'Bonjour M. Dupont, comment allez-vous ?', ' Très bien merci.'
+    ]
+    assert segment(['Le livre de J. R. R. Tolkien est long. Il est bon.']) == [
+        'Le livre de J. R. R. Tolkien est long.', ' Il est bon.'
+    ]
+
+
+def test_numbered_list():
+    assert segment(['Voici la liste :\n1. Premier point\n2. Second point\n']) == [
+        'Voici la liste :', '\n1. Premier point\n', '2. Second point\n'
+    ]
+
+
+def test_code():
+    # a code block is read as a whole, delimiters inside code do not end sentences
+    assert segment(['Voici le code de test :\n```python\nx = 1. \nprint(x)\n```\nFin du code. Voilà.']) == [
+        'Voici le code de test :', '\n```python\nx = 1. \nprint(x)\n```', '\nFin du code.', ' Voilà.'
+    ]
+    assert segment(['Utilise `a. b` pour voir. Ensuite continue.']) == [
+        'Utilise `a. b` pour voir.', ' Ensuite continue.'
+    ]
+
+
+def test_french_guillemets():
+    for space in [' ', '\u00a0', '\u202f']:
+        assert segment([f'Il a dit « Bonjour.{space}» Puis il est parti.']) == [
+            f'Il a dit « Bonjour.{space}»', ' Puis il est parti.'
+        ]
+
+
+def test_lengths():
+    # short sentences are merged with the next one, except the first one
+    assert segment(['Oui. Non. Peut-être bien que oui.']) == ['Oui.', ' Non. Peut-être bien que oui.']
+    assert segment(['Oui. Non. Peut-être bien que oui.'], min_length=0) == ['Oui.', ' Non.', ' Peut-être bien que oui.']
+    assert segment(['Oui. Non. Peut-être bien que oui.'], first_min_length=5) == ['Oui. Non.', ' Peut-être bien que oui.']
+
+    # long sentences are cut at their last space, the first one sooner
+    sentences = segment(['mot ' * 100], first_max_length=40, max_length=120)
+    assert len(sentences[0]) <= 40 and all([len(s) <= 120 for s in sentences[1:]])
+    assert ''.join(sentences) == 'mot ' * 100
+
+    # or at their last comma
+    assert segment(['un deux, trois quatre'], min_length=0, max_length=20, first_max_length=20) == [
+        'un deux,', ' trois quatre'
+    ]
+
+
+def test_chunking():
+    expected = segment([ANSWER])
+    assert ''.join(expected) == ANSWER
+    assert segment(list(ANSWER)) == expected
+
+    for seed in range(200):
+        rng = random.Random(seed)
+        chunks = []
+        i = 0
+        while i < len(ANSWER):
+            length = rng.randint(1, 8)
+            chunks.append(ANSWER[i:i + length])
+            i += length
+        assert segment(chunks) == expected, f'Chunking {seed} differs'
+
+
+if __name__ == '__main__':
+    tests = [name for name in list(globals()) if name.startswith('test_')]
+    for name in tests:
+        globals()[name]()
+        print(f'{name} passed')